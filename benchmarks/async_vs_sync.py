@@ -0,0 +1,101 @@
+"""
+Нагрузочное сравнение синхронного (WSGI) и асинхронного (ASGI) стеков API.
+
+Каждый клиент проходит сценарий входа: ``phone/`` -> ``verify/`` -> ``profile/<username>/``.
+Синхронный стек нагружается пулом потоков (как многопоточный WSGI-сервер),
+асинхронный — корутинами в одном цикле событий (как один ASGI-процесс).
+
+    python -m benchmarks.async_vs_sync --clients 200 --concurrency 50
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import Timer, print_table, setup_django, summarize
+
+
+def run_sync(clients, concurrency, prefix):
+    from django.test import Client
+
+    latencies = {'login flow': [], 'phone/': [], 'verify/': [], 'profile/': []}
+
+    def login(number):
+        client = Client()
+        phone_number = f'{prefix}{number:07d}'
+        started = time.perf_counter()
+        with Timer() as timer:
+            response = client.post('/phone/', {'phone_number': phone_number},
+                                   content_type='application/json')
+        latencies['phone/'].append(timer.elapsed)
+        code = response.json()['verification_code']
+
+        with Timer() as timer:
+            client.post('/verify/', {'phone_number': phone_number, 'verification_code': code},
+                        content_type='application/json')
+        latencies['verify/'].append(timer.elapsed)
+
+        with Timer() as timer:
+            client.get(f'/profile/{phone_number}/')
+        latencies['profile/'].append(timer.elapsed)
+        latencies['login flow'].append(time.perf_counter() - started)
+
+    with Timer() as total, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(login, range(clients)))
+    return latencies, total.elapsed
+
+
+async def run_async(clients, concurrency, prefix):
+    from django.test import AsyncClient
+
+    latencies = {'login flow': [], 'phone/': [], 'verify/': [], 'profile/': []}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def login(number):
+        client = AsyncClient()
+        phone_number = f'{prefix}{number:07d}'
+        async with semaphore:
+            started = time.perf_counter()
+            with Timer() as timer:
+                response = await client.post('/async/phone/', {'phone_number': phone_number},
+                                             content_type='application/json')
+            latencies['phone/'].append(timer.elapsed)
+            code = response.json()['verification_code']
+
+            with Timer() as timer:
+                await client.post('/async/verify/',
+                                  {'phone_number': phone_number, 'verification_code': code},
+                                  content_type='application/json')
+            latencies['verify/'].append(timer.elapsed)
+
+            with Timer() as timer:
+                await client.get(f'/async/profile/{phone_number}/')
+            latencies['profile/'].append(timer.elapsed)
+            latencies['login flow'].append(time.perf_counter() - started)
+
+    with Timer() as total:
+        await asyncio.gather(*(login(number) for number in range(clients)))
+    return latencies, total.elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--clients', type=int, default=200, help='Количество сценариев входа')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='Одновременных клиентов (потоков для sync, корутин для async)')
+    parser.add_argument('--database', help='Путь к файлу SQLite (по умолчанию временный)')
+    args = parser.parse_args()
+
+    setup_django(args.database)
+
+    rows = []
+    for stack, (latencies, elapsed) in (
+            ('sync', run_sync(args.clients, args.concurrency, prefix='7900')),
+            ('async', asyncio.run(run_async(args.clients, args.concurrency, prefix='7901')))):
+        for name, values in latencies.items():
+            rows.append((f'{stack}: {name}', summarize(values, elapsed)))
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
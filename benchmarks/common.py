@@ -0,0 +1,84 @@
+"""
+Общие утилиты бенчмарков: настройка Django на отдельной базе и статистика задержек.
+
+Бенчмарки запускаются как модули из корня проекта, например::
+
+    python -m benchmarks.async_vs_sync --clients 200
+
+По умолчанию используется временная база SQLite; чтобы мерить на PostgreSQL,
+задайте переменные окружения ``ENGINE_DB``/``NAME_DB``/... как для settings.py.
+"""
+import os
+import statistics
+import tempfile
+import time
+
+
+def setup_django(database=None, throttling=False):
+    """
+    Настраивает Django для бенчмарка и применяет миграции.
+    Без явных настроек базы создаёт временный файл SQLite.
+    Ограничение частоты запросов по умолчанию отключено: все клиенты бенчмарка
+    приходят с одного адреса.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'referral_system.settings')
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('SMS_BACKEND', 'users.sms.LocmemSmsBackend')
+    if not os.getenv('ENGINE_DB'):
+        os.environ['ENGINE_DB'] = 'django.db.backends.sqlite3'
+        os.environ['NAME_DB'] = database or os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+
+    import django
+    from django.core.management import call_command
+    from django.test.utils import override_settings, setup_test_environment
+
+    django.setup()
+    # Разрешает хост testserver для тестовых клиентов Django
+    setup_test_environment()
+    if not throttling:
+        override_settings(REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': {}}).enable()
+    call_command('migrate', verbosity=0)
+
+
+def percentile(values, percent):
+    """Перцентиль по методу ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, elapsed):
+    """Сводка по списку задержек в секундах: пропускная способность и перцентили в мс"""
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'mean_ms': statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def format_row(name, summary):
+    return (f"{name:<28} {summary['requests']:>8} {summary['rps']:>10.1f} "
+            f"{summary['mean_ms']:>10.2f} {summary['p50_ms']:>10.2f} {summary['p99_ms']:>10.2f}")
+
+
+def print_table(rows):
+    """Печатает таблицу результатов: [(название, сводка), ...]"""
+    print(f"{'benchmark':<28} {'requests':>8} {'req/s':>10} "
+          f"{'mean, ms':>10} {'p50, ms':>10} {'p99, ms':>10}")
+    for name, summary in rows:
+        print(format_row(name, summary))
+
+
+class Timer:
+    """Контекстный менеджер, измеряющий длительность блока в секундах"""
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.started
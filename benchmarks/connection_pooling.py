@@ -0,0 +1,143 @@
+"""
+Задержка API с новым соединением на каждый запрос, с постоянными соединениями и с пулом.
+
+Каждый режим запускается в отдельном процессе (настройки базы читаются при
+старте Django): процесс поднимает WSGI-сервер с фиксированным пулом потоков,
+как у gunicorn с воркерами gthread, и нагружает его HTTP-запросами к
+``phone/`` и ``profile/<username>/``. Тестовый клиент Django для этого не
+подходит: он не закрывает соединения с базой между запросами.
+
+Режимы:
+
+* ``new`` — ``DB_CONN_MAX_AGE=0``, соединение открывается на каждый запрос;
+* ``persistent`` — ``DB_CONN_MAX_AGE=60`` с проверкой соединений;
+* ``pool`` — пул psycopg 3 (``DB_POOL=True``), только для PostgreSQL.
+
+Разница заметна на PostgreSQL (особенно по сети); на SQLite открытие
+соединения дешёвое::
+
+    ENGINE_DB=django.db.backends.postgresql NAME_DB=referral ... \\
+        python -m benchmarks.connection_pooling --requests 2000 --concurrency 16
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from benchmarks.common import Timer, print_table, setup_django, summarize
+
+MODES = {
+    'new': {'DB_CONN_MAX_AGE': '0', 'DB_POOL': 'False'},
+    'persistent': {'DB_CONN_MAX_AGE': '60', 'DB_POOL': 'False'},
+    'pool': {'DB_CONN_MAX_AGE': '0', 'DB_POOL': 'True'},
+}
+
+PROFILE_USERNAME = '79000000000'
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """WSGI-сервер с фиксированным пулом потоков: поток переиспользует своё соединение"""
+
+    def __init__(self, *args, threads, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def run_worker(mode, requests, concurrency):
+    """Выполняется в дочернем процессе: поднимает сервер и печатает задержки в JSON"""
+    setup_django()
+
+    from django.core.wsgi import get_wsgi_application
+
+    server = ThreadPoolWSGIServer(('127.0.0.1', 0), QuietHandler, threads=concurrency)
+    server.set_app(get_wsgi_application())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    def call(path, data=None):
+        request = urllib.request.Request(
+            base_url + path, data=json.dumps(data).encode() if data else None,
+            headers={'Host': 'testserver', 'Content-Type': 'application/json'})
+        with Timer() as timer, urllib.request.urlopen(request) as response:
+            response.read()
+        return timer.elapsed
+
+    # Номера телефонов не пересекаются между режимами
+    prefix = f'71{list(MODES).index(mode)}'
+
+    def scenario(number):
+        return (call('/phone/', {'phone_number': f'{prefix}{number:08d}'}),
+                call(f'/profile/{PROFILE_USERNAME}/'))
+
+    with Timer() as total, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(scenario, range(requests)))
+    server.shutdown()
+
+    json.dump({'elapsed': total.elapsed,
+               'phone/': [phone for phone, _ in results],
+               'profile/': [profile for _, profile in results]}, sys.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='Количество сценариев (phone/ + profile/) на режим')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Одновременных клиентов и потоков сервера')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--database', help='Путь к файлу SQLite (по умолчанию временный)')
+    parser.add_argument('--worker', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.requests, args.concurrency)
+        return
+
+    setup_django(args.database)
+
+    from django.conf import settings
+    from users.models import User
+
+    User.objects.get_or_create(username=PROFILE_USERNAME, phone_number=PROFILE_USERNAME,
+                               defaults={'invite_code': 'BENCH1', 'is_active': True})
+
+    rows = []
+    for mode in args.modes:
+        if mode == 'pool' and 'postgresql' not in settings.DATABASES['default']['ENGINE']:
+            print('pool: пропущено, пул соединений поддерживается только для PostgreSQL',
+                  file=sys.stderr)
+            continue
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.connection_pooling', '--worker', mode,
+             '--requests', str(args.requests), '--concurrency', str(args.concurrency)],
+            env={**os.environ, **MODES[mode]}, check=True, capture_output=True, text=True,
+        ).stdout
+        result = json.loads(output)
+        for name in ('phone/', 'profile/'):
+            rows.append((f'{mode}: {name}', summarize(result[name], result['elapsed'])))
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Время импорта при старте воркера.
+
+В отдельном процессе ``python -X importtime`` выполняется то же, что воркер делает до
+первого запроса: загрузка WSGI-приложения (настройки, приложения, middleware) и
+корневого URLconf со всеми представлениями. Печатаются общее время импорта, время
+запуска процесса и самые дорогие пакеты (собственное время всех их модулей) и модули
+(время с учётом вложенных импортов). Повторы уменьшают шум: берётся медиана.
+
+Как и в benchmarks.suite, результат можно сохранить как базовый и сравнивать с ним;
+при росте общего времени импорта сверх ``--tolerance`` код выхода 1::
+
+    python -m benchmarks.import_time --save-baseline
+    python -m benchmarks.import_time --top 15
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+from benchmarks.common import Timer
+
+BASELINES_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+
+STARTUP = ('from referral_system.wsgi import application\n'
+           'from django.urls import get_resolver\n'
+           'get_resolver().url_patterns\n')
+
+
+def parse(report):
+    """Строки ``-X importtime``: [(модуль, собственное время, с вложенными), ...] в мкс"""
+    modules = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(own), int(cumulative)))
+    return modules
+
+
+def measure(environ):
+    """Один запуск: отчёт о модулях и время работы процесса в секундах"""
+    with Timer() as timer:
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP],
+                                 env=environ, capture_output=True, text=True)
+    if process.returncode:
+        sys.exit(process.stderr)
+    return parse(process.stderr), timer.elapsed
+
+
+def summarize_runs(runs, top):
+    """Медианы по запускам: общее время, пакеты и модули"""
+    totals, walls = [], []
+    packages, modules = defaultdict(list), defaultdict(list)
+    for report, wall in runs:
+        walls.append(wall * 1000)
+        totals.append(sum(own for _, own, _ in report) / 1000)
+        by_package = defaultdict(int)
+        for name, own, cumulative in report:
+            by_package[name.split('.')[0]] += own
+            modules[name].append(cumulative / 1000)
+        for name, own in by_package.items():
+            packages[name].append(own / 1000)
+
+    def ranked(values):
+        medians = {name: statistics.median(times) for name, times in values.items()}
+        return dict(sorted(medians.items(), key=lambda item: -item[1])[:top])
+
+    return {
+        'imports_ms': statistics.median(totals),
+        'process_ms': statistics.median(walls),
+        'modules': len(runs[0][0]),
+        'packages': ranked(packages),
+        'slowest_modules': ranked(modules),
+    }
+
+
+def print_results(results):
+    print(f"Импорт: {results['imports_ms']:.1f} мс, модулей: {results['modules']}, "
+          f"запуск процесса: {results['process_ms']:.1f} мс")
+    for title, key in (('пакет', 'packages'), ('модуль (с вложенными)', 'slowest_modules')):
+        print(f"\n{title:<48} {'мс':>8}")
+        for name, elapsed in results[key].items():
+            print(f'{name:<48} {elapsed:>8.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=5, help='Количество запусков')
+    parser.add_argument('--top', type=int, default=20,
+                        help='Сколько пакетов и модулей показывать')
+    parser.add_argument('--baseline', help='Файл базового результата')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Сохранить результат как базовый')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Допустимый рост общего времени импорта')
+    args = parser.parse_args()
+
+    environ = dict(os.environ)
+    environ.setdefault('DJANGO_SETTINGS_MODULE', 'referral_system.settings')
+    environ.setdefault('SECRET_KEY', 'benchmark')
+    environ.setdefault('ENGINE_DB', 'django.db.backends.sqlite3')
+    environ.setdefault('NAME_DB', os.devnull)
+
+    # Первый запуск прогревает кэш байт-кода и файловой системы и не учитывается
+    measure(environ)
+    results = summarize_runs([measure(environ) for _ in range(args.repeat)], args.top)
+    print_results(results)
+
+    baseline_path = args.baseline or os.path.join(BASELINES_DIR, 'import-time.json')
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, 'w', encoding='utf-8') as stream:
+            json.dump(results, stream, indent=2)
+        print(f'Базовый результат сохранён в {baseline_path}', file=sys.stderr)
+        return
+
+    if not os.path.exists(baseline_path):
+        print(f'Базовый результат {baseline_path} не найден, сравнение пропущено',
+              file=sys.stderr)
+        return
+    with open(baseline_path, encoding='utf-8') as stream:
+        baseline = json.load(stream)
+    allowed = baseline['imports_ms'] * (1 + args.tolerance)
+    if results['imports_ms'] > allowed:
+        print(f"Регрессия: импорт {results['imports_ms']:.1f} мс, "
+              f"базовый {baseline['imports_ms']:.1f} мс", file=sys.stderr)
+        sys.exit(1)
+    print('Регрессий нет', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Пропускная способность доставки исходящих событий.
+
+Записывает ``--events`` событий и доставляет их на локальный HTTP-приёмник
+(``users.testing.LocalWebhookServer``) с задержкой ответа ``--latency`` мс при
+разном количестве параллельных отправок. Для каждого варианта печатаются
+события в секунду и время от записи события до доставки::
+
+    python -m benchmarks.outbox_dispatch --events 2000 --latency 20 --concurrency 1 10 50
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import Timer, print_table, setup_django, summarize
+from users.testing import LocalWebhookServer
+
+
+def run(events, latency, concurrency, batch_size):
+    from users import events as outbox
+    from users.models import OutboxEvent
+
+    OutboxEvent.objects.all().delete()
+    OutboxEvent.objects.bulk_create(OutboxEvent(event_type=OutboxEvent.USER_VERIFIED,
+                                                payload={'user_id': number})
+                                    for number in range(events))
+
+    with LocalWebhookServer(delay=latency / 1000) as server, \
+            ThreadPoolExecutor(max_workers=concurrency) as executor:
+        backend = outbox.WebhookEventBackend(url=server.url)
+        with Timer() as timer:
+            while outbox.dispatch_batch(batch_size=batch_size, backend=backend,
+                                        executor=executor).claimed:
+                pass
+    lags = [(event.sent_at - event.created_at).total_seconds()
+            for event in OutboxEvent.objects.filter(status=OutboxEvent.STATUS_SENT)]
+    return summarize(lags, timer.elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--events', type=int, default=1000, help='Количество событий')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='Задержка ответа приёмника, мс')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50],
+                        help='Варианты количества параллельных отправок')
+    parser.add_argument('--batch-size', type=int, default=100, help='Событий в пачке')
+    parser.add_argument('--database', help='Путь к файлу SQLite (по умолчанию временный)')
+    args = parser.parse_args()
+
+    setup_django(args.database)
+    # Задержка в таблице — время от записи события до доставки
+    print_table([(f'concurrency={concurrency}',
+                  run(args.events, args.latency, concurrency, args.batch_size))
+                 for concurrency in args.concurrency])
+
+
+if __name__ == '__main__':
+    main()
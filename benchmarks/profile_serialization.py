@@ -0,0 +1,86 @@
+"""
+Сериализация профиля: ModelSerializer и JSONRenderer DRF против выборки
+``values_list()`` (users/serializers.py:load_profile) и рендерера orjson
+(users/renderers.py).
+
+Сравнивает отдельно кодирование готовых данных и полный путь промаха кэша
+профилей (чтение из базы, сериализация и кодирование) для пользователя с
+``--invited`` приглашёнными. Перед замером проверяется, что оба пути дают
+одинаковые байты.
+
+    python -m benchmarks.profile_serialization --iterations 5000
+"""
+import argparse
+
+from benchmarks.common import Timer, print_table, setup_django, summarize
+
+PROFILE_USERNAME = '79100000000'
+
+
+def measure(function, iterations):
+    latencies = []
+    with Timer() as total:
+        for _ in range(iterations):
+            with Timer() as timer:
+                function()
+            latencies.append(timer.elapsed)
+    return summarize(latencies, total.elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--iterations', type=int, default=5000,
+                        help='Повторений каждого варианта')
+    parser.add_argument('--invited', type=int, default=20,
+                        help='Количество приглашённых у профиля')
+    parser.add_argument('--database', help='Путь к файлу SQLite (по умолчанию временный)')
+    args = parser.parse_args()
+
+    setup_django(args.database)
+
+    from rest_framework.renderers import JSONRenderer
+
+    from users import renderers
+    from users.models import Referral, User
+    from users.serializers import UserProfileSerializer, load_profile
+
+    if renderers.orjson is None:
+        print('orjson не установлен: FastJSONRenderer использует энкодер DRF')
+
+    inviter, _ = User.objects.get_or_create(
+        username=PROFILE_USERNAME, phone_number=PROFILE_USERNAME,
+        defaults={'invite_code': 'BENCH2', 'is_active': True})
+    if not Referral.objects.filter(inviter=inviter).exists():
+        invitees = User.objects.bulk_create(
+            [User(username=f'7910{number:07d}', phone_number=f'7910{number:07d}',
+                  phone_key=int(f'7910{number:07d}'), activated_invite_code='BENCH2')
+             for number in range(1, args.invited + 1)])
+        Referral.objects.bulk_create([Referral(inviter=inviter, invitee=invitee)
+                                      for invitee in invitees])
+
+    drf_renderer, fast_renderer = JSONRenderer(), renderers.FastJSONRenderer()
+
+    def drf_path():
+        user = User.objects.get(username=PROFILE_USERNAME)
+        return drf_renderer.render(UserProfileSerializer(user).data)
+
+    def lean_path():
+        return fast_renderer.render(load_profile(PROFILE_USERNAME))
+
+    if drf_path() != lean_path():
+        raise SystemExit('Пути сериализации дают разные ответы')
+
+    data = load_profile(PROFILE_USERNAME)
+    user = User.objects.get(username=PROFILE_USERNAME)
+    print_table([
+        ('encode JSONRenderer', measure(lambda: drf_renderer.render(data), args.iterations)),
+        ('encode orjson', measure(lambda: fast_renderer.render(data), args.iterations)),
+        ('serialize ModelSerializer',
+         measure(lambda: UserProfileSerializer(user).data, args.iterations)),
+        ('load+render DRF', measure(drf_path, args.iterations)),
+        ('load+render lean', measure(lean_path, args.iterations)),
+    ])
+
+
+if __name__ == '__main__':
+    main()
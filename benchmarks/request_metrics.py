@@ -0,0 +1,65 @@
+"""
+Накладные расходы сбора метрик запросов (users/middleware.py).
+
+Сравнивает задержку ``profile/<username>/`` (ответ из кэша, самый дешёвый
+эндпоинт, где доля накладных расходов максимальна) и ``phone/`` без
+middleware, с полной выборкой и с выборкой 10% запросов.
+
+    python -m benchmarks.request_metrics --requests 5000
+"""
+import argparse
+
+from benchmarks.common import Timer, print_table, setup_django, summarize
+
+PROFILE_USERNAME = '79000000000'
+
+
+def run(requests, prefix):
+    from django.test import Client
+
+    client = Client()
+    latencies = {'profile/': [], 'phone/': []}
+    with Timer() as total:
+        for number in range(requests):
+            with Timer() as timer:
+                client.get(f'/profile/{PROFILE_USERNAME}/')
+            latencies['profile/'].append(timer.elapsed)
+            with Timer() as timer:
+                client.post('/phone/', {'phone_number': f'{prefix}{number:07d}'},
+                            content_type='application/json')
+            latencies['phone/'].append(timer.elapsed)
+    return latencies, total.elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=5000,
+                        help='Количество запросов к каждому эндпоинту в каждом режиме')
+    parser.add_argument('--database', help='Путь к файлу SQLite (по умолчанию временный)')
+    args = parser.parse_args()
+
+    setup_django(args.database)
+
+    from django.conf import settings
+    from django.test.utils import override_settings
+    from users.models import User
+
+    User.objects.get_or_create(username=PROFILE_USERNAME, phone_number=PROFILE_USERNAME,
+                               defaults={'invite_code': 'BENCH1', 'is_active': True})
+    without_metrics = [name for name in settings.MIDDLEWARE
+                       if name != 'users.middleware.RequestMetricsMiddleware']
+
+    rows = []
+    for mode, prefix, overrides in (
+            ('off', '7300', {'MIDDLEWARE': without_metrics}),
+            ('sampled 100%', '7301', {'METRICS_SAMPLE_RATE': 1.0}),
+            ('sampled 10%', '7302', {'METRICS_SAMPLE_RATE': 0.1})):
+        with override_settings(**overrides):
+            latencies, elapsed = run(args.requests, prefix)
+        for name, values in latencies.items():
+            rows.append((f'{name} {mode}', summarize(values, elapsed)))
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+"""
+Нагрузочный набор для API реферальной системы.
+
+Заполняет базу ``--users`` пользователями со случайным деревом рефералов, затем
+``--clients`` клиентов параллельно (потоками или корутинами) проходят сценарий
+``phone/`` -> ``verify/`` -> ``profile/<username>/`` -> ``activate-invite-code/``.
+Для каждого эндпоинта печатаются пропускная способность (его запросы за время
+от начала первого до конца последнего из них), перцентили задержки и среднее
+количество SQL-запросов (по метрикам users/metrics.py).
+
+Результат можно сохранить как базовый (``--save-baseline``); при следующих
+запусках он сравнивается с базовым, и при регрессии сверх ``--tolerance``
+или росте количества запросов команда завершается с кодом 1::
+
+    python -m benchmarks.suite --users 10000 --clients 500 --save-baseline
+    python -m benchmarks.suite --users 10000 --clients 500
+
+Базовые результаты хранятся в ``benchmarks/baselines/<база>-<режим>.json`` и
+зависят от машины, поэтому в репозиторий не добавляются.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import Timer, setup_django, summarize
+
+ENDPOINTS = {
+    # эндпоинт: (маршрут синхронного API, маршрут асинхронного API)
+    'phone/': ('phone_number', 'phone_number_async'),
+    'verify/': ('verify_code', 'verify_code_async'),
+    'profile/': ('user-profile', 'user-profile-async'),
+    'activate-invite-code/': ('activate-invite-code', 'activate-invite-code-async'),
+}
+
+SEED_PREFIX = '7000'
+CLIENT_PREFIX = '7001'
+BASELINES_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+
+
+def seed(users, batch_size=5000):
+    """Создаёт активных пользователей с инвайт-кодами и случайным деревом рефералов"""
+    from django.db import transaction
+    from django.utils import timezone
+
+    from users import invite_codes, leaderboard
+    from users.models import Referral, User
+
+    if User.objects.filter(username__startswith=SEED_PREFIX).count() >= users:
+        return list(User.objects.filter(username__startswith=SEED_PREFIX)
+                    .values_list('username', 'invite_code')[:users])
+
+    rng = random.Random(users)
+    now = timezone.now()
+    with transaction.atomic():
+        created = []
+        for start in range(0, users, batch_size):
+            batch = [User(username=f'{SEED_PREFIX}{number:07d}',
+                          phone_number=f'{SEED_PREFIX}{number:07d}',
+                          phone_key=int(f'{SEED_PREFIX}{number:07d}'), is_active=True)
+                     for number in range(start, min(users, start + batch_size))]
+            created += User.objects.bulk_create(batch)
+
+        referrals = []
+        for index, user in enumerate(created):
+            user.invite_code = invite_codes.candidates(user.pk)[0]
+            if index:
+                # Чаще приглашают ранние пользователи: дерево с длинным хвостом
+                inviter = created[int(index * rng.random() ** 2)]
+                referrals.append(Referral(
+                    inviter=inviter, invitee=user,
+                    activated_at=now - timedelta(seconds=rng.randrange(86400 * 60))))
+                inviter.invited_count += 1
+        for referral in referrals:
+            referral.invitee.activated_invite_code = referral.inviter.invite_code
+
+        User.objects.bulk_update(created, ['invite_code', 'activated_invite_code',
+                                           'invited_count'], batch_size=batch_size)
+        Referral.objects.bulk_create(referrals, batch_size=batch_size)
+        leaderboard.reconcile(days=62)
+    return [(user.username, user.invite_code) for user in created]
+
+
+def flow(seeded, number, prefix):
+    """
+    Сценарий клиента ``number``: номер телефона и запросы (эндпоинт, метод, путь, данные).
+    Данные для verify/ подставляются после ответа phone/.
+    """
+    phone_number = f'{CLIENT_PREFIX}{number:07d}'
+    rng = random.Random(number)
+    profile, _ = rng.choice(seeded)
+    _, invite_code = rng.choice(seeded)
+    return phone_number, [
+        ('phone/', 'post', f'{prefix}phone/', {'phone_number': phone_number}),
+        ('verify/', 'post', f'{prefix}verify/', None),
+        ('profile/', 'get', f'{prefix}profile/{profile}/', None),
+        ('activate-invite-code/', 'post', f'{prefix}profile/{phone_number}/activate-invite-code/',
+         {'phone_number': phone_number, 'activated_invite_code': invite_code}),
+    ]
+
+
+def run_threads(seeded, clients, concurrency):
+    from django.test import Client
+
+    # эндпоинт: [(начало запроса, длительность), ...]
+    timings = {endpoint: [] for endpoint in ENDPOINTS}
+
+    def login(number):
+        client = Client()
+        phone_number, steps = flow(seeded, number, prefix='/')
+        code = None
+        for endpoint, method, path, data in steps:
+            if endpoint == 'verify/':
+                data = {'phone_number': phone_number, 'verification_code': code}
+            with Timer() as timer:
+                if method == 'get':
+                    response = client.get(path)
+                else:
+                    response = client.post(path, data, content_type='application/json')
+            timings[endpoint].append((timer.started, timer.elapsed))
+            if endpoint == 'phone/':
+                code = response.json()['verification_code']
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(login, range(clients)))
+    return timings
+
+
+async def run_async(seeded, clients, concurrency):
+    from django.test import AsyncClient
+
+    timings = {endpoint: [] for endpoint in ENDPOINTS}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def login(number):
+        client = AsyncClient()
+        phone_number, steps = flow(seeded, number, prefix='/async/')
+        code = None
+        async with semaphore:
+            for endpoint, method, path, data in steps:
+                if endpoint == 'verify/':
+                    data = {'phone_number': phone_number, 'verification_code': code}
+                with Timer() as timer:
+                    if method == 'get':
+                        response = await client.get(path)
+                    else:
+                        response = await client.post(path, data,
+                                                     content_type='application/json')
+                timings[endpoint].append((timer.started, timer.elapsed))
+                if endpoint == 'phone/':
+                    code = response.json()['verification_code']
+
+    await asyncio.gather(*(login(number) for number in range(clients)))
+    return timings
+
+
+def collect(timings, mode):
+    """
+    Сводка по эндпоинтам с количеством SQL-запросов из метрик. Пропускная
+    способность эндпоинта — его запросы за окно от начала первого до конца
+    последнего из них, а не за время всего прогона.
+    """
+    from users import metrics
+
+    results = {}
+    for endpoint, requests in timings.items():
+        route = ENDPOINTS[endpoint][mode == 'async']
+        count, total = metrics.registry.summary(route, 'http_request_db_queries')
+        elapsed = (max(started + duration for started, duration in requests) -
+                   min(started for started, _ in requests)) if requests else 0.0
+        results[endpoint] = {**summarize([duration for _, duration in requests], elapsed),
+                             'queries': round(total / count, 2) if count else 0.0}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Список регрессий относительно базового результата"""
+    regressions = []
+    for endpoint, current in results.items():
+        base = baseline.get(endpoint)
+        if base is None:
+            continue
+        # Хвост распределения шумнее медианы, для p99 допуск вдвое больше
+        for key, allowed in (('p50_ms', tolerance), ('p99_ms', tolerance * 2)):
+            if current[key] > base[key] * (1 + allowed):
+                regressions.append(f'{endpoint} {key}: {current[key]:.2f} > '
+                                   f'{base[key]:.2f} (+{allowed:.0%})')
+        if current['rps'] < base['rps'] / (1 + tolerance):
+            regressions.append(f"{endpoint} rps: {current['rps']:.1f} < {base['rps']:.1f}")
+        # Доля попаданий в кэш профилей зависит от порядка запросов клиентов
+        if current['queries'] > base['queries'] + 0.1:
+            regressions.append(f"{endpoint} queries: {current['queries']} > {base['queries']}")
+    return regressions
+
+
+def print_results(results):
+    print(f"{'endpoint':<24} {'requests':>8} {'req/s':>10} {'p50, ms':>10} "
+          f"{'p99, ms':>10} {'queries':>8}")
+    for endpoint, summary in results.items():
+        print(f"{endpoint:<24} {summary['requests']:>8} {summary['rps']:>10.1f} "
+              f"{summary['p50_ms']:>10.2f} {summary['p99_ms']:>10.2f} "
+              f"{summary['queries']:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=10000,
+                        help='Количество пользователей в дереве рефералов')
+    parser.add_argument('--clients', type=int, default=500,
+                        help='Количество клиентов, проходящих сценарий')
+    parser.add_argument('--concurrency', type=int, default=20,
+                        help='Одновременных клиентов')
+    parser.add_argument('--mode', choices=['thread', 'async'], default='thread',
+                        help='Потоки и синхронный API или корутины и /async/ API')
+    parser.add_argument('--database', help='Путь к файлу SQLite (по умолчанию временный)')
+    parser.add_argument('--baseline', help='Файл базового результата')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Сохранить результат как базовый')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Допустимое ухудшение задержки и пропускной способности')
+    args = parser.parse_args()
+
+    setup_django(args.database)
+
+    from django.db import connection
+    from django.test.utils import override_settings
+
+    with Timer() as timer:
+        seeded = seed(args.users)
+    print(f'Заполнение базы: {len(seeded)} пользователей за {timer.elapsed:.1f} с',
+          file=sys.stderr)
+
+    from users.models import User
+    # Повторный запуск на той же базе: номера клиентов прошлого запуска освобождаются
+    User.objects.filter(username__startswith=CLIENT_PREFIX).delete()
+
+    with override_settings(METRICS_SAMPLE_RATE=1.0):
+        if args.mode == 'async':
+            timings = asyncio.run(run_async(seeded, args.clients, args.concurrency))
+        else:
+            timings = run_threads(seeded, args.clients, args.concurrency)
+    results = collect(timings, args.mode)
+    print_results(results)
+
+    baseline_path = args.baseline or os.path.join(
+        BASELINES_DIR, f'{connection.vendor}-{args.mode}.json')
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, 'w', encoding='utf-8') as stream:
+            json.dump(results, stream, indent=2)
+        print(f'Базовый результат сохранён в {baseline_path}', file=sys.stderr)
+        return
+
+    if not os.path.exists(baseline_path):
+        print(f'Базовый результат {baseline_path} не найден, сравнение пропущено',
+              file=sys.stderr)
+        return
+    with open(baseline_path, encoding='utf-8') as stream:
+        regressions = compare(results, json.load(stream), args.tolerance)
+    if regressions:
+        print('Регрессии относительно базового результата:', *regressions,
+              sep='\n  ', file=sys.stderr)
+        sys.exit(1)
+    print('Регрессий нет', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Стоимость ограничения частоты запросов на эндпоинтах входа.
+
+Замеряет отдельную проверку ограничений (три ведра: номер, IP и общее) и
+задержку ``phone/`` и ``verify/`` с ограничениями и без них. Лимиты в замере
+с ограничениями заданы заведомо большими, чтобы все запросы проходили проверку
+полностью и ни один не отклонялся.
+
+    python -m benchmarks.throttling --requests 2000
+"""
+import argparse
+
+from benchmarks.common import Timer, print_table, setup_django, summarize
+
+UNLIMITED = {f'{scope}_{kind}': '1000000/sec'
+             for scope in ('sms', 'verify') for kind in ('phone', 'ip', 'global')}
+
+
+def run_checks(requests):
+    """Задержка проверки трёх вёдер для одного запроса, без HTTP и базы данных"""
+    from rest_framework.test import APIRequestFactory
+
+    from users.throttling import LOGIN_THROTTLES
+    from users.views import PhoneNumberView
+
+    factory = APIRequestFactory()
+    view = PhoneNumberView()
+    prepared = [view.initialize_request(
+        factory.post('/phone/', {'phone_number': f'7999{number:07d}'}, format='json'))
+        for number in range(requests)]
+    for request in prepared:
+        request.data  # разбор тела не входит в замер
+
+    latencies = []
+    with Timer() as total:
+        for request in prepared:
+            with Timer() as timer:
+                for throttle_class in LOGIN_THROTTLES:
+                    assert throttle_class().allow_request(request, view)
+            latencies.append(timer.elapsed)
+    return latencies, total.elapsed
+
+
+def run_endpoints(requests, prefix):
+    """Задержки phone/ и verify/ последовательными запросами одного клиента"""
+    from django.test import Client
+
+    client = Client()
+    latencies = {'phone/': [], 'verify/': []}
+    with Timer() as total:
+        for number in range(requests):
+            phone_number = f'{prefix}{number:07d}'
+            with Timer() as timer:
+                client.post('/phone/', {'phone_number': phone_number},
+                            content_type='application/json')
+            latencies['phone/'].append(timer.elapsed)
+            with Timer() as timer:
+                client.post('/verify/', {'phone_number': phone_number,
+                                         'verification_code': '0000'},
+                            content_type='application/json')
+            latencies['verify/'].append(timer.elapsed)
+    return latencies, total.elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='Количество запросов в каждом замере')
+    parser.add_argument('--database', help='Путь к файлу SQLite (по умолчанию временный)')
+    args = parser.parse_args()
+
+    setup_django(args.database)
+
+    from django.test.utils import override_settings
+
+    rows = []
+    with override_settings(REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': UNLIMITED}):
+        latencies, elapsed = run_checks(args.requests)
+        rows.append(('throttle check (3 buckets)', summarize(latencies, elapsed)))
+        latencies, elapsed = run_endpoints(args.requests, prefix='7100')
+    for name, values in latencies.items():
+        rows.append((f'{name} throttled', summarize(values, elapsed)))
+
+    latencies, elapsed = run_endpoints(args.requests, prefix='7200')
+    for name, values in latencies.items():
+        rows.append((f'{name} unthrottled', summarize(values, elapsed)))
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""
+Документация API на drf_yasg: Swagger UI, ReDoc и генерация схемы OpenAPI.
+
+Модуль импортируется лениво — при первом запросе к swagger/ или redoc/ (см. urls.py)
+и командой generate_openapi_schema, — поэтому воркеры не загружают drf_yasg при старте.
+Страницы документации сами схему не строят: они загружают заранее сгенерированную
+схему по адресу ``SPEC_URL`` (см. referral_system/schema.py).
+"""
+from drf_yasg import openapi
+from drf_yasg.codecs import OpenAPICodecJson
+from drf_yasg.views import get_schema_view
+from rest_framework import permissions
+
+API_INFO = openapi.Info(
+    title="Referral System API",
+    default_version='v1',
+    description="API простой реферальной системы",
+    contact=openapi.Contact(email="imletoroma@gmail.com"),
+    license=openapi.License(name="BSD License"),
+)
+
+schema_view = get_schema_view(
+    API_INFO,
+    public=True,
+    permission_classes=[permissions.AllowAny],  # Уровень доступа
+)
+
+swagger_ui = schema_view.with_ui('swagger', cache_timeout=0)
+redoc_ui = schema_view.with_ui('redoc', cache_timeout=0)
+
+
+def generate_schema(url=None):
+    """
+    Схема OpenAPI всех эндпоинтов в JSON (байты). ``url`` — схема и хост API
+    (``https://api.example.com``); без него клиенты используют адрес страницы.
+    """
+    generator = schema_view.generator_class(API_INFO, url=url)
+    return OpenAPICodecJson(validators=[]).encode(generator.get_schema(request=None, public=True))
@@ -0,0 +1,124 @@
+"""
+Раздача заранее сгенерированной схемы OpenAPI.
+
+Схема строится один раз при сборке командой ``generate_openapi_schema`` и хранится
+в двух файлах: ``openapi.json`` и сжатый ``openapi.json.gz``. Клиенту, принимающему
+gzip, отдаётся готовый сжатый файл, без сжатия на каждый запрос. ETag — хеш
+содержимого, поэтому повторные загрузки схемы Swagger UI и ReDoc получают 304.
+
+Файлы читаются один раз на процесс и перечитываются, только если схема
+перегенерирована. Если файла нет (например, при разработке), схема генерируется
+при первом запросе и хранится в памяти процесса.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import re
+import threading
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_safe
+from django.views.decorators.vary import vary_on_headers
+
+logger = logging.getLogger(__name__)
+
+ACCEPTS_GZIP = re.compile(r'\bgzip\b')
+
+_lock = threading.Lock()
+# Путь к схеме -> (время изменения файла или None, Schema)
+_loaded = {}
+
+
+class Schema:
+    """Содержимое схемы, его сжатая копия и ETag"""
+    __slots__ = ('content', 'compressed', 'etag')
+
+    def __init__(self, content, compressed=None):
+        self.content = content
+        self.compressed = compress(content) if compressed is None else compressed
+        self.etag = hashlib.sha256(content).hexdigest()[:32]
+
+
+def compress(content):
+    # mtime=0: одинаковая схема всегда даёт одинаковый файл
+    return gzip.compress(content, compresslevel=9, mtime=0)
+
+
+def write(path, content):
+    """
+    Записывает схему и её сжатую копию через временные файлы, возвращает сжатую копию.
+    Она заменяется первой: процесс, увидевший новый openapi.json, прочитает и новый .gz.
+    """
+    compressed = compress(content)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    for target, data in ((f'{path}.gz', compressed), (path, content)):
+        with open(f'{target}.tmp', 'wb') as stream:
+            stream.write(data)
+        os.replace(f'{target}.tmp', target)
+    return compressed
+
+
+def read(path):
+    with open(path, 'rb') as stream:
+        content = stream.read()
+    try:
+        with open(f'{path}.gz', 'rb') as stream:
+            compressed = stream.read()
+    except FileNotFoundError:
+        compressed = None
+    return Schema(content, compressed)
+
+
+def load():
+    """Текущая схема: из файла OPENAPI_SCHEMA_PATH или сгенерированная в памяти"""
+    path = str(settings.OPENAPI_SCHEMA_PATH)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    loaded = _loaded.get(path)
+    if loaded is not None and loaded[0] == mtime:
+        return loaded[1]
+
+    with _lock:
+        loaded = _loaded.get(path)
+        if loaded is not None and loaded[0] == mtime:
+            return loaded[1]
+        if mtime is None:
+            from referral_system import docs
+
+            logger.warning("Схема OpenAPI %s не найдена, генерируется при запросе; "
+                           "выполните manage.py generate_openapi_schema", path)
+            schema = Schema(docs.generate_schema())
+        else:
+            schema = read(path)
+        _loaded[path] = (mtime, schema)
+    return schema
+
+
+def accepts_gzip(request):
+    return bool(ACCEPTS_GZIP.search(request.headers.get('Accept-Encoding', '')))
+
+
+def schema_etag(request):
+    # Сжатый и несжатый ответы — разные представления, у них разные ETag
+    etag = load().etag
+    return f'{etag}-gzip' if accepts_gzip(request) else etag
+
+
+@require_safe
+@vary_on_headers('Accept-Encoding')
+@cache_control(public=True, no_cache=True)
+@condition(etag_func=schema_etag)
+def openapi_schema(request):
+    """Схема OpenAPI для Swagger UI и ReDoc (SPEC_URL в настройках drf_yasg)"""
+    schema = load()
+    if accepts_gzip(request):
+        response = HttpResponse(schema.compressed, content_type='application/json')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(schema.content, content_type='application/json')
+    return response
@@ -34,6 +34,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'users.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -64,6 +65,10 @@ TEMPLATES = [
 WSGI_APPLICATION = 'referral_system.wsgi.application'
 
 # Database
+# Постоянные соединения: соединение переиспользуется потоком до DB_CONN_MAX_AGE секунд
+# (0 — новое соединение на каждый запрос, пустое значение — без ограничения)
+DB_CONN_MAX_AGE = os.getenv('DB_CONN_MAX_AGE', '60')
+
 DATABASES = {
     'default': {
         'ENGINE': os.getenv("ENGINE_DB"),
@@ -72,9 +77,74 @@ DATABASES = {
         'PASSWORD': os.getenv("PASSWORD_DB"),
         'HOST': os.getenv("HOST_DB"),
         'PORT': os.getenv("PORT_DB"),
+        'CONN_MAX_AGE': int(DB_CONN_MAX_AGE) if DB_CONN_MAX_AGE else None,
+        # Проверка переиспользуемого соединения перед первым запросом в каждом запросе
+        'CONN_HEALTH_CHECKS': os.getenv('DB_CONN_HEALTH_CHECKS', 'True') == 'True',
+        'OPTIONS': {},
     }
 }
 
+# Пул соединений psycopg 3 (только PostgreSQL, нужен пакет "psycopg[pool]").
+# Пул заменяет постоянные соединения: Django требует CONN_MAX_AGE = 0
+if os.getenv('DB_POOL') == 'True':
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+        'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+        'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+    }
+
+# Реплики для чтения (см. users/replicas.py): хосты через запятую, остальные параметры
+# подключения как у default. Профиль, изменённый за последние REPLICA_PIN_SECONDS секунд
+# (дольше ожидаемого отставания реплик), читается из основной базы
+DB_REPLICA_HOSTS = [host for host in os.getenv('DB_REPLICA_HOSTS', '').split(',') if host]
+DATABASE_REPLICAS = []
+for number, host in enumerate(DB_REPLICA_HOSTS, 1):
+    DATABASES[f'replica{number}'] = {**DATABASES['default'], 'HOST': host,
+                                     'OPTIONS': dict(DATABASES['default']['OPTIONS']),
+                                     # В тестах реплика — та же база, что и default
+                                     'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append(f'replica{number}')
+DATABASE_ROUTERS = ['users.replicas.ReplicaRouter']
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', 5))
+REPLICA_PIN_CACHE_ALIAS = 'default'
+
+# Cache
+# По умолчанию кэш в памяти процесса; при заданном REDIS_URL — общий кэш в Redis
+REDIS_URL = os.getenv('REDIS_URL')
+CACHE_BACKEND = ('django.core.cache.backends.redis.RedisCache' if REDIS_URL
+                 else 'django.core.cache.backends.locmem.LocMemCache')
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': REDIS_URL or 'default',
+    },
+    'profiles': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': REDIS_URL or 'profiles',
+        'KEY_PREFIX': 'profiles',
+        'OPTIONS': ({} if REDIS_URL
+                    else {'MAX_ENTRIES': int(os.getenv('PROFILE_CACHE_MAX_ENTRIES', 100000))}),
+    },
+    # Отозванные и погашенные токены: вытеснение записи снова сделало бы токен
+    # действительным, поэтому кэш отдельный и с большим лимитом записей
+    'tokens': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': REDIS_URL or 'tokens',
+        'KEY_PREFIX': 'tokens',
+        'OPTIONS': ({} if REDIS_URL
+                    else {'MAX_ENTRIES': int(os.getenv('TOKEN_CACHE_MAX_ENTRIES', 1000000))}),
+    },
+}
+
+# Кэш профилей (см. users/cache.py); версии профилей — в общем для воркеров кэше
+PROFILE_CACHE_ALIAS = 'profiles'
+PROFILE_VERSION_CACHE_ALIAS = 'default'
+PROFILE_CACHE_TIMEOUT = int(os.getenv('PROFILE_CACHE_TIMEOUT', 600))
+
+# Сессии шаблонного интерфейса и админки читаются из кэша, из базы — только при промахе
+SESSION_ENGINE = os.getenv('SESSION_ENGINE', 'django.contrib.sessions.backends.cached_db')
+
 # Новая модель пользователя
 AUTH_USER_MODEL = 'users.User'
 
@@ -103,5 +173,101 @@ USE_TZ = True
 # Static files (CSS, JavaScript, Images)
 STATIC_URL = 'static/'
 
+# Документация API (см. referral_system/schema.py): файл заранее сгенерированной схемы
+# OpenAPI (manage.py generate_openapi_schema). Swagger UI и ReDoc загружают схему из него
+# вместо построения по всем представлениям на каждый запрос
+OPENAPI_SCHEMA_PATH = os.getenv('OPENAPI_SCHEMA_PATH', BASE_DIR / 'openapi' / 'openapi.json')
+SWAGGER_SETTINGS = {'SPEC_URL': 'openapi-schema'}
+REDOC_SETTINGS = {'SPEC_URL': 'openapi-schema'}
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Нормализация номеров телефонов (см. users/phones.py): код страны для номеров без него,
+# префикс выхода на межгород и длина национального номера
+PHONE_COUNTRY_CODE = os.getenv('PHONE_COUNTRY_CODE', '7')
+PHONE_TRUNK_PREFIX = os.getenv('PHONE_TRUNK_PREFIX', '8')
+PHONE_NATIONAL_LENGTH = int(os.getenv('PHONE_NATIONAL_LENGTH', 10))
+
+# Доставка SMS (см. users/sms.py и команду sms_worker): попытки и паузы между ними
+# (секунды, пауза удваивается с каждой попыткой), срок, на который воркер забирает пачку
+SMS_BACKEND = os.getenv('SMS_BACKEND', 'users.sms.ConsoleSmsBackend')
+SMS_FILE_PATH = os.getenv('SMS_FILE_PATH', BASE_DIR / 'sms_outbox.jsonl')
+SMS_BATCH_SIZE = int(os.getenv('SMS_BATCH_SIZE', 100))
+SMS_MAX_ATTEMPTS = int(os.getenv('SMS_MAX_ATTEMPTS', 5))
+SMS_RETRY_DELAY = float(os.getenv('SMS_RETRY_DELAY', 2))
+SMS_RETRY_MAX_DELAY = float(os.getenv('SMS_RETRY_MAX_DELAY', 60))
+SMS_LEASE_TIMEOUT = int(os.getenv('SMS_LEASE_TIMEOUT', 60))
+
+# Исходящие события для внешних систем (см. users/events.py и команду events_worker):
+# адрес вебхука и ключ подписи, размер пачки и количество параллельных отправок,
+# попытки и паузы между ними (секунды, пауза удваивается с каждой попыткой)
+EVENTS_BACKEND = os.getenv('EVENTS_BACKEND', 'users.events.WebhookEventBackend')
+EVENTS_WEBHOOK_URL = os.getenv('EVENTS_WEBHOOK_URL')
+EVENTS_WEBHOOK_SECRET = os.getenv('EVENTS_WEBHOOK_SECRET')
+EVENTS_WEBHOOK_TIMEOUT = float(os.getenv('EVENTS_WEBHOOK_TIMEOUT', 5))
+EVENTS_BATCH_SIZE = int(os.getenv('EVENTS_BATCH_SIZE', 100))
+EVENTS_CONCURRENCY = int(os.getenv('EVENTS_CONCURRENCY', 10))
+EVENTS_MAX_ATTEMPTS = int(os.getenv('EVENTS_MAX_ATTEMPTS', 10))
+EVENTS_RETRY_DELAY = float(os.getenv('EVENTS_RETRY_DELAY', 1))
+EVENTS_RETRY_MAX_DELAY = float(os.getenv('EVENTS_RETRY_MAX_DELAY', 3600))
+# На сколько воркер забирает пачку; должно превышать время её отправки
+EVENTS_LEASE_TIMEOUT = int(os.getenv('EVENTS_LEASE_TIMEOUT', 300))
+EVENTS_METRICS_CACHE_ALIAS = 'default'
+
+# Коды верификации (см. users/verification.py)
+VERIFICATION_STORE = os.getenv('VERIFICATION_STORE',
+                               'users.verification.DatabaseVerificationStore')
+VERIFICATION_CACHE_ALIAS = 'default'
+VERIFICATION_CODE_TTL = int(os.getenv('VERIFICATION_CODE_TTL', 600))  # секунды
+VERIFICATION_MAX_ATTEMPTS = int(os.getenv('VERIFICATION_MAX_ATTEMPTS', 5))
+
+# Ограничение частоты запросов (см. users/throttling.py): "<число>/<период>",
+# пустое значение переменной окружения отключает ограничение
+REST_FRAMEWORK = {
+    # Токен доступа проверяется без запросов к базе (см. users/authentication.py)
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'users.authentication.SignedTokenAuthentication',
+        'rest_framework.authentication.SessionAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ],
+    'DEFAULT_THROTTLE_RATES': {
+        'sms_phone': os.getenv('THROTTLE_SMS_PHONE', '5/hour') or None,
+        'sms_ip': os.getenv('THROTTLE_SMS_IP', '30/hour') or None,
+        'sms_global': os.getenv('THROTTLE_SMS_GLOBAL', '50/sec') or None,
+        'verify_phone': os.getenv('THROTTLE_VERIFY_PHONE', '20/hour') or None,
+        'verify_ip': os.getenv('THROTTLE_VERIFY_IP', '60/hour') or None,
+        'verify_global': os.getenv('THROTTLE_VERIFY_GLOBAL', '200/sec') or None,
+    },
+    # Количество прокси перед приложением: IP клиента берётся из X-Forwarded-For
+    'NUM_PROXIES': int(os.getenv('NUM_PROXIES')) if os.getenv('NUM_PROXIES') else None,
+}
+THROTTLE_CACHE_ALIAS = 'default'
+
+# Токены доступа и обновления (см. users/tokens.py): время жизни в секундах и кэш списка отзыва
+ACCESS_TOKEN_TTL = int(os.getenv('ACCESS_TOKEN_TTL', 15 * 60))
+REFRESH_TOKEN_TTL = int(os.getenv('REFRESH_TOKEN_TTL', 30 * 24 * 60 * 60))
+TOKEN_CACHE_ALIAS = 'tokens'
+# Активация инвайт-кода только с токеном доступа; без него пользователь определяется
+# по номеру телефона в теле запроса (для клиентов, ещё не получающих токены)
+INVITE_ACTIVATION_REQUIRES_TOKEN = os.getenv('INVITE_ACTIVATION_REQUIRES_TOKEN', 'False') == 'True'
+
+# Максимальное количество пользователей в одном запросе profiles/lookup/
+PROFILE_LOOKUP_MAX_BATCH = int(os.getenv('PROFILE_LOOKUP_MAX_BATCH', 5000))
+
+# Аналитика дерева рефералов (см. users/referral_tree.py): вести таблицу замыкания
+# при активации инвайт-кодов и максимальная глубина обхода дерева
+REFERRAL_CLOSURE_ENABLED = os.getenv('REFERRAL_CLOSURE_ENABLED', 'False') == 'True'
+REFERRAL_TREE_MAX_DEPTH = int(os.getenv('REFERRAL_TREE_MAX_DEPTH', 100))
+
+# Время жизни закэшированной первой страницы приглашённых пользователей, секунды
+INVITED_USERS_CACHE_TIMEOUT = int(os.getenv('INVITED_USERS_CACHE_TIMEOUT', 300))
+
+# Отставание отметки export_referrals от текущего момента, секунды: транзакции,
+# начатые до выгрузки и закоммиченные после неё, попадут в следующую выгрузку
+EXPORT_LAG = int(os.getenv('EXPORT_LAG', 60))
+
+# Метрики запросов (см. users/metrics.py): доля запросов с детальными метриками
+# и токен доступа к эндпоинту metrics/ (без токена эндпоинт открыт)
+METRICS_SAMPLE_RATE = float(os.getenv('METRICS_SAMPLE_RATE', 1.0))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
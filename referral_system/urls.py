@@ -1,38 +1,63 @@
 from django.urls import path, include
-from rest_framework import permissions
-from drf_yasg.views import get_schema_view
-from drf_yasg import openapi
+from django.utils.module_loading import import_string
 
-from users import views
+from referral_system import schema
+from users import async_views, views
 from users.views import HomePageView, VerifyPhoneNumberView, UserProfileView
 from users.views import UserProfileView, ActivateInviteCodeView
 
-schema_view = get_schema_view(
-    openapi.Info(
-        title="Referral System API",
-        default_version='v1',
-        description="API простой реферальной системы",
-        contact=openapi.Contact(email="imletoroma@gmail.com"),
-        license=openapi.License(name="BSD License"),
-    ),
-    public=True,
-    permission_classes=[permissions.AllowAny],  # Уровень доступа
-)
+
+def lazy_view(dotted_path):
+    """Представление, модуль которого импортируется при первом запросе"""
+    view = None
+
+    def wrapper(request, *args, **kwargs):
+        nonlocal view
+        if view is None:
+            view = import_string(dotted_path)
+        return view(request, *args, **kwargs)
+    return wrapper
+
 
 urlpatterns = [
     # REST API
     path('phone/', views.PhoneNumberView.as_view(), name='phone_number'),
     path('verify/', views.VerificationCodeView.as_view(), name='verify_code'),
-    path('profile/<str:username>/', views.UserProfileView.as_view(), name='user-profile'),
+    path('token/refresh/', views.TokenRefreshView.as_view(), name='token-refresh'),
+    path('token/revoke/', views.TokenRevokeView.as_view(), name='token-revoke'),
+    path('profile/<str:username>/', views.UserProfileAPIView.as_view(),
+         name='user-profile'),
+    path('profile/<str:username>/invited-users/', views.InvitedUsersView.as_view(),
+         name='invited-users'),
     path('profile/<str:username>/activate-invite-code/', views.ActivateInviteCodeView.as_view(),
          name='activate-invite-code'),
+    path('profile/<str:username>/downline/', views.DownlineView.as_view(), name='downline'),
+
+    path('profiles/lookup/', views.ProfileLookupView.as_view(), name='profile-lookup'),
+    path('leaderboard/', views.LeaderboardView.as_view(), name='leaderboard'),
+
+    path('profile-cache/stats/', views.ProfileCacheStatsView.as_view(),
+         name='profile-cache-stats'),
+    path('metrics/', views.metrics_view, name='metrics'),
+
+    # REST API (ASGI): те же эндпоинты на асинхронном ORM
+    path('async/phone/', async_views.AsyncPhoneNumberView.as_view(),
+         name='phone_number_async'),
+    path('async/verify/', async_views.AsyncVerificationCodeView.as_view(),
+         name='verify_code_async'),
+    path('async/profile/<str:username>/', async_views.AsyncUserProfileView.as_view(),
+         name='user-profile-async'),
+    path('async/profile/<str:username>/activate-invite-code/',
+         async_views.AsyncActivateInviteCodeView.as_view(),
+         name='activate-invite-code-async'),
 
     # DOCS
     path('api-auth/', include('rest_framework.urls')),
-    # Swagger UI
-    path('swagger/', schema_view.with_ui('swagger', cache_timeout=0),
-         name='schema-swagger-ui'),
-    path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
+    # Заранее сгенерированная схема OpenAPI (manage.py generate_openapi_schema)
+    path('openapi.json', schema.openapi_schema, name='openapi-schema'),
+    # Swagger UI и ReDoc: drf_yasg загружается при первом запросе (см. referral_system/docs.py)
+    path('swagger/', lazy_view('referral_system.docs.swagger_ui'), name='schema-swagger-ui'),
+    path('redoc/', lazy_view('referral_system.docs.redoc_ui'), name='schema-redoc'),
 
     # TEMPLATES
     path('', HomePageView.as_view(), name='home'),  # Главная страница
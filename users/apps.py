@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class UsersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'users'
+
+    def ready(self):
+        from . import checks  # noqa: F401 (регистрирует проверки)
+        from .metrics import install_query_counter
+
+        connection_created.connect(install_query_counter,
+                                   dispatch_uid='users.metrics.install_query_counter')
@@ -0,0 +1,211 @@
+"""
+Асинхронные (ASGI) версии API-эндпоинтов.
+
+Повторяют поведение представлений из ``users/views.py``, но работают через
+асинхронный ORM Django (``afirst``, ``aget``, ``async for``) и не занимают поток
+на время ожидания базы данных. Запускаются под ASGI-сервером
+(``referral_system.asgi:application``).
+"""
+import json
+import math
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.exceptions import NotAuthenticated, Throttled
+
+from . import phones, tokens, verification
+from .authentication import KEYWORD, TokenUser, token_from_header
+from .cache import profile_cache
+from .models import User
+from .serializers import PhoneNumberVerificationSerializer, VerificationCodeSerializer, \
+    InviteCodeSerializer, load_profile
+from .throttling import LOGIN_THROTTLES
+
+
+class AsyncAPIView(View):
+    """Базовое асинхронное представление: разбор JSON-тела и JSON-ответы"""
+    throttle_classes = []
+    throttle_scope = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Как и APIView в DRF, эндпоинты API не используют CSRF-защиту
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    @staticmethod
+    def get_data(request):
+        """Возвращает данные запроса из JSON-тела или формы"""
+        if request.content_type == 'application/json':
+            try:
+                return json.loads(request.body or b'{}')
+            except ValueError:
+                return {}
+        return request.POST
+
+    @staticmethod
+    def respond(data, status_code=status.HTTP_200_OK):
+        return JsonResponse(data, status=status_code, safe=False,
+                            json_dumps_params={'ensure_ascii': False})
+
+    def unauthorized(self, detail=NotAuthenticated.default_detail):
+        """Ответ 401 с заголовком WWW-Authenticate, как у SignedTokenAuthentication"""
+        response = self.respond({'detail': str(detail)}, status.HTTP_401_UNAUTHORIZED)
+        response['WWW-Authenticate'] = f'{KEYWORD} realm="api"'
+        return response
+
+    def throttle_waits(self, request):
+        """Паузы ограничений, не пропустивших запрос (пустой список — запрос пропущен)"""
+        return [throttle.wait() for throttle in (cls() for cls in self.throttle_classes)
+                if not throttle.allow_request(request, self)]
+
+    async def check_throttles(self, request):
+        """
+        Как APIView.check_throttles в DRF, но возвращает ответ 429 вместо исключения.
+        Ограничения синхронно читают и пишут кэш (Redis), поэтому проверка идёт в пуле
+        потоков, не блокируя цикл событий; ORM ей не нужен, отсюда thread_sensitive=False.
+        """
+        waits = await sync_to_async(self.throttle_waits, thread_sensitive=False)(request)
+        if not waits:
+            return None
+        wait = max((wait for wait in waits if wait is not None), default=None)
+        response = self.respond({'detail': Throttled(wait).detail},
+                                status.HTTP_429_TOO_MANY_REQUESTS)
+        if wait is not None:
+            response['Retry-After'] = str(math.ceil(wait))
+        return response
+
+
+class AsyncPhoneNumberView(AsyncAPIView):
+    """Асинхронная версия PhoneNumberView"""
+    throttle_classes = LOGIN_THROTTLES
+    throttle_scope = 'sms'
+
+    async def post(self, request, *args, **kwargs):
+        if throttled := await self.check_throttles(request):
+            return throttled
+        serializer = PhoneNumberVerificationSerializer(data=self.get_data(request))
+        if not serializer.is_valid():
+            return self.respond(serializer.errors, status.HTTP_400_BAD_REQUEST)
+
+        phone_number = serializer.validated_data['phone_number']
+        user = await User.objects.by_phone(phone_number).afirst()
+        if user:
+            if user.is_active:
+                return self.respond({
+                    "message": "Пользователь верифицирован",
+                    "profile_url": f"/profile/{user.id}/"
+                })
+            verification_code = await user.agenerate_and_send_verification_code()
+            return self.respond({
+                "message": "Новый код верификации отправлен на номер телефона",
+                "verification_code": verification_code
+            })
+
+        user = await User.objects.acreate(username=phone_number,
+                                          phone_number=phone_number, is_active=False)
+        verification_code = await user.agenerate_and_send_verification_code()
+        return self.respond({
+            "message": "Пользователь создан, код верификации отправлен на номер телефона",
+            "verification_code": verification_code
+        }, status.HTTP_201_CREATED)
+
+
+class AsyncVerificationCodeView(AsyncAPIView):
+    """Асинхронная версия VerificationCodeView"""
+    throttle_classes = LOGIN_THROTTLES
+    throttle_scope = 'verify'
+
+    async def post(self, request, *args, **kwargs):
+        if throttled := await self.check_throttles(request):
+            return throttled
+        serializer = VerificationCodeSerializer(data=self.get_data(request))
+        if not serializer.is_valid():
+            return self.respond(serializer.errors, status.HTTP_400_BAD_REQUEST)
+
+        phone_number = serializer.validated_data['phone_number']
+        verification_code = serializer.validated_data['verification_code']
+
+        user = await User.objects.by_phone(phone_number).afirst()
+        if not user:
+            return self.respond({
+                "message": "Пользователь с таким номером телефона не найден"
+            }, status.HTTP_404_NOT_FOUND)
+        result = await user.acheck_verification_code(verification_code)
+        if result != verification.VALID:
+            return self.respond({
+                "message": verification.ERROR_MESSAGES[result]
+            }, status.HTTP_400_BAD_REQUEST)
+
+        await user.averify()
+        return self.respond({
+            "message": f"Верификация прошла успешно! Ваш invite-код: {user.invite_code}",
+            **tokens.issue_pair(user),
+        })
+
+
+class AsyncUserProfileView(AsyncAPIView):
+    """
+    Асинхронная версия UserProfileAPIView. Профиль читается через тот же кэш
+    профилей и тот же загрузчик, поэтому ответы обеих версий совпадают.
+    """
+
+    async def get(self, request, *args, **kwargs):
+        phone_number = phones.canonical_or_none(kwargs.get('username'))
+        data = phone_number and await sync_to_async(profile_cache.get_or_load)(
+            phone_number, load_profile)
+        if data is None:
+            return self.respond({"message": "Пользователь не найден"},
+                                status.HTTP_404_NOT_FOUND)
+        return self.respond(data)
+
+
+class AsyncActivateInviteCodeView(AsyncAPIView):
+    """Асинхронная версия ActivateInviteCodeView"""
+
+    async def post(self, request, *args, **kwargs):
+        serializer = InviteCodeSerializer(data=self.get_data(request))
+        if not serializer.is_valid():
+            return self.respond(serializer.errors, status.HTTP_400_BAD_REQUEST)
+
+        activated_invite_code = serializer.validated_data['activated_invite_code']
+        try:
+            # Проверка отзыва читает кэш синхронно: не блокируем цикл событий
+            token = await sync_to_async(token_from_header, thread_sensitive=False)(
+                request.headers.get('Authorization', ''))
+        except tokens.InvalidToken as error:
+            return self.unauthorized(error)
+        if token is not None:
+            # Пользователь из токена доступа, без запроса к базе
+            if serializer.validated_data['phone_number'] != token.phone_number:
+                return self.respond({'detail': "Номер телефона не совпадает с номером из токена."},
+                                    status.HTTP_403_FORBIDDEN)
+            user = TokenUser(token).get_user()
+        elif settings.INVITE_ACTIVATION_REQUIRES_TOKEN:
+            return self.unauthorized()
+        else:
+            try:
+                user = await User.objects.by_phone(
+                    serializer.validated_data['phone_number']).aget()
+            except User.DoesNotExist:
+                return self.respond({"message": "Пользователь не найден"},
+                                    status.HTTP_404_NOT_FOUND)
+
+        inviter = await User.objects.filter(invite_code=activated_invite_code).afirst()
+        if inviter is None:
+            return self.respond({"message": "Нет пользователя с таким инвайт-кодом."},
+                                status.HTTP_400_BAD_REQUEST)
+
+        if inviter.pk == user.pk:
+            return self.respond({"message": "Нельзя активировать свой инвайт-код"},
+                                status.HTTP_400_BAD_REQUEST)
+
+        if not await user.aactivate_invite_code(activated_invite_code, inviter=inviter):
+            return self.respond({"message": "Инвайт-код ранее активирован"},
+                                status.HTTP_400_BAD_REQUEST)
+        return self.respond({
+            "message": f"Инвайт-код {activated_invite_code} успешно активирован!"
+        })
@@ -0,0 +1,72 @@
+"""
+Аутентификация API по токену доступа (``Authorization: Bearer <токен>``).
+
+Пользователь восстанавливается из самого токена (см. users/tokens.py), без
+запроса к базе данных и к таблице сессий: представления получают
+``TokenUser`` с идентификатором и номером телефона.
+"""
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+
+from . import tokens
+
+KEYWORD = 'Bearer'
+
+
+def token_from_header(header):
+    """
+    Токен доступа из значения заголовка Authorization (строка или байты).
+    None, если заголовок не относится к токенам; InvalidToken, если токен не принят.
+    """
+    if isinstance(header, str):
+        header = header.encode('latin-1', 'replace')
+    parts = header.split()
+    if not parts or parts[0].lower() != KEYWORD.lower().encode():
+        return None
+    if len(parts) != 2:
+        raise tokens.InvalidToken("Неверный заголовок авторизации.")
+    try:
+        return tokens.check(parts[1].decode(), tokens.ACCESS)
+    except UnicodeError:
+        raise tokens.InvalidToken("Неверный токен.")
+
+
+class TokenUser:
+    """Пользователь из токена доступа: данные токена, без загрузки модели"""
+    is_authenticated = True
+    is_anonymous = False
+    is_active = True
+    is_staff = False
+    is_superuser = False
+
+    def __init__(self, token):
+        self.token = token
+        self.pk = self.id = token.user_id
+        self.username = self.phone_number = token.phone_number
+
+    def __str__(self):
+        return self.username
+
+    def get_user(self):
+        """Экземпляр User для изменения строки (update_columns и т. п.) без запроса к базе"""
+        from .models import User
+
+        user = User(pk=self.pk, username=self.username, phone_number=self.phone_number)
+        user._state.adding = False
+        return user
+
+
+class SignedTokenAuthentication(BaseAuthentication):
+
+    def authenticate(self, request):
+        try:
+            token = token_from_header(get_authorization_header(request))
+        except tokens.InvalidToken as error:
+            raise AuthenticationFailed(str(error))
+        if token is None:
+            return None
+        return TokenUser(token), token
+
+    def authenticate_header(self, request):
+        # Без заголовка WWW-Authenticate DRF отвечает 403 вместо 401
+        return f'{KEYWORD} realm="api"'
@@ -0,0 +1,133 @@
+"""
+Кэширование данных профилей и ключи кэша.
+
+Профили кэшируются по схеме read-through в отдельном алиасе кэша
+(``PROFILE_CACHE_ALIAS``): по умолчанию это LocMemCache, при заданном
+``REDIS_URL`` — Redis (см. ``CACHES`` в settings.py). Ключом профиля служит
+каноническая запись номера телефона (см. users/phones.py), поэтому разные
+записи одного номера в адресе читают и сбрасывают одну запись кэша.
+
+Ключ записи содержит версию профиля: метку времени последнего изменения
+пользователя. Инвалидация не удаляет запись, а выставляет новую версию, поэтому
+чтение, начавшееся до изменения, не может положить в кэш устаревшие данные под
+актуальным ключом.
+
+Версии хранятся отдельно от записей, в кэше ``PROFILE_VERSION_CACHE_ALIAS``
+(``default``): инвалидация должна дойти до всех воркеров, поэтому с несколькими
+процессами этот кэш должен быть общим (Redis при заданном ``REDIS_URL``). Иначе
+остальные процессы отдают устаревший профиль, его ETag и Last-Modified до истечения
+``PROFILE_CACHE_TIMEOUT``; ``manage.py check --deploy`` об этом предупреждает.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import cache, caches
+
+
+class ProfileCache:
+    """Read-through кэш профилей с версионированными ключами и счётчиками"""
+
+    def __init__(self, alias=None):
+        self.alias = alias
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    @property
+    def cache(self):
+        return caches[self.alias or settings.PROFILE_CACHE_ALIAS]
+
+    @property
+    def versions(self):
+        return caches[settings.PROFILE_VERSION_CACHE_ALIAS]
+
+    @staticmethod
+    def version_key(username):
+        return f'profile:version:{username}'
+
+    @staticmethod
+    def entry_key(username, version):
+        return f'profile:{username}:{version}'
+
+    def _count(self, counter):
+        with self._lock:
+            self._stats[counter] += 1
+
+    def get_version(self, username):
+        """Текущая версия профиля (метка времени изменения в микросекундах)"""
+        version = self.versions.get(self.version_key(username))
+        if version is None:
+            version = time.time_ns() // 1000
+            # add() не перезапишет версию, выставленную конкурентным запросом
+            if not self.versions.add(self.version_key(username), version, None):
+                version = self.versions.get(self.version_key(username), version)
+        return version
+
+    @staticmethod
+    def last_modified(version):
+        """Момент изменения профиля по его версии"""
+        return datetime.fromtimestamp(version / 1_000_000, tz=timezone.utc)
+
+    def get_or_load(self, username, loader):
+        """
+        Возвращает профиль из кэша, при промахе загружает его через ``loader(username)``.
+        Если ``loader`` вернул None (пользователь не найден), результат не кэшируется.
+        """
+        key = self.entry_key(username, self.get_version(username))
+        data = self.cache.get(key)
+        if data is not None:
+            self._count('hits')
+            return data
+
+        self._count('misses')
+        data = loader(username)
+        if data is not None:
+            self.cache.set(key, data, settings.PROFILE_CACHE_TIMEOUT)
+        return data
+
+    def invalidate(self, username):
+        """Выставляет новую версию профиля, прежняя запись больше не читается"""
+        self.versions.set(self.version_key(username), time.time_ns() // 1000, None)
+        self._count('invalidations')
+
+    def stats(self):
+        """Счётчики текущего процесса: попадания, промахи и инвалидации"""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def reset_stats(self):
+        with self._lock:
+            for counter in self._stats:
+                self._stats[counter] = 0
+
+
+profile_cache = ProfileCache()
+
+
+# region Список приглашённых пользователей
+# Первая страница кэшируется под версией профиля, как и сам профиль: запрос,
+# прочитавший список до новой активации, запишет его под прежней версией, и
+# устаревшая страница больше не будет прочитана. Ссылки на соседние страницы
+# зависят от адреса запроса и в кэш не попадают.
+def invited_users_key(username, version):
+    """Ключ кэша первой страницы приглашённых пользователей"""
+    return f'invited-users:first-page:{username}:{version}'
+
+
+def get_invited_users_page(username, version):
+    return cache.get(invited_users_key(username, version))
+
+
+def set_invited_users_page(username, version, data):
+    cache.set(invited_users_key(username, version), data, settings.INVITED_USERS_CACHE_TIMEOUT)
+
+
+def invalidate_invited_users(username):
+    """Сбрасывает первую страницу после изменения списка: выставляет новую версию профиля"""
+    profile_cache.invalidate(username)
+
+# endregion
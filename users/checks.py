@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+# Кэши, через которые воркеры обмениваются состоянием: версии профилей, отозванные
+# токены и закрепления за основной базой
+SHARED_CACHE_SETTINGS = ['PROFILE_VERSION_CACHE_ALIAS', 'TOKEN_CACHE_ALIAS',
+                         'REPLICA_PIN_CACHE_ALIAS']
+
+LOCAL_CACHE_BACKENDS = ['django.core.cache.backends.locmem.LocMemCache',
+                        'django.core.cache.backends.dummy.DummyCache']
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_caches(app_configs, **kwargs):
+    """Предупреждает, если общее состояние воркеров хранится в памяти одного процесса"""
+    aliases = {}
+    for name in SHARED_CACHE_SETTINGS:
+        aliases.setdefault(getattr(settings, name), []).append(name)
+    warnings = []
+    for alias, names in aliases.items():
+        backend = settings.CACHES[alias]['BACKEND']
+        if backend in LOCAL_CACHE_BACKENDS:
+            warnings.append(Warning(
+                f"Кэш '{alias}' ({', '.join(names)}) использует {backend.rsplit('.', 1)[-1]}: "
+                f"изменения не видны другим процессам.",
+                hint='С несколькими воркерами задайте REDIS_URL.',
+                obj=alias,
+                id='users.W001',
+            ))
+    return warnings
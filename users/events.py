@@ -0,0 +1,265 @@
+"""
+Исходящие события для внешних систем (биллинга): transactional outbox.
+
+Событие (``OutboxEvent``) записывается в той же транзакции, что и изменение, о котором
+оно сообщает: верификация пользователя (``User.verify``) и активация инвайт-кода
+(``User.activate_invite_code``). Если транзакция откатилась, события нет; если
+зафиксирована — событие будет доставлено, даже если процесс сразу завершится.
+Обработчик запроса сетевых вызовов не делает.
+
+Доставку выполняют воркеры ``manage.py events_worker``: забирают пачку готовых событий,
+отправляют их пулом из ``EVENTS_CONCURRENCY`` потоков через бэкенд ``EVENTS_BACKEND``
+(по умолчанию POST на ``EVENTS_WEBHOOK_URL``) и отмечают результат. Неудачная попытка
+повторяется с экспоненциальной паузой, после ``EVENTS_MAX_ATTEMPTS`` попыток событие
+помечается как неотправленное.
+
+Доставка «хотя бы один раз»: воркер забирает события на ``EVENTS_LEASE_TIMEOUT`` секунд,
+и если он упал между отправкой и отметкой, событие отправится повторно. Порядок
+доставки не гарантируется. Получатель отбрасывает повторы по заголовку
+``Idempotency-Key`` (идентификатор события).
+"""
+import hashlib
+import hmac
+import json
+import logging
+import random
+import threading
+import urllib.request
+from collections import namedtuple
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+# Результат обработки одной пачки
+DispatchResult = namedtuple('DispatchResult', ['claimed', 'delivered', 'failed'])
+
+# События, "доставленные" через LocmemEventBackend (используется в тестах)
+delivered = []
+_delivered_lock = threading.Lock()
+
+
+def body(event):
+    """Тело запроса с событием"""
+    return {'id': event.pk, 'type': event.event_type, 'occurred_at': event.created_at,
+            'data': event.payload}
+
+
+# region Бэкенды
+class BaseEventBackend:
+    """Базовый класс бэкенда доставки событий"""
+
+    def send(self, event):
+        """
+        Доставляет одно событие ``OutboxEvent``, при ошибке бросает исключение.
+        Вызывается параллельно из нескольких потоков.
+        """
+        raise NotImplementedError('Бэкенд должен реализовать send()')
+
+
+class WebhookEventBackend(BaseEventBackend):
+    """
+    POST события в формате JSON на ``EVENTS_WEBHOOK_URL``. При заданном
+    ``EVENTS_WEBHOOK_SECRET`` тело подписывается HMAC-SHA256 (заголовок ``X-Signature``).
+    Доставленным считается событие, на которое получен ответ 2xx.
+    """
+
+    def __init__(self, url=None, secret=None, timeout=None):
+        self.url = url or settings.EVENTS_WEBHOOK_URL
+        if not self.url:
+            raise ImproperlyConfigured('Для доставки событий задайте EVENTS_WEBHOOK_URL')
+        self.secret = secret or settings.EVENTS_WEBHOOK_SECRET
+        self.timeout = timeout or settings.EVENTS_WEBHOOK_TIMEOUT
+
+    def send(self, event):
+        data = json.dumps(body(event), cls=DjangoJSONEncoder).encode()
+        headers = {'Content-Type': 'application/json', 'Idempotency-Key': str(event.pk),
+                   'X-Event-Type': event.event_type}
+        if self.secret:
+            signature = hmac.new(self.secret.encode(), data, hashlib.sha256).hexdigest()
+            headers['X-Signature'] = f'sha256={signature}'
+        request = urllib.request.Request(self.url, data=data, headers=headers, method='POST')
+        # Ответы 4xx и 5xx urllib превращает в HTTPError
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+class LocmemEventBackend(BaseEventBackend):
+    """Сохраняет события в памяти процесса (``users.events.delivered``)"""
+
+    def send(self, event):
+        with _delivered_lock:
+            delivered.append(json.loads(json.dumps(body(event), cls=DjangoJSONEncoder)))
+
+
+def get_backend(backend=None, **kwargs):
+    """Создаёт экземпляр бэкенда по пути к классу (по умолчанию ``EVENTS_BACKEND``)"""
+    return import_string(backend or settings.EVENTS_BACKEND)(**kwargs)
+
+# endregion Бэкенды
+
+
+# region Очередь
+def record(event_type, **payload):
+    """
+    Записывает событие в очередь. Вызывается внутри транзакции изменения, о котором
+    сообщает событие: событие и изменение фиксируются или откатываются вместе.
+    """
+    return OutboxEvent.objects.create(event_type=event_type, payload=payload)
+
+
+def retry_delay(attempts):
+    """Пауза перед следующей попыткой: удваивается с каждой попыткой, со случайным разбросом"""
+    delay = min(settings.EVENTS_RETRY_MAX_DELAY,
+                settings.EVENTS_RETRY_DELAY * 2 ** (attempts - 1))
+    # Разброс не даёт событиям, упавшим вместе, повторяться одновременно
+    return random.uniform(delay / 2, delay)
+
+
+def claim_batch(batch_size):
+    """
+    Забирает пачку событий, время попытки которых наступило, и откладывает их
+    следующую попытку на ``EVENTS_LEASE_TIMEOUT``: пока воркер их отправляет, другие
+    воркеры их не возьмут, а если воркер упадёт, события вернутся в очередь.
+
+    Строки блокируются через ``SELECT ... FOR UPDATE SKIP LOCKED`` только на время
+    этой короткой транзакции (на SQLite запускайте один воркер).
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(OutboxEvent.objects
+                     .select_for_update(skip_locked=True)
+                     .filter(status=OutboxEvent.STATUS_PENDING, available_at__lte=now)
+                     .order_by('available_at', 'id')[:batch_size])
+        if batch:
+            OutboxEvent.objects.filter(pk__in=[event.pk for event in batch]).update(
+                available_at=now + timedelta(seconds=settings.EVENTS_LEASE_TIMEOUT))
+    return batch
+
+
+def attempt(backend, event):
+    """Одна попытка доставки; возвращает текст ошибки или None"""
+    try:
+        backend.send(event)
+    except Exception as error:
+        return f'{type(error).__name__}: {error}'
+    return None
+
+
+def dispatch_batch(batch_size=None, backend=None, executor=None):
+    """
+    Забирает и доставляет одну пачку событий. ``executor`` — пул потоков, через
+    который события пачки отправляются параллельно (без него — по очереди).
+    Результаты всей пачки записываются после отправки, по bulk_update на доставленные
+    и неудачные.
+    """
+    backend = backend or get_backend()
+    batch = claim_batch(batch_size or settings.EVENTS_BATCH_SIZE)
+    if not batch:
+        return DispatchResult(0, 0, 0)
+
+    send = partial(attempt, backend)
+    errors = list(executor.map(send, batch) if executor is not None else map(send, batch))
+
+    now = timezone.now()
+    sent, failed = [], []
+    for event, error in zip(batch, errors):
+        event.attempts += 1
+        if error is None:
+            sent.append(event)
+            continue
+        event.last_error = error
+        if event.attempts >= settings.EVENTS_MAX_ATTEMPTS:
+            event.status = OutboxEvent.STATUS_FAILED
+            logger.error('Событие %s не доставлено после %s попыток: %s',
+                         event.pk, event.attempts, error)
+        else:
+            event.available_at = now + timedelta(seconds=retry_delay(event.attempts))
+            logger.warning('Событие %s не доставлено (попытка %s): %s',
+                           event.pk, event.attempts, error)
+        failed.append(event)
+
+    if sent:
+        for event in sent:
+            event.status, event.sent_at = OutboxEvent.STATUS_SENT, now
+        OutboxEvent.objects.bulk_update(sent, ['status', 'attempts', 'sent_at'])
+    if failed:
+        OutboxEvent.objects.bulk_update(failed, ['status', 'attempts', 'available_at',
+                                                 'last_error'])
+    count_dispatch(sent, len(failed), now)
+    return DispatchResult(len(batch), len(sent), len(failed))
+
+# endregion Очередь
+
+
+# region Метрики
+# Счётчики воркеров хранятся в кэше, общем для процессов (Redis при заданном REDIS_URL),
+# и отдаются эндпоинтом metrics/ вместе с размером очереди из базы
+DELIVERED_KEY = 'events:metrics:delivered'
+FAILURES_KEY = 'events:metrics:failures'
+LAG_KEY = 'events:metrics:lag_ms'
+
+
+def get_metrics_cache():
+    return caches[settings.EVENTS_METRICS_CACHE_ALIAS]
+
+
+def increment(cache, key, value):
+    if not value:
+        return
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key, value)
+    except ValueError:
+        # Ключ вытеснен из кэша между add и incr
+        cache.set(key, value, timeout=None)
+
+
+def count_dispatch(sent, failures, now):
+    """Учитывает доставленные события, неудачные попытки и время от записи до доставки"""
+    cache = get_metrics_cache()
+    increment(cache, DELIVERED_KEY, len(sent))
+    increment(cache, FAILURES_KEY, failures)
+    increment(cache, LAG_KEY, round(sum((now - event.created_at).total_seconds()
+                                        for event in sent) * 1000))
+
+
+def render_metrics():
+    """Метрики очереди событий в текстовом формате Prometheus"""
+    queue = {row['status']: row for row in
+             OutboxEvent.objects.filter(status__in=[OutboxEvent.STATUS_PENDING,
+                                                    OutboxEvent.STATUS_FAILED])
+             .values('status').annotate(count=Count('pk'), oldest=Min('created_at'))}
+    pending = queue.get(OutboxEvent.STATUS_PENDING)
+    lag = (timezone.now() - pending['oldest']).total_seconds() if pending else 0.0
+    counters = get_metrics_cache().get_many([DELIVERED_KEY, FAILURES_KEY, LAG_KEY])
+
+    lines = ['# HELP outbox_events Недоставленные события в очереди',
+             '# TYPE outbox_events gauge']
+    for status in (OutboxEvent.STATUS_PENDING, OutboxEvent.STATUS_FAILED):
+        lines.append(f'outbox_events{{status="{status}"}} '
+                     f'{queue[status]["count"] if status in queue else 0}')
+    lines += ['# HELP outbox_lag_seconds Возраст самого старого недоставленного события',
+              '# TYPE outbox_lag_seconds gauge',
+              f'outbox_lag_seconds {lag}',
+              '# HELP outbox_delivery_lag_seconds Время от записи события до доставки',
+              '# TYPE outbox_delivery_lag_seconds summary',
+              f'outbox_delivery_lag_seconds_sum {counters.get(LAG_KEY, 0) / 1000}',
+              f'outbox_delivery_lag_seconds_count {counters.get(DELIVERED_KEY, 0)}',
+              '# HELP outbox_delivery_failures_total Неудачные попытки доставки',
+              '# TYPE outbox_delivery_failures_total counter',
+              f'outbox_delivery_failures_total {counters.get(FAILURES_KEY, 0)}']
+    return '\n'.join(lines) + '\n'
+
+# endregion Метрики
@@ -1,10 +1,19 @@
 from django import forms
 
+from . import phones
+
 
 class PhoneNumberForm(forms.Form):
-    phone_number = forms.CharField(max_length=15, widget=forms.TextInput(
+    phone_number = forms.CharField(max_length=32, widget=forms.TextInput(
         attrs={'placeholder': 'Введите номер телефона'}))
 
+    def clean_phone_number(self):
+        """Каноническая запись номера, как в PhoneNumberVerificationSerializer"""
+        try:
+            return phones.normalize(self.cleaned_data['phone_number'])
+        except phones.InvalidPhoneNumber as error:
+            raise forms.ValidationError(str(error))
+
 
 class VerificationCodeForm(forms.Form):
     verification_code = forms.CharField(max_length=4, widget=forms.TextInput(
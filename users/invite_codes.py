@@ -0,0 +1,43 @@
+"""
+Выдача инвайт-кодов без коллизий.
+
+Код выводится из первичного ключа пользователя: значение переставляется
+биективным аффинным отображением по модулю 62**6 и записывается шестью
+символами base62. Разные значения дают разные коды, поэтому выдача не требует
+ни проверок уникальности, ни повторных попыток, ни общего счётчика между
+воркерами — последовательность первичных ключей уже выдаётся базой данных.
+
+У каждого пользователя есть несколько кодов-кандидатов из непересекающихся
+диапазонов. Следующий кандидат нужен, только если код уже занят случайным
+кодом, выданным до появления этого модуля.
+"""
+import string
+
+ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase
+CODE_LENGTH = 6
+CODE_SPACE = len(ALPHABET) ** CODE_LENGTH
+
+# Множитель взаимно прост с 62**6 = 2**6 * 31**6, поэтому отображение биективно
+_MULTIPLIER = 48271144813
+_INCREMENT = 20240917133
+
+# Диапазон первичных ключей, для которых кандидаты разных пользователей не пересекаются
+KEY_RANGE = 2 ** 34
+CANDIDATES = CODE_SPACE // KEY_RANGE
+
+
+def encode(value):
+    """Переводит число из [0, CODE_SPACE) в шестисимвольный инвайт-код"""
+    value = (value * _MULTIPLIER + _INCREMENT) % CODE_SPACE
+    chars = []
+    for _ in range(CODE_LENGTH):
+        value, index = divmod(value, len(ALPHABET))
+        chars.append(ALPHABET[index])
+    return ''.join(reversed(chars))
+
+
+def candidates(key):
+    """Инвайт-коды пользователя с первичным ключом ``key`` в порядке предпочтения"""
+    if not 0 < key < KEY_RANGE:
+        raise ValueError(f'Первичный ключ {key} вне диапазона выдачи инвайт-кодов')
+    return [encode(key + attempt * KEY_RANGE) for attempt in range(CANDIDATES)]
@@ -0,0 +1,161 @@
+"""
+Рейтинг пригласивших пользователей.
+
+Счётчики ведутся инкрементально при активации инвайт-кода:
+
+* за всё время — поле ``User.invited_count``;
+* за текущие календарный день, неделю и месяц (по ``TIME_ZONE``) — строки
+  ``LeaderboardCounter``, которые обновляются одним UPSERT с увеличением счётчика.
+
+Первые N мест читаются по индексу, упорядоченному по убыванию счётчика, то
+есть стоимость чтения зависит только от N, а не от числа пользователей.
+Расхождения счётчиков с таблицей рефералов (ручные правки, удаления, сбои)
+исправляет периодическая команда ``manage.py reconcile_leaderboard``.
+"""
+from datetime import datetime, time, timedelta
+
+from django.db import connection, transaction
+from django.db.models import Count, Max, Min, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import phones
+from .cache import invalidate_invited_users
+from .models import LeaderboardCounter, Referral, User
+
+ALL_TIME = 'all'
+PERIODS = [ALL_TIME] + [period for period, _ in LeaderboardCounter.PERIODS]
+
+COUNTERS = LeaderboardCounter._meta.db_table
+REFERRALS = Referral._meta.db_table
+
+# Три периода одним запросом: новая строка со счётчиком 1 или увеличение существующей
+INCREMENT_SQL = f'''
+    INSERT INTO {COUNTERS} (period, period_start, user_id, count)
+    VALUES (%s, %s, %s, 1), (%s, %s, %s, 1), (%s, %s, %s, 1)
+    ON CONFLICT (period, period_start, user_id) DO UPDATE SET count = {COUNTERS}.count + 1
+'''
+
+# Счётчики периода из агрегата по рефералам тем же запросом, что и подсчёт
+RECOUNT_SQL = f'''
+    INSERT INTO {COUNTERS} (period, period_start, user_id, count)
+    SELECT %s, %s, inviter_id, COUNT(*) FROM {REFERRALS}
+    WHERE activated_at >= %s AND activated_at < %s
+    GROUP BY inviter_id
+    ON CONFLICT (period, period_start, user_id) DO UPDATE SET count = excluded.count
+    WHERE {COUNTERS}.count <> excluded.count
+'''
+
+# Пользователей в одном UPDATE при пересчёте общего счётчика
+RECONCILE_BATCH_SIZE = 1000
+
+
+def period_start(period, day):
+    """Первый день календарного периода, в который попадает ``day``"""
+    if period == LeaderboardCounter.WEEK:
+        return day - timedelta(days=day.weekday())
+    if period == LeaderboardCounter.MONTH:
+        return day.replace(day=1)
+    return day
+
+
+def period_end(period, start):
+    """Первый день следующего периода"""
+    if period == LeaderboardCounter.WEEK:
+        return start + timedelta(days=7)
+    if period == LeaderboardCounter.MONTH:
+        return (start + timedelta(days=31)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def record_activation(inviter_id, activated_at):
+    """Учитывает активацию инвайт-кода в счётчиках текущих периодов"""
+    day = timezone.localdate(activated_at)
+    params = []
+    for period, _ in LeaderboardCounter.PERIODS:
+        params += [period, period_start(period, day), inviter_id]
+    with connection.cursor() as cursor:
+        cursor.execute(INCREMENT_SQL, params)
+
+
+def top(period=ALL_TIME, limit=10, day=None):
+    """
+    Первые ``limit`` пригласивших за период, в который попадает ``day``
+    (по умолчанию текущий). Возвращает (начало периода или None, список мест).
+    Рейтинг публичный, поэтому номера телефонов (имена пользователей) маскируются.
+    """
+    if period == ALL_TIME:
+        rows = (User.objects.filter(invited_count__gt=0)
+                .order_by('-invited_count', 'id')
+                .values_list('username', 'invited_count')[:limit])
+        start = None
+    else:
+        start = period_start(period, day or timezone.localdate())
+        rows = (LeaderboardCounter.objects.filter(period=period, period_start=start)
+                .order_by('-count', 'user')
+                .values_list('user__username', 'count')[:limit])
+    return start, [{'rank': rank, 'user': phones.mask(username), 'invited_count': count}
+                   for rank, (username, count) in enumerate(rows, start=1)]
+
+
+def aware_midnight(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def reconcile_period(period, start):
+    """
+    Пересчитывает счётчики одного периода по таблице рефералов.
+
+    Сначала блокируются существующие счётчики периода: активации, которые успели их
+    увеличить, к этому моменту зафиксированы и попадают в подсчёт, а остальные ждут
+    конца транзакции и добавят свою единицу уже к пересчитанному значению. Подсчёт
+    и запись идут одним INSERT ... SELECT ... ON CONFLICT DO UPDATE.
+    """
+    since, until = aware_midnight(start), aware_midnight(period_end(period, start))
+    referrals = Referral.objects.filter(activated_at__gte=since, activated_at__lt=until)
+    counters = LeaderboardCounter.objects.filter(period=period, period_start=start)
+    adapt = connection.ops.adapt_datetimefield_value
+    with transaction.atomic():
+        list(counters.select_for_update().values_list('pk', flat=True))
+        with connection.cursor() as cursor:
+            cursor.execute(RECOUNT_SQL, [period, start, adapt(since), adapt(until)])
+        # Пригласившие, у которых в периоде не осталось рефералов
+        counters.exclude(user__in=referrals.values('inviter')).delete()
+
+
+def reconcile(days=1, today=None):
+    """
+    Пересчитывает счётчики всех периодов, пересекающихся с последними ``days``
+    днями, и исправляет ``User.invited_count``. Возвращает количество
+    пользователей с исправленным общим счётчиком.
+
+    Каждый период и каждая пачка пользователей пересчитываются в своей короткой
+    транзакции: активации во время пересчёта не ждут его окончания и не теряются.
+    """
+    today = today or timezone.localdate()
+    first_day = today - timedelta(days=days - 1)
+    for period, _ in LeaderboardCounter.PERIODS:
+        start = period_start(period, first_day)
+        while start <= today:
+            reconcile_period(period, start)
+            start = period_end(period, start)
+
+    actual = Coalesce(Subquery(Referral.objects.filter(inviter=OuterRef('pk')).order_by()
+                               .values('inviter').annotate(count=Count('id')).values('count')),
+                      Value(0))
+    bounds = User.objects.aggregate(first=Min('pk'), last=Max('pk'))
+    fixed = 0
+    for first_pk in range(bounds['first'] or 0, (bounds['last'] or -1) + 1, RECONCILE_BATCH_SIZE):
+        batch = User.objects.filter(pk__gte=first_pk, pk__lt=first_pk + RECONCILE_BATCH_SIZE)
+        with transaction.atomic():
+            # Блокировка, как в reconcile_period: значение вычисляется и записывается
+            # в UPDATE, а активации, начавшиеся позже, увеличат уже исправленный счётчик
+            drifted = dict(batch.select_for_update().exclude(invited_count=actual)
+                           .values_list('pk', 'phone_number'))
+            if drifted:
+                User.objects.filter(pk__in=drifted).exclude(invited_count=actual) \
+                    .update(invited_count=actual)
+        for phone_number in drifted.values():
+            invalidate_invited_users(phone_number)
+        fixed += len(drifted)
+    return fixed
@@ -0,0 +1,52 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from users.events import dispatch_batch, get_backend
+
+
+class Command(BaseCommand):
+    help = ("Воркер доставки событий: разбирает очередь исходящих событий пачками, "
+            "отправляя события каждой пачки параллельно. "
+            "Для масштабирования запустите несколько процессов.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.EVENTS_BATCH_SIZE,
+                            help='Количество событий в одной пачке')
+        parser.add_argument('--concurrency', type=int, default=settings.EVENTS_CONCURRENCY,
+                            help='Количество одновременных отправок')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Пауза в секундах, когда готовых событий нет')
+        parser.add_argument('--once', action='store_true',
+                            help='Разобрать готовые события и завершиться')
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        batch_size = options['batch_size']
+        delivered = failed = 0
+        started = time.monotonic()
+
+        try:
+            with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+                while True:
+                    result = dispatch_batch(batch_size=batch_size, backend=backend,
+                                            executor=executor)
+                    delivered += result.delivered
+                    failed += result.failed
+                    if result.claimed and options['verbosity'] >= 2:
+                        self.stdout.write(f"Пачка: доставлено {result.delivered}, "
+                                          f"ошибок {result.failed}")
+                    if result.claimed < batch_size:
+                        # Готовые события разобраны: выходим или ждём новые
+                        if options['once']:
+                            break
+                        time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Доставлено событий: {delivered}, неудачных попыток: {failed}, "
+            f"{delivered / elapsed if elapsed else 0:.1f} событий/с"))
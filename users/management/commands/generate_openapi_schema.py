@@ -0,0 +1,27 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from referral_system import docs, schema
+
+
+class Command(BaseCommand):
+    help = ("Генерирует схему OpenAPI и её сжатую копию для раздачи по адресу openapi.json "
+            "(Swagger UI и ReDoc). Запускается при сборке, после изменения API.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=settings.OPENAPI_SCHEMA_PATH,
+                            help='Файл схемы (по умолчанию OPENAPI_SCHEMA_PATH); '
+                                 'сжатая копия пишется рядом с расширением .gz')
+        parser.add_argument('--url',
+                            help='Схема и хост API, например https://api.example.com; '
+                                 'по умолчанию используется адрес страницы документации')
+
+    def handle(self, *args, **options):
+        content = docs.generate_schema(options['url'])
+        path = str(options['output'])
+        compressed = schema.write(path, content)
+        self.stdout.write(self.style.SUCCESS(
+            f"{path}: {len(json.loads(content)['paths'])} путей, {len(content)} байт, "
+            f"сжатая копия {len(compressed)} байт"))
@@ -0,0 +1,169 @@
+import csv
+import json
+import os
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from rest_framework import serializers
+
+from users import invite_codes
+from users.models import User
+from users.serializers import validate_phone_number
+
+
+class Command(BaseCommand):
+    help = ("Массовая предварительная регистрация пользователей по номерам телефонов "
+            "из CSV или JSON Lines. Файл читается потоково, пользователи создаются "
+            "пачками через bulk_create, прогресс сохраняется в файл контрольной точки.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Путь к файлу с номерами телефонов')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='Формат файла (по умолчанию определяется по расширению)')
+        parser.add_argument('--chunk-size', type=int, default=5000,
+                            help='Количество записей в одной пачке')
+        parser.add_argument('--assign-invite-codes', action='store_true',
+                            help='Сразу выдать созданным пользователям инвайт-коды')
+        parser.add_argument('--checkpoint',
+                            help='Файл контрольной точки (по умолчанию <path>.checkpoint)')
+        parser.add_argument('--restart', action='store_true',
+                            help='Игнорировать контрольную точку и начать сначала')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f"Файл {path} не найден")
+        file_format = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson'))
+                                            else 'csv')
+        chunk_size = options['chunk_size']
+        checkpoint = options['checkpoint'] or f'{path}.checkpoint'
+
+        position = 0 if options['restart'] else self.load_checkpoint(checkpoint, path)
+        if position:
+            self.stdout.write(f"Продолжаем с записи {position}")
+
+        totals = {'read': 0, 'created': 0, 'duplicates': 0, 'invalid': 0}
+        started = time.perf_counter()
+
+        with open(path, encoding='utf-8', newline='') as stream:
+            records = islice(self.read_records(stream, file_format), position, None)
+            while True:
+                batch = list(islice(records, chunk_size))
+                if not batch:
+                    break
+                stats = self.import_batch(batch, options['assign_invite_codes'])
+                position += len(batch)
+                self.save_checkpoint(checkpoint, path, position)
+
+                totals['read'] += len(batch)
+                for key, value in stats.items():
+                    totals[key] += value
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f"Обработано {position}: создано {totals['created']}, "
+                    f"дублей {totals['duplicates']}, ошибок {totals['invalid']} "
+                    f"({totals['read'] / elapsed:.0f} записей/с)")
+
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Импорт завершён за {elapsed:.1f} с: создано {totals['created']} "
+            f"пользователей из {totals['read']} записей"))
+
+    @staticmethod
+    def read_records(stream, file_format):
+        """Потоково читает номера телефонов: по одной записи на строку файла"""
+        if file_format == 'jsonl':
+            for line in stream:
+                line = line.strip()
+                try:
+                    yield str(json.loads(line).get('phone_number', '')) if line else ''
+                except (ValueError, AttributeError):
+                    yield ''
+            return
+
+        column = 0
+        for index, row in enumerate(csv.reader(stream)):
+            if index == 0 and 'phone_number' in row:
+                # Строка заголовка: берём колонку phone_number
+                column = row.index('phone_number')
+                continue
+            yield row[column] if len(row) > column else ''
+
+    def import_batch(self, batch, assign_invite_codes):
+        """Проверяет, дедуплицирует и вставляет одну пачку номеров"""
+        stats = {'created': 0, 'duplicates': 0, 'invalid': 0}
+
+        phone_numbers = []
+        seen = set()
+        for value in batch:
+            try:
+                phone_number = validate_phone_number(value)
+            except serializers.ValidationError:
+                stats['invalid'] += 1
+                continue
+            if phone_number in seen:
+                stats['duplicates'] += 1
+                continue
+            seen.add(phone_number)
+            phone_numbers.append(phone_number)
+
+        # Номера уже канонические: поиск по уникальному индексу phone_key
+        existing = set(User.objects.filter(phone_key__in=map(int, phone_numbers))
+                       .values_list('phone_key', flat=True))
+        new_numbers = [number for number in phone_numbers if int(number) not in existing]
+        stats['duplicates'] += len(existing)
+
+        # ignore_conflicts защищает от гонки с параллельной регистрацией через API.
+        # Пропущенные при конфликте строки не отличить по результату bulk_create,
+        # поэтому у пачки общее время регистрации, по которому считаются вставленные
+        joined = timezone.now()
+        User.objects.bulk_create(
+            [User(username=number, phone_number=number, phone_key=int(number), is_active=False,
+                  date_joined=joined)
+             for number in new_numbers],
+            batch_size=len(new_numbers) or None,
+            ignore_conflicts=True,
+        )
+        if new_numbers:
+            stats['created'] = User.objects.filter(phone_key__in=map(int, new_numbers),
+                                                   date_joined=joined).count()
+            stats['duplicates'] += len(new_numbers) - stats['created']
+
+        if assign_invite_codes and new_numbers:
+            self.assign_invite_codes(new_numbers)
+        return stats
+
+    @staticmethod
+    def assign_invite_codes(phone_numbers):
+        """Выдаёт инвайт-коды пачке пользователей двумя запросами"""
+        users = list(User.objects.filter(phone_key__in=map(int, phone_numbers),
+                                         invite_code__isnull=True).only('pk'))
+        candidates = {user.pk: invite_codes.candidates(user.pk) for user in users}
+        taken = set(User.objects
+                    .filter(invite_code__in=[code for codes in candidates.values()
+                                             for code in codes])
+                    .values_list('invite_code', flat=True))
+        for user in users:
+            user.invite_code = next(code for code in candidates[user.pk] if code not in taken)
+        User.objects.bulk_update(users, ['invite_code'], batch_size=1000)
+
+    @staticmethod
+    def load_checkpoint(checkpoint, path):
+        if not os.path.exists(checkpoint):
+            return 0
+        with open(checkpoint, encoding='utf-8') as stream:
+            data = json.load(stream)
+        if data.get('path') != os.path.abspath(path):
+            raise CommandError(f"Контрольная точка {checkpoint} относится к другому файлу")
+        return data['position']
+
+    @staticmethod
+    def save_checkpoint(checkpoint, path, position):
+        # Запись через временный файл, чтобы прерывание не оставило битую точку
+        with open(f'{checkpoint}.tmp', 'w', encoding='utf-8') as stream:
+            json.dump({'path': os.path.abspath(path), 'position': position}, stream)
+        os.replace(f'{checkpoint}.tmp', checkpoint)
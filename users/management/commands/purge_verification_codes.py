@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from users.verification import get_store
+
+
+class Command(BaseCommand):
+    help = "Удаляет истёкшие коды верификации (запускайте периодически, например из cron)."
+
+    def handle(self, *args, **options):
+        deleted = get_store().purge_expired()
+        self.stdout.write(self.style.SUCCESS(f"Удалено истёкших кодов: {deleted}"))
@@ -0,0 +1,19 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from users import referral_tree
+
+
+class Command(BaseCommand):
+    help = ("Пересчитывает таблицу замыкания дерева рефералов по таблице рефералов. "
+            "Запустите перед включением REFERRAL_CLOSURE_ENABLED.")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        with transaction.atomic():
+            rows = referral_tree.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f"Таблица замыкания пересчитана за {time.perf_counter() - started:.1f} с: "
+            f"{rows} связей"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from users import leaderboard
+
+
+class Command(BaseCommand):
+    help = ("Пересчитывает счётчики рейтинга пригласивших по таблице рефералов "
+            "(запускайте периодически, например из cron раз в час).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=1,
+                            help='Пересчитать периоды, пересекающиеся с последними N днями')
+
+    def handle(self, *args, **options):
+        fixed = leaderboard.reconcile(days=options['days'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Счётчики рейтинга пересчитаны, исправлено общих счётчиков: {fixed}"))
@@ -0,0 +1,42 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from users.sms import drain_batch, get_backend
+
+
+class Command(BaseCommand):
+    help = ("Воркер отправки SMS: разбирает очередь исходящих сообщений пачками. "
+            "Для масштабирования запустите несколько процессов.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.SMS_BATCH_SIZE,
+                            help='Количество сообщений в одной пачке')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Пауза в секундах, когда готовых сообщений нет '
+                                 'или пачку не удалось отправить')
+        parser.add_argument('--once', action='store_true',
+                            help='Разобрать готовые сообщения и завершиться')
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        batch_size = options['batch_size']
+        sent = failed = 0
+
+        try:
+            while True:
+                result = drain_batch(batch_size=batch_size, backend=backend)
+                sent += result.sent
+                failed += result.failed
+                if result.claimed < batch_size or result.failed:
+                    # Готовые сообщения разобраны или провайдер недоступен: выходим
+                    # или ждём, не забирая сразу следующую пачку
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Отправлено сообщений: {sent}, неудачных попыток: {failed}"))
@@ -0,0 +1,239 @@
+"""
+Метрики запросов: количество и время SQL-запросов, задержка и размер ответа
+по имени маршрута (``phone_number``, ``verify_code``, ``user-profile``, ...).
+
+Метрики собирает ``users.middleware.RequestMetricsMiddleware``, экспорт —
+в текстовом формате Prometheus (эндпоинт ``metrics/``) и в структурированный
+лог ``users.metrics`` (одна JSON-строка на запрос, уровень INFO).
+
+SQL-запросы считает обёртка выполнения запросов, которая ставится на каждое
+соединение при его открытии и относит запрос к текущему HTTP-запросу через
+contextvar, поэтому учитываются и запросы асинхронных представлений,
+выполняемые ORM в другом потоке.
+
+Детальные метрики собираются для доли запросов ``METRICS_SAMPLE_RATE``;
+счётчик запросов ``http_requests_total`` ведётся для всех запросов. Метрики
+хранятся в памяти процесса: при нескольких воркерах каждый отдаёт свои.
+"""
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+from bisect import bisect_left
+from functools import partial
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000)
+
+UNMATCHED_ROUTE = '<unmatched>'
+
+# Статистика текущего HTTP-запроса; None — запрос не попал в выборку
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+class RequestSample:
+    """Счётчики одного HTTP-запроса, попавшего в выборку"""
+    __slots__ = ('started', 'queries', 'sql_time')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+
+
+class Histogram:
+    """Кумулятивная гистограмма в терминах Prometheus"""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_sum{{{labels}}} {self.sum}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+HISTOGRAMS = {
+    'http_request_duration_seconds': ('Время обработки запроса', LATENCY_BUCKETS),
+    'http_request_db_queries': ('Количество SQL-запросов на запрос', QUERY_COUNT_BUCKETS),
+    'http_request_db_duration_seconds': ('Время SQL-запросов на запрос', LATENCY_BUCKETS),
+    'http_response_size_bytes': ('Размер тела ответа', SIZE_BUCKETS),
+}
+
+
+class MetricsRegistry:
+    """Метрики процесса, сгруппированные по маршруту"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._requests = {}
+            self._histograms = {}
+
+    def count_request(self, route, method, status_code):
+        key = (route, method, status_code)
+        with self._lock:
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+    def observe(self, route, values):
+        """values: {имя гистограммы: значение}; None пропускается"""
+        with self._lock:
+            histograms = self._histograms.get(route)
+            if histograms is None:
+                histograms = self._histograms[route] = {
+                    name: Histogram(buckets) for name, (_, buckets) in HISTOGRAMS.items()}
+            for name, value in values.items():
+                if value is not None:
+                    histograms[name].observe(value)
+
+    def summary(self, route, name):
+        """Количество наблюдений и их сумма по гистограмме маршрута"""
+        with self._lock:
+            histogram = self._histograms.get(route, {}).get(name)
+            return (histogram.count, histogram.sum) if histogram else (0, 0)
+
+    def render(self):
+        """Метрики в текстовом формате Prometheus 0.0.4"""
+        with self._lock:
+            lines = ['# HELP http_requests_total Количество обработанных запросов',
+                     '# TYPE http_requests_total counter']
+            for (route, method, status_code), count in sorted(self._requests.items()):
+                lines.append(f'http_requests_total{{route="{route}",method="{method}",'
+                             f'status="{status_code}"}} {count}')
+            for name, (description, _) in HISTOGRAMS.items():
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} histogram')
+                for route, histograms in sorted(self._histograms.items()):
+                    lines.extend(histograms[name].render(name, f'route="{route}"'))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def count_queries(execute, sql, params, many, context):
+    """Обёртка выполнения SQL: относит запрос к текущему HTTP-запросу"""
+    sample = current_request.get()
+    if sample is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        sample.queries += 1
+        sample.sql_time += time.perf_counter() - started
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """Обработчик connection_created: ставит обёртку на новое соединение"""
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, count_queries)
+
+
+def start_request():
+    """Начинает учёт запроса; возвращает (выборка или None, токен contextvar)"""
+    sample = RequestSample() if random.random() < settings.METRICS_SAMPLE_RATE else None
+    return sample, current_request.set(sample)
+
+
+def finish_request(request, response, sample, token):
+    """
+    Записывает метрики завершённого запроса. Тело потокового ответа формируется уже
+    после выхода из middleware, поэтому для него метрики записываются, когда тело
+    отдано целиком (или клиент отключился): время запроса включает отдачу тела, а
+    SQL-запросы генератора относятся к этому HTTP-запросу.
+    """
+    current_request.reset(token)
+    match = getattr(request, 'resolver_match', None)
+    route = match.url_name if match and match.url_name else UNMATCHED_ROUTE
+    registry.count_request(route, request.method, response.status_code)
+    if sample is None:
+        return
+
+    if response.streaming:
+        stream = astream_content if response.is_async else stream_content
+        response.streaming_content = stream(response.streaming_content, sample,
+                                            partial(record, request, response, route, sample))
+    else:
+        record(request, response, route, sample, len(response.content))
+
+
+def stream_content(content, sample, finish):
+    """Отдаёт тело потокового ответа, относя SQL-запросы генератора к выборке"""
+    size = 0
+    iterator = iter(content)
+    try:
+        while True:
+            # Значение contextvar не должно оставаться выставленным между фрагментами
+            token = current_request.set(sample)
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                current_request.reset(token)
+            size += len(chunk)
+            yield chunk
+    finally:
+        finish(size)
+
+
+async def astream_content(content, sample, finish):
+    """Асинхронная версия stream_content"""
+    size = 0
+    iterator = aiter(content)
+    try:
+        while True:
+            token = current_request.set(sample)
+            try:
+                chunk = await anext(iterator)
+            except StopAsyncIteration:
+                return
+            finally:
+                current_request.reset(token)
+            size += len(chunk)
+            yield chunk
+    finally:
+        finish(size)
+
+
+def record(request, response, route, sample, size):
+    duration = time.perf_counter() - sample.started
+    registry.observe(route, {
+        'http_request_duration_seconds': duration,
+        'http_request_db_queries': sample.queries,
+        'http_request_db_duration_seconds': sample.sql_time,
+        'http_response_size_bytes': size,
+    })
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({
+            'route': route,
+            'method': request.method,
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 3),
+            'queries': sample.queries,
+            'sql_ms': round(sample.sql_time * 1000, 3),
+            'bytes': size,
+        }))
@@ -0,0 +1,32 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import metrics
+
+
+class RequestMetricsMiddleware:
+    """
+    Собирает метрики запроса (см. users/metrics.py). Должен стоять первым в
+    MIDDLEWARE, чтобы задержка включала остальные промежуточные слои.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        sample, token = metrics.start_request()
+        response = self.get_response(request)
+        metrics.finish_request(request, response, sample, token)
+        return response
+
+    async def __acall__(self, request):
+        sample, token = metrics.start_request()
+        response = await self.get_response(request)
+        metrics.finish_request(request, response, sample, token)
+        return response
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundSms',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phone_number', models.CharField(max_length=15, verbose_name='Номер телефона')),
+                ('text', models.CharField(max_length=160, verbose_name='Текст сообщения')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает отправки'), ('sent', 'Отправлено'), ('failed', 'Ошибка отправки')], default='pending', max_length=10, verbose_name='Статус')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Количество попыток')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Время создания')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='Время отправки')),
+            ],
+            options={
+                'verbose_name': 'Исходящее SMS',
+                'verbose_name_plural': 'Исходящие SMS',
+                'indexes': [models.Index(fields=['status', 'id'], name='outbound_sms_queue_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:33
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_outboundsms'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Referral',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('activated_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Время активации инвайт-кода')),
+                ('invitee', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='referral', to=settings.AUTH_USER_MODEL, verbose_name='Приглашённый пользователь')),
+                ('inviter', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='referrals', to=settings.AUTH_USER_MODEL, verbose_name='Пригласивший пользователь')),
+            ],
+            options={
+                'verbose_name': 'Реферал',
+                'verbose_name_plural': 'Рефералы',
+                'indexes': [models.Index(fields=['inviter', 'activated_at'], name='referral_inviter_idx')],
+            },
+        ),
+    ]
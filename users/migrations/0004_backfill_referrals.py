@@ -0,0 +1,51 @@
+from django.db import migrations, transaction
+
+BATCH_SIZE = 5000
+
+
+def backfill_referrals(apps, schema_editor):
+    """
+    Заполняет таблицу рефералов по строковым полям activated_invite_code.
+    Пользователи обходятся пачками по первичному ключу, каждая пачка —
+    отдельная транзакция, поэтому миграция не держит блокировки на всей таблице.
+    """
+    User = apps.get_model('users', 'User')
+    Referral = apps.get_model('users', 'Referral')
+    last_pk = 0
+
+    while True:
+        with transaction.atomic():
+            invitees = list(User.objects
+                            .filter(pk__gt=last_pk, activated_invite_code__isnull=False)
+                            .order_by('pk')
+                            .values_list('pk', 'activated_invite_code', 'date_joined')[:BATCH_SIZE])
+            if not invitees:
+                break
+            last_pk = invitees[-1][0]
+
+            # При дублях инвайт-кодов пригласившим считаем самого раннего владельца
+            inviters = {}
+            for inviter_pk, code in (User.objects
+                                     .filter(invite_code__in={code for _, code, _ in invitees})
+                                     .order_by('-pk')
+                                     .values_list('pk', 'invite_code')):
+                inviters[code] = inviter_pk
+
+            Referral.objects.bulk_create(
+                [Referral(inviter_id=inviters[code], invitee_id=invitee_pk, activated_at=joined)
+                 for invitee_pk, code, joined in invitees
+                 if code in inviters and inviters[code] != invitee_pk],
+                ignore_conflicts=True,
+            )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('users', '0003_referral'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_referrals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations
+from django.db.models import Count, Min
+
+from users import invite_codes
+
+
+def dedupe_invite_codes(apps, schema_editor):
+    """
+    Подготовка к уникальному индексу на invite_code: пустые коды заменяются на NULL,
+    а при дублях код остаётся у самого раннего владельца, остальным выдаётся новый.
+    """
+    User = apps.get_model('users', 'User')
+    User.objects.filter(invite_code='').update(invite_code=None)
+
+    duplicates = (User.objects
+                  .filter(invite_code__isnull=False)
+                  .values('invite_code')
+                  .annotate(owners=Count('pk'), first_owner=Min('pk'))
+                  .filter(owners__gt=1))
+    for duplicate in list(duplicates):
+        for user_pk in (User.objects
+                        .filter(invite_code=duplicate['invite_code'])
+                        .exclude(pk=duplicate['first_owner'])
+                        .values_list('pk', flat=True)):
+            taken = set(User.objects
+                        .filter(invite_code__in=invite_codes.candidates(user_pk))
+                        .values_list('invite_code', flat=True))
+            code = next(code for code in invite_codes.candidates(user_pk) if code not in taken)
+            User.objects.filter(pk=user_pk).update(invite_code=code)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_backfill_referrals'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_invite_codes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_dedupe_invite_codes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='invite_code',
+            field=models.CharField(blank=True, max_length=6, null=True, unique=True, verbose_name='Инвайт-код'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_invite_code_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='invited_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество приглашённых'),
+        ),
+    ]
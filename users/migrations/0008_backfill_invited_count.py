@@ -0,0 +1,34 @@
+from django.db import migrations
+from django.db.models import Count
+
+BATCH_SIZE = 1000
+
+
+def backfill_invited_count(apps, schema_editor):
+    """Заполняет счётчик приглашённых по таблице рефералов"""
+    User = apps.get_model('users', 'User')
+    Referral = apps.get_model('users', 'Referral')
+
+    counts = (Referral.objects
+              .values('inviter_id')
+              .annotate(invited=Count('pk'))
+              .order_by('inviter_id'))
+    batch = []
+    for row in counts.iterator():
+        batch.append(User(pk=row['inviter_id'], invited_count=row['invited']))
+        if len(batch) >= BATCH_SIZE:
+            User.objects.bulk_update(batch, ['invited_count'])
+            batch = []
+    User.objects.bulk_update(batch, ['invited_count'])
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('users', '0007_user_invited_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_invited_count, migrations.RunPython.noop),
+    ]
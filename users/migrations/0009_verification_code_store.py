@@ -0,0 +1,34 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_backfill_invited_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VerificationCode',
+            fields=[
+                ('phone_number', models.CharField(max_length=15, primary_key=True, serialize=False, verbose_name='Номер телефона')),
+                ('code', models.CharField(max_length=4, verbose_name='Код верификации')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='Действует до')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Неудачных попыток')),
+            ],
+            options={
+                'verbose_name': 'Код верификации',
+                'verbose_name_plural': 'Коды верификации',
+            },
+        ),
+        migrations.RemoveField(
+            model_name='user',
+            name='verification_code',
+        ),
+        migrations.RemoveField(
+            model_name='user',
+            name='verification_code_created_at',
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:50
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_verification_code_store'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferralClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField(verbose_name='Глубина')),
+                ('ancestor', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Предок')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Потомок')),
+            ],
+            options={
+                'verbose_name': 'Связь в дереве рефералов',
+                'verbose_name_plural': 'Дерево рефералов',
+                'indexes': [models.Index(fields=['ancestor', 'depth'], name='referral_closure_depth_idx')],
+                'constraints': [models.UniqueConstraint(fields=('ancestor', 'descendant'), name='referral_closure_unique')],
+            },
+        ),
+    ]
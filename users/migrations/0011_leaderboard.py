@@ -0,0 +1,46 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('users', '0010_referral_closure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('day', 'День'), ('week', 'Неделя'), ('month', 'Месяц')], max_length=5, verbose_name='Период')),
+                ('period_start', models.DateField(verbose_name='Начало периода')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Количество приглашённых')),
+            ],
+            options={
+                'verbose_name': 'Счётчик рейтинга',
+                'verbose_name_plural': 'Счётчики рейтинга',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['-invited_count', 'id'], name='user_invited_count_idx'),
+        ),
+        migrations.AddField(
+            model_name='leaderboardcounter',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Пригласивший пользователь'),
+        ),
+        migrations.AddIndex(
+            model_name='leaderboardcounter',
+            index=models.Index(fields=['period', 'period_start', '-count', 'user'], name='leaderboard_top_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='leaderboardcounter',
+            constraint=models.UniqueConstraint(fields=('period', 'period_start', 'user'), name='leaderboard_counter_unique'),
+        ),
+    ]
@@ -0,0 +1,126 @@
+from django.db import migrations, models, transaction
+from django.db.models import Count
+
+import users.models
+from users import phones
+
+BATCH_SIZE = 1000
+
+
+def batches(queryset, fields):
+    """Пользователи пачками по первичному ключу"""
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk).order_by('pk').only(*fields)[:BATCH_SIZE])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1].pk
+
+
+def merge(User, Referral, key):
+    """
+    Объединяет записи одного номера в самую раннюю из активных (или просто самую
+    раннюю): к ней переходят приглашённые, активированный и собственный инвайт-коды
+    """
+    users = list(User.objects.filter(phone_key=key).order_by('-is_active', 'pk'))
+    survivor, duplicates = users[0], users[1:]
+    merged = [user.pk for user in users]
+    duplicate_ids = merged[1:]
+    affected_inviters = set(Referral.objects.filter(invitee_id__in=duplicate_ids)
+                            .values_list('inviter_id', flat=True))
+
+    if not Referral.objects.filter(invitee_id=survivor.pk).exists():
+        referral = (Referral.objects.filter(invitee_id__in=duplicate_ids)
+                    .exclude(inviter_id__in=merged).order_by('activated_at').first())
+        if referral is not None:
+            invitee = next(user for user in duplicates if user.pk == referral.invitee_id)
+            survivor.activated_invite_code = invitee.activated_invite_code
+            referral.invitee_id = survivor.pk
+            referral.save(update_fields=['invitee'])
+    (Referral.objects.filter(inviter_id__in=duplicate_ids).exclude(invitee_id__in=merged)
+     .update(inviter_id=survivor.pk))
+
+    if survivor.invite_code is None:
+        survivor.invite_code = next((user.invite_code for user in duplicates
+                                     if user.invite_code), None)
+    survivor.is_active = any(user.is_active for user in users)
+    survivor.date_joined = min(user.date_joined for user in users)
+
+    # Оставшиеся связи между записями одного номера удаляются каскадно
+    User.objects.filter(pk__in=duplicate_ids).delete()
+    survivor.save(update_fields=['invite_code', 'activated_invite_code', 'is_active',
+                                 'date_joined'])
+    for user_id in affected_inviters | {survivor.pk}:
+        User.objects.filter(pk=user_id).update(
+            invited_count=Referral.objects.filter(inviter_id=user_id).count())
+
+
+def canonicalize_phone_numbers(apps, schema_editor):
+    """
+    Заполняет phone_key, объединяет пользователей с разными записями одного
+    номера и приводит phone_number (и username, если он совпадал с номером)
+    к канонической записи. Таблицы рейтинга и замыкания после объединения
+    пересчитываются командами reconcile_leaderboard и rebuild_referral_closure.
+    """
+    User = apps.get_model('users', 'User')
+    Referral = apps.get_model('users', 'Referral')
+
+    for batch in batches(User.objects.all(), ['pk', 'phone_number']):
+        for user in batch:
+            user.phone_key = phones.key_or_none(user.phone_number)
+        User.objects.bulk_update(batch, ['phone_key'])
+
+    duplicates = (User.objects.filter(phone_key__isnull=False).values('phone_key')
+                  .annotate(users=Count('pk')).filter(users__gt=1)
+                  .values_list('phone_key', flat=True))
+    for key in list(duplicates):
+        with transaction.atomic():
+            merge(User, Referral, key)
+
+    for batch in batches(User.objects.filter(phone_key__isnull=False),
+                         ['pk', 'phone_key', 'phone_number', 'username']):
+        renamed = {user.pk: str(user.phone_key) for user in batch
+                   if user.username == user.phone_number}
+        taken = set(User.objects.filter(username__in=renamed.values())
+                    .exclude(pk__in=list(renamed)).values_list('username', flat=True))
+        for user in batch:
+            if user.pk in renamed and renamed[user.pk] not in taken:
+                user.username = renamed[user.pk]
+            user.phone_number = str(user.phone_key)
+        User.objects.bulk_update(batch, ['phone_number', 'username'])
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('users', '0011_leaderboard'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='user',
+            managers=[
+                ('objects', users.models.UserManager()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='phone_key',
+            field=models.BigIntegerField(blank=True, editable=False, null=True,
+                                         verbose_name='Ключ номера телефона'),
+        ),
+        migrations.RunPython(canonicalize_phone_numbers, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='user',
+            name='phone_key',
+            field=models.BigIntegerField(blank=True, editable=False, null=True, unique=True,
+                                         verbose_name='Ключ номера телефона'),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='phone_number',
+            field=models.CharField(max_length=15),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.3 on 2026-10-18 14:15
+
+import django.core.serializers.json
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0012_user_phone_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_type', models.CharField(choices=[('user.verified', 'Пользователь верифицирован'), ('invite_code.activated', 'Инвайт-код активирован')], max_length=50, verbose_name='Тип события')),
+                ('payload', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, verbose_name='Данные события')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает отправки'), ('sent', 'Отправлено'), ('failed', 'Ошибка отправки')], default='pending', max_length=10, verbose_name='Статус')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Количество попыток')),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Время следующей попытки')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='Последняя ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Время создания')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='Время отправки')),
+            ],
+            options={
+                'verbose_name': 'Исходящее событие',
+                'verbose_name_plural': 'Исходящие события',
+                'indexes': [models.Index(fields=['status', 'available_at'], name='outbox_event_queue_idx')],
+            },
+        ),
+    ]
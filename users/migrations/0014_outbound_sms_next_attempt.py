@@ -0,0 +1,27 @@
+# Generated by Django 5.1.3 on 2026-10-18 14:26
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0013_outbox_event'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='outboundsms',
+            name='outbound_sms_queue_idx',
+        ),
+        migrations.AddField(
+            model_name='outboundsms',
+            name='next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Время следующей попытки'),
+        ),
+        migrations.AddIndex(
+            model_name='outboundsms',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='outbound_sms_queue_idx'),
+        ),
+    ]
@@ -1,83 +1,246 @@
 import random
 import string
 
-from datetime import datetime
-from django.db import models
-from django.contrib.auth.models import AbstractUser
+from functools import partial
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
+from django.contrib.auth.models import AbstractUser, UserManager as BaseUserManager
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from . import invite_codes, phones, replicas
+from .cache import profile_cache
+
+
+def profile_changed(phone_number):
+    """
+    После фиксации изменения профиля: закрепляет чтения профиля за основной базой и
+    сбрасывает закэшированный профиль. Именно в этом порядке: промах кэша после сброса
+    не загрузит профиль с отстающей реплики.
+    """
+    replicas.pin(phone_number)
+    profile_cache.invalidate(phone_number)
+
+
+class UserQuerySet(models.QuerySet):
+
+    def by_phone(self, value):
+        """
+        Пользователь по номеру телефона в любой записи (или по имени пользователя,
+        совпадающему с номером): поиск по уникальному индексу phone_key
+        """
+        key = phones.key_or_none(value)
+        return self.none() if key is None else self.filter(phone_key=key)
+
+
+class UserManager(BaseUserManager.from_queryset(UserQuerySet)):
+    pass
 
 
 class User(AbstractUser):
-    phone_number = models.CharField(max_length=15, unique=True)
+    # Каноническая запись номера (см. users/phones.py); уникальность обеспечивает phone_key
+    phone_number = models.CharField(max_length=15)
+    # Числовое значение номера: единственный индекс для поиска пользователя по телефону.
+    # NULL у служебных учётных записей без номера телефона
+    phone_key = models.BigIntegerField(null=True,
+                                       blank=True,
+                                       unique=True,
+                                       editable=False,
+                                       verbose_name="Ключ номера телефона")
     invite_code = models.CharField(max_length=6,
                                    null=True,
                                    blank=True,
+                                   unique=True,
                                    verbose_name="Инвайт-код")
     activated_invite_code = models.CharField(max_length=6,
                                              null=True,
                                              blank=True,
                                              verbose_name="Активированный инвайт-код")
-    verification_code = models.CharField(max_length=4,
-                                         null=True,
-                                         blank=True,
-                                         verbose_name="Код верификации")
-    verification_code_created_at = (
-        models.DateTimeField(null=True,
-                             blank=True,
-                             verbose_name="Время создания кода верификации"))
+    # Счётчик поддерживается при активации инвайт-кода, чтобы не считать COUNT(*)
+    invited_count = models.PositiveIntegerField(default=0,
+                                                verbose_name="Количество приглашённых")
+
+    objects = UserManager()
+
+    class Meta(AbstractUser.Meta):
+        # Общий рейтинг пригласивших читается по этому индексу (см. users/leaderboard.py)
+        indexes = [models.Index(fields=['-invited_count', 'id'],
+                                name='user_invited_count_idx')]
 
     def __str__(self):
         return self.username
 
-    def generate_invite_code(self):
-        """Генерация случайного 6-значного инвайт-кода (смешанные цифры и буквы)"""
-        self.invite_code = ''.join(
-            random.choices(string.ascii_letters + string.digits, k=6))
-        self.save()
+    def save(self, *args, **kwargs):
+        """Сохранение пользователя со сбросом закэшированного профиля после коммита"""
+        self.phone_key = phones.key_or_none(self.phone_number)
+        super().save(*args, **kwargs)
+        transaction.on_commit(partial(profile_changed, self.phone_number))
+
+    def update_columns(self, condition=None, **values):
+        """
+        Точечное изменение колонок строки одним ``UPDATE ... WHERE``.
+        ``condition`` (Q или выражение) ограничивает изменение: строка обновится,
+        только если условие выполняется в базе на момент запроса.
+        Возвращает True, если строка была изменена.
+        """
+        queryset = User.objects.filter(pk=self.pk)
+        if condition is not None:
+            queryset = queryset.filter(condition)
+        if not queryset.update(**values):
+            return False
+        for field, value in values.items():
+            setattr(self, field, value)
+        transaction.on_commit(partial(profile_changed, self.phone_number))
+        return True
+
+    def generate_invite_code(self, **values):
+        """
+        Выдача уникального 6-значного инвайт-кода (смешанные цифры и буквы).
+        Код выводится из первичного ключа (см. users/invite_codes.py), поэтому
+        конкурентные верификации не конфликтуют между собой. Код записывается
+        условным UPDATE вместе с колонками из ``values``: если кандидат уже занят
+        унаследованным случайным кодом, строка не меняется и берётся следующий.
+        Уже выданный код (в том числе параллельным запросом) не перезаписывается:
+        возвращается код, сохранённый в базе.
+        """
+        for code in invite_codes.candidates(self.pk):
+            if self.update_columns(models.Q(invite_code__isnull=True) &
+                                   ~models.Exists(User.objects.filter(invite_code=code)),
+                                   invite_code=code, **values):
+                return code
+            stored = User.objects.filter(pk=self.pk).values_list('invite_code', flat=True).first()
+            if stored is not None:
+                self.invite_code = stored
+                if values:
+                    self.update_columns(**values)
+                return stored
+        raise IntegrityError(f'Нет свободного инвайт-кода для пользователя {self.pk}')
+
+    def verify(self):
+        """
+        Подтверждение номера телефона: активация и выдача инвайт-кода одним UPDATE.
+        В той же транзакции записывается событие user.verified для внешних систем.
+        """
+        from .events import record
+
+        with transaction.atomic():
+            if self.invite_code:
+                verified = self.update_columns(is_active=True)
+            else:
+                verified = bool(self.generate_invite_code(is_active=True))
+            if verified:
+                record(OutboxEvent.USER_VERIFIED, user_id=self.pk,
+                       phone_number=self.phone_number, invite_code=self.invite_code)
+        return verified
+
+    async def averify(self):
+        """Асинхронная версия verify"""
+        return await sync_to_async(self.verify)()
 
     def generate_verification_code(self):
-        """Генерация 4-значного кода авторизации"""
-        self.verification_code = str(random.randint(1000, 9999))
-        self.save()
+        """
+        Генерация 4-значного кода авторизации.
+        Код сохраняется в хранилище кодов верификации (см. users/verification.py),
+        строка пользователя при этом не изменяется.
+        """
+        from .verification import get_store
+
+        return get_store().issue(self.phone_number)
+
+    def check_verification_code(self, code):
+        """Проверка кода авторизации, возвращает результат из users.verification"""
+        from .verification import get_store
+
+        return get_store().check(self.phone_number, code)
+
+    async def acheck_verification_code(self, code):
+        """Асинхронная версия check_verification_code"""
+        from .verification import get_store
+
+        return await get_store().acheck(self.phone_number, code)
 
     def get_invite_code(self):
         """Получение invite-кода"""
         return self.invite_code
 
-    def get_verification_code(self):
-        """Получение verification-кода"""
-        return self.verification_code
-
     def generate_and_send_verification_code(self):
-        """Генерация и отправка кода верификации"""
-        self.generate_verification_code()
-        # Здесь можно отправить код на телефон или email
-        # Например, отправка через SMS или email
-        # send_sms(self.phone_number, self.verification_code)
-        return self.verification_code
-
-    def activate_invite_code(self, code):
-        """Активация инвайт-кода"""
-        if code != self.invite_code:
-            self.activated_invite_code = code
-            self.save()
-            return True
-        return False
+        """
+        Генерация кода верификации и постановка SMS в очередь отправки.
+        Сама доставка выполняется воркером ``manage.py sms_worker``,
+        поэтому метод не блокирует обработку запроса.
+        """
+        from .sms import enqueue_sms
+
+        verification_code = self.generate_verification_code()
+        enqueue_sms(self.phone_number, f"Ваш код верификации: {verification_code}")
+        return verification_code
+
+    async def agenerate_and_send_verification_code(self):
+        """Асинхронная версия generate_and_send_verification_code для ASGI-эндпоинтов"""
+        from .sms import aenqueue_sms
+        from .verification import get_store
+
+        verification_code = await get_store().aissue(self.phone_number)
+        await aenqueue_sms(self.phone_number, f"Ваш код верификации: {verification_code}")
+        return verification_code
+
+    async def agenerate_invite_code(self):
+        """Асинхронная версия generate_invite_code"""
+        return await sync_to_async(self.generate_invite_code)()
+
+    def activate_invite_code(self, code, inviter=None):
+        """
+        Активация инвайт-кода: сохраняет код, создаёт связь в таблице рефералов
+        и увеличивает счётчик приглашённых у владельца кода.
+        ``inviter`` можно передать, если владелец кода уже загружен.
+
+        Проверка "код ещё не активирован и это не свой код" выполняется самой базой
+        в условном UPDATE, поэтому из параллельных активаций применится ровно одна.
+        Возвращает True, если активация применена.
+        """
+        if inviter is None:
+            inviter = User.objects.filter(invite_code=code).first()
+            if inviter is None:
+                return False
+
+        with transaction.atomic():
+            applied = self.update_columns(
+                models.Q(activated_invite_code__isnull=True) & ~models.Q(pk=inviter.pk),
+                activated_invite_code=code)
+            if not applied:
+                return False
+            referral = Referral.objects.create(inviter=inviter, invitee=self)
+            User.objects.filter(pk=inviter.pk).update(invited_count=F('invited_count') + 1)
+            # Счётчики рейтинга за текущие день, неделю и месяц
+            from .leaderboard import record_activation
+            record_activation(inviter.pk, referral.activated_at)
+            if settings.REFERRAL_CLOSURE_ENABLED:
+                from .referral_tree import link
+                link(inviter.pk, self.pk)
+            from .events import record
+            record(OutboxEvent.INVITE_CODE_ACTIVATED, inviter_id=inviter.pk,
+                   inviter_phone_number=inviter.phone_number, invitee_id=self.pk,
+                   invitee_phone_number=self.phone_number, invite_code=code,
+                   activated_at=referral.activated_at)
+            # У пригласившего изменился список приглашённых: новая версия профиля
+            # сбрасывает и профиль, и первую страницу списка (см. users/cache.py)
+            transaction.on_commit(partial(profile_changed, inviter.phone_number))
+        return True
+
+    async def aactivate_invite_code(self, code, inviter=None):
+        """Асинхронная версия activate_invite_code"""
+        return await sync_to_async(self.activate_invite_code)(code, inviter)
 
     # region Дополнительный функционал
     def reset_verification_code(self):
         """Сбросить код верификации"""
-        self.verification_code = None
-        self.verification_code_created_at = None
-        self.save()
-
-    def is_verification_code_expired(self):
-        """Проверка истечения времени для кода верификации"""
-        if self.verification_code_created_at:
-            expiration_time = (self.verification_code_created_at +
-                               datetime.timedelta(
-                                   minutes=10))  # Код истекает через 10 минут
-            return datetime.datetime.now() > expiration_time
-        return False
+        from .verification import get_store
+
+        get_store().discard(self.phone_number)
 
     # endregion
 
@@ -87,3 +250,188 @@ class User(AbstractUser):
         invite_code, created = cls.objects.get_or_create(code=''.join
         (random.choices(string.ascii_letters + string.digits, k=6)))
         return invite_code
+
+
+class Referral(models.Model):
+    """Реферальная связь: кто пригласил пользователя и когда был активирован инвайт-код"""
+    # Отдельный индекс по inviter не нужен: его покрывает составной индекс ниже
+    inviter = models.ForeignKey(User,
+                                on_delete=models.CASCADE,
+                                related_name='referrals',
+                                db_index=False,
+                                verbose_name="Пригласивший пользователь")
+    invitee = models.OneToOneField(User,
+                                   on_delete=models.CASCADE,
+                                   related_name='referral',
+                                   verbose_name="Приглашённый пользователь")
+    activated_at = models.DateTimeField(default=timezone.now,
+                                        verbose_name="Время активации инвайт-кода")
+
+    class Meta:
+        verbose_name = "Реферал"
+        verbose_name_plural = "Рефералы"
+        indexes = [models.Index(fields=['inviter', 'activated_at'],
+                                name='referral_inviter_idx')]
+
+    def __str__(self):
+        return f"{self.inviter_id} -> {self.invitee_id}"
+
+
+class LeaderboardCounter(models.Model):
+    """Количество пользователей, приглашённых за календарный период (см. users/leaderboard.py)"""
+    DAY = 'day'
+    WEEK = 'week'
+    MONTH = 'month'
+    PERIODS = [(DAY, "День"), (WEEK, "Неделя"), (MONTH, "Месяц")]
+
+    period = models.CharField(max_length=5, choices=PERIODS, verbose_name="Период")
+    period_start = models.DateField(verbose_name="Начало периода")
+    user = models.ForeignKey(User,
+                             on_delete=models.CASCADE,
+                             related_name='+',
+                             verbose_name="Пригласивший пользователь")
+    count = models.PositiveIntegerField(default=0, verbose_name="Количество приглашённых")
+
+    class Meta:
+        verbose_name = "Счётчик рейтинга"
+        verbose_name_plural = "Счётчики рейтинга"
+        constraints = [models.UniqueConstraint(fields=['period', 'period_start', 'user'],
+                                               name='leaderboard_counter_unique')]
+        # Первые N мест периода — чтение N строк индекса
+        indexes = [models.Index(fields=['period', 'period_start', '-count', 'user'],
+                                name='leaderboard_top_idx')]
+
+    def __str__(self):
+        return f"{self.period} {self.period_start}: {self.user_id} = {self.count}"
+
+
+class ReferralClosure(models.Model):
+    """
+    Транзитивное замыкание дерева рефералов: пара "предок — потомок" для каждого
+    пользователя в нижней линии, с глубиной (1 — прямой реферал).
+    Ведётся при REFERRAL_CLOSURE_ENABLED, см. users/referral_tree.py.
+    """
+    # Поиск по предку покрывают индексы ниже
+    ancestor = models.ForeignKey(User,
+                                 on_delete=models.CASCADE,
+                                 related_name='+',
+                                 db_index=False,
+                                 verbose_name="Предок")
+    descendant = models.ForeignKey(User,
+                                   on_delete=models.CASCADE,
+                                   related_name='+',
+                                   verbose_name="Потомок")
+    depth = models.PositiveIntegerField(verbose_name="Глубина")
+
+    class Meta:
+        verbose_name = "Связь в дереве рефералов"
+        verbose_name_plural = "Дерево рефералов"
+        constraints = [models.UniqueConstraint(fields=['ancestor', 'descendant'],
+                                               name='referral_closure_unique')]
+        indexes = [models.Index(fields=['ancestor', 'depth'],
+                                name='referral_closure_depth_idx')]
+
+    def __str__(self):
+        return f"{self.ancestor_id} -> {self.descendant_id} ({self.depth})"
+
+
+class VerificationCode(models.Model):
+    """Действующий код верификации номера телефона"""
+    phone_number = models.CharField(max_length=15,
+                                    primary_key=True,
+                                    verbose_name="Номер телефона")
+    code = models.CharField(max_length=4, verbose_name="Код верификации")
+    expires_at = models.DateTimeField(db_index=True, verbose_name="Действует до")
+    attempts = models.PositiveSmallIntegerField(default=0,
+                                                verbose_name="Неудачных попыток")
+
+    class Meta:
+        verbose_name = "Код верификации"
+        verbose_name_plural = "Коды верификации"
+
+    def __str__(self):
+        return self.phone_number
+
+
+class OutboundSms(models.Model):
+    """Исходящее SMS в очереди на отправку"""
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Ожидает отправки'),
+        (STATUS_SENT, 'Отправлено'),
+        (STATUS_FAILED, 'Ошибка отправки'),
+    ]
+
+    phone_number = models.CharField(max_length=15, verbose_name="Номер телефона")
+    text = models.CharField(max_length=160, verbose_name="Текст сообщения")
+    status = models.CharField(max_length=10,
+                              choices=STATUS_CHOICES,
+                              default=STATUS_PENDING,
+                              verbose_name="Статус")
+    attempts = models.PositiveSmallIntegerField(default=0,
+                                                verbose_name="Количество попыток")
+    # Время, раньше которого сообщение не отправляется: пауза перед повторной попыткой
+    # или срок, на который сообщение забрал воркер
+    next_attempt_at = models.DateTimeField(default=timezone.now,
+                                           verbose_name="Время следующей попытки")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Время создания")
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name="Время отправки")
+
+    class Meta:
+        verbose_name = "Исходящее SMS"
+        verbose_name_plural = "Исходящие SMS"
+        # Воркеры выбирают ожидающие сообщения, время попытки которых наступило
+        indexes = [models.Index(fields=['status', 'next_attempt_at'],
+                                name='outbound_sms_queue_idx')]
+
+    def __str__(self):
+        return f"{self.phone_number}: {self.text}"
+
+
+class OutboxEvent(models.Model):
+    """
+    Событие для внешних систем (биллинга), записанное в той же транзакции, что и
+    изменение. Доставку выполняют воркеры ``manage.py events_worker`` (см. users/events.py).
+    """
+    USER_VERIFIED = 'user.verified'
+    INVITE_CODE_ACTIVATED = 'invite_code.activated'
+    TYPE_CHOICES = [
+        (USER_VERIFIED, 'Пользователь верифицирован'),
+        (INVITE_CODE_ACTIVATED, 'Инвайт-код активирован'),
+    ]
+
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Ожидает отправки'),
+        (STATUS_SENT, 'Отправлено'),
+        (STATUS_FAILED, 'Ошибка отправки'),
+    ]
+
+    event_type = models.CharField(max_length=50, choices=TYPE_CHOICES, verbose_name="Тип события")
+    payload = models.JSONField(encoder=DjangoJSONEncoder, verbose_name="Данные события")
+    status = models.CharField(max_length=10,
+                              choices=STATUS_CHOICES,
+                              default=STATUS_PENDING,
+                              verbose_name="Статус")
+    attempts = models.PositiveSmallIntegerField(default=0,
+                                                verbose_name="Количество попыток")
+    # Время, раньше которого событие не отправляется: пауза перед повторной попыткой
+    # или срок, на который событие забрал воркер
+    available_at = models.DateTimeField(default=timezone.now,
+                                        verbose_name="Время следующей попытки")
+    last_error = models.TextField(blank=True, default='', verbose_name="Последняя ошибка")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Время создания")
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name="Время отправки")
+
+    class Meta:
+        verbose_name = "Исходящее событие"
+        verbose_name_plural = "Исходящие события"
+        # Воркеры выбирают ожидающие события, время попытки которых наступило
+        indexes = [models.Index(fields=['status', 'available_at'], name='outbox_event_queue_idx')]
+
+    def __str__(self):
+        return f"{self.event_type} #{self.pk}"
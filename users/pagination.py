@@ -0,0 +1,27 @@
+from urllib.parse import parse_qs, urlsplit
+
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.urls import replace_query_param
+
+
+class InvitedUsersPagination(CursorPagination):
+    """
+    Курсорная пагинация приглашённых пользователей: новые рефералы первыми.
+    Страница выбирается по индексу (inviter, activated_at) без OFFSET,
+    поэтому стоимость запроса не растёт с номером страницы.
+    """
+    page_size = 100
+    ordering = ('-activated_at', '-id')
+
+    def get_next_cursor(self):
+        """Значение параметра курсора следующей страницы (без адреса запроса) или None"""
+        link = self.get_next_link()
+        if link is None:
+            return None
+        return parse_qs(urlsplit(link).query)[self.cursor_query_param][0]
+
+    def cursor_link(self, request, cursor):
+        """Ссылка на страницу с курсором ``cursor`` относительно адреса текущего запроса"""
+        if cursor is None:
+            return None
+        return replace_query_param(request.build_absolute_uri(), self.cursor_query_param, cursor)
@@ -0,0 +1,89 @@
+"""
+Нормализация номеров телефонов.
+
+Любая запись номера приводится к канонической форме E.164 без ``+``: код
+страны и национальный номер, только цифры. ``+7 (999) 123-45-67``,
+``8 999 123 45 67``, ``0079991234567`` и ``9991234567`` — это ``79991234567``.
+
+Каноническая строка хранится в ``User.phone_number`` (и в ``User.username``
+пользователей, зарегистрированных по телефону), а её числовое значение — в
+``User.phone_key``: BIGINT с единственным уникальным индексом, по которому
+ищутся пользователи (``User.objects.by_phone``). 15 цифр E.164 помещаются в
+BIGINT с запасом.
+
+Номер без кода страны дополняется ``PHONE_COUNTRY_CODE``; префикс выхода на
+межгород ``PHONE_TRUNK_PREFIX`` (``8`` в России) перед национальным номером
+длины ``PHONE_NATIONAL_LENGTH`` заменяется кодом страны.
+"""
+from django.conf import settings
+
+# Допустимые разделители в записи номера
+SEPARATORS = str.maketrans('', '', ' -().\t')
+
+MIN_LENGTH = 10
+# Максимальная длина номера по E.164
+MAX_LENGTH = 15
+
+
+class InvalidPhoneNumber(ValueError):
+    """Строка не является номером телефона; текст исключения — сообщение для пользователя"""
+
+
+def normalize(value):
+    """Каноническая запись номера: цифры E.164 без ``+``"""
+    value = str(value).strip().translate(SEPARATORS)
+    if not value:
+        raise InvalidPhoneNumber("Номер телефона не указан.")
+
+    if value.startswith('+'):
+        digits = value[1:]
+    elif value.startswith('00'):
+        # Международный префикс выхода
+        digits = value[2:]
+    else:
+        digits = value
+        national_length = settings.PHONE_NATIONAL_LENGTH
+        trunk_prefix = settings.PHONE_TRUNK_PREFIX
+        if len(digits) == national_length:
+            digits = settings.PHONE_COUNTRY_CODE + digits
+        elif (trunk_prefix and digits.startswith(trunk_prefix)
+              and len(digits) == national_length + len(trunk_prefix)):
+            digits = settings.PHONE_COUNTRY_CODE + digits[len(trunk_prefix):]
+
+    if not digits.isascii() or not digits.isdigit():
+        raise InvalidPhoneNumber("Номер телефона может содержать только цифры, пробелы, "
+                                 "скобки, дефисы и «+» в начале.")
+    if len(digits) > MAX_LENGTH:
+        raise InvalidPhoneNumber("Номер телефона слишком длинный.")
+    if len(digits) < MIN_LENGTH:
+        raise InvalidPhoneNumber("Номер телефона слишком короткий.")
+    if digits.startswith('0'):
+        raise InvalidPhoneNumber("Код страны не может начинаться с нуля.")
+    return digits
+
+
+def to_key(value):
+    """Числовой ключ номера для ``User.phone_key``; InvalidPhoneNumber для не-номеров"""
+    return int(normalize(value))
+
+
+def canonical_or_none(value):
+    """Каноническая запись номера или None, если строка не является номером телефона"""
+    try:
+        return normalize(value)
+    except InvalidPhoneNumber:
+        return None
+
+
+def key_or_none(value):
+    """Числовой ключ номера или None, если строка не является номером телефона"""
+    canonical = canonical_or_none(value)
+    return None if canonical is None else int(canonical)
+
+
+def mask(value):
+    """Номер (или имя пользователя) для публичных списков: видны первые 4 и последние 2 символа"""
+    value = str(value)
+    if len(value) <= 6:
+        return '*' * len(value)
+    return value[:4] + '*' * (len(value) - 6) + value[-2:]
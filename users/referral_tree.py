@@ -0,0 +1,122 @@
+"""
+Аналитика многоуровневого дерева рефералов: нижняя линия пользователя
+(все приглашённые его приглашёнными и т. д.), её глубина и размер по уровням.
+
+Статистика считается одним SQL-запросом:
+
+* по умолчанию — рекурсивным обходом таблицы рефералов (``WITH RECURSIVE``,
+  одинаковый SQL для PostgreSQL и SQLite);
+* при ``REFERRAL_CLOSURE_ENABLED`` — по таблице замыкания ``ReferralClosure``
+  (группировка по индексу ``(ancestor, depth)``), которая обновляется при каждой
+  активации инвайт-кода. Перед включением таблицу нужно заполнить командой
+  ``manage.py rebuild_referral_closure``.
+
+Параллельные активации могут строить пути друг через друга: пока одна транзакция
+(A пригласил B) читает предков A, другая (C пригласил A) читает нижнюю линию A,
+и ни одна не видит незафиксированную связь другой — строка (C, B) теряется.
+Поэтому ``link`` сначала блокирует строки пригласившего и всех его предков
+(``SELECT ... FOR UPDATE``, в порядке первичного ключа), а строку приглашённого
+уже заблокировал UPDATE активации. Вторая транзакция ждёт первую, и её
+``INSERT ... SELECT`` (новый снимок в READ COMMITTED) видит зафиксированные пути.
+
+У пользователя не больше одного пригласившего, поэтому путь от корня до любого
+узла единственный. Цикл (A пригласил B, затем B пригласил A) может проходить
+только через корень обхода, поэтому обход не возвращается в корень; глубина
+дополнительно ограничена ``REFERRAL_TREE_MAX_DEPTH``.
+"""
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+
+from .models import Referral, ReferralClosure, User
+
+REFERRALS = Referral._meta.db_table
+CLOSURE = ReferralClosure._meta.db_table
+
+DOWNLINE_SQL = f'''
+    WITH RECURSIVE downline (user_id, depth) AS (
+        SELECT invitee_id, 1 FROM {REFERRALS} WHERE inviter_id = %(root)s
+        UNION ALL
+        SELECT r.invitee_id, d.depth + 1
+        FROM downline d JOIN {REFERRALS} r ON r.inviter_id = d.user_id
+        WHERE r.invitee_id <> %(root)s AND d.depth < %(max_depth)s
+    )
+    SELECT depth, COUNT(*) FROM downline GROUP BY depth ORDER BY depth
+'''
+
+CLOSURE_LEVELS_SQL = f'''
+    SELECT depth, COUNT(*) FROM {CLOSURE}
+    WHERE ancestor_id = %(root)s AND depth <= %(max_depth)s
+    GROUP BY depth ORDER BY depth
+'''
+
+# Новая связь inviter -> invitee соединяет всех предков пригласившего (и его самого)
+# со всей нижней линией приглашённого (и им самим)
+LINK_SQL = f'''
+    INSERT INTO {CLOSURE} (ancestor_id, descendant_id, depth)
+    SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+    FROM (SELECT ancestor_id, depth FROM {CLOSURE} WHERE descendant_id = %(inviter)s
+          UNION ALL SELECT %(inviter)s, 0) a
+    CROSS JOIN (SELECT descendant_id, depth FROM {CLOSURE} WHERE ancestor_id = %(invitee)s
+                UNION ALL SELECT %(invitee)s, 0) d
+    WHERE a.ancestor_id <> d.descendant_id
+    ON CONFLICT DO NOTHING
+'''
+
+REBUILD_SQL = f'''
+    WITH RECURSIVE paths (ancestor_id, descendant_id, depth) AS (
+        SELECT inviter_id, invitee_id, 1 FROM {REFERRALS}
+        UNION ALL
+        SELECT p.ancestor_id, r.invitee_id, p.depth + 1
+        FROM paths p JOIN {REFERRALS} r ON r.inviter_id = p.descendant_id
+        WHERE r.invitee_id <> p.ancestor_id AND p.depth < %(max_depth)s
+    )
+    INSERT INTO {CLOSURE} (ancestor_id, descendant_id, depth)
+    SELECT ancestor_id, descendant_id, MIN(depth) FROM paths
+    GROUP BY ancestor_id, descendant_id
+'''
+
+
+def downline_levels(user_id, max_depth=None, use_closure=None):
+    """Размер нижней линии по уровням: [(уровень, количество), ...] начиная с 1"""
+    max_depth = min(max_depth or settings.REFERRAL_TREE_MAX_DEPTH,
+                    settings.REFERRAL_TREE_MAX_DEPTH)
+    if use_closure is None:
+        use_closure = settings.REFERRAL_CLOSURE_ENABLED
+    with connection.cursor() as cursor:
+        cursor.execute(CLOSURE_LEVELS_SQL if use_closure else DOWNLINE_SQL,
+                       {'root': user_id, 'max_depth': max_depth})
+        return [(depth, count) for depth, count in cursor.fetchall()]
+
+
+def downline_stats(user_id, max_depth=None, use_closure=None):
+    """Глубина нижней линии, общее количество потомков и количество на каждом уровне"""
+    levels = downline_levels(user_id, max_depth, use_closure)
+    return {
+        'depth': levels[-1][0] if levels else 0,
+        'total': sum(count for _, count in levels),
+        'levels': [{'level': depth, 'count': count} for depth, count in levels],
+    }
+
+
+def lock_path(inviter_id):
+    """Блокирует до конца транзакции строки пользователя и его предков, возвращает их id"""
+    ancestors = ReferralClosure.objects.filter(descendant_id=inviter_id).values('ancestor_id')
+    return list(User.objects.select_for_update()
+                .filter(Q(pk=inviter_id) | Q(pk__in=ancestors))
+                .order_by('pk').values_list('pk', flat=True))
+
+
+def link(inviter_id, invitee_id):
+    """Добавляет в таблицу замыкания пути через новую связь; вызывается в транзакции активации"""
+    lock_path(inviter_id)
+    with connection.cursor() as cursor:
+        cursor.execute(LINK_SQL, {'inviter': inviter_id, 'invitee': invitee_id})
+
+
+def rebuild():
+    """Пересчитывает таблицу замыкания по таблице рефералов, возвращает количество строк"""
+    ReferralClosure.objects.all().delete()
+    with connection.cursor() as cursor:
+        cursor.execute(REBUILD_SQL, {'max_depth': settings.REFERRAL_TREE_MAX_DEPTH})
+    return ReferralClosure.objects.count()
@@ -0,0 +1,39 @@
+"""
+JSON-рендерер с кодированием через orjson.
+
+Вывод байт-в-байт совпадает с ``rest_framework.renderers.JSONRenderer`` для
+простых данных (строки, числа, None, списки и словари): компактные
+разделители и UTF-8 без экранирования. orjson — необязательная зависимость:
+если он не установлен, а также для данных, которые он не кодирует, и для
+запросов с отступами (``Accept: application/json; indent=4``) используется
+стандартный рендерер DRF.
+"""
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Даты и dataclass orjson кодирует иначе, чем энкодер DRF: они уходят в запасной путь
+OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS if orjson else 0
+
+# DRF экранирует разделители строк U+2028 и U+2029, orjson — нет
+LINE_SEPARATORS = (b'\xe2\x80\xa8', b'\xe2\x80\xa9')
+
+
+class FastJSONRenderer(JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        if data is None:
+            return b''
+        try:
+            content = orjson.dumps(data, option=OPTIONS)
+        except TypeError:
+            # Даты, Decimal, ленивые строки и т. п. кодирует энкодер DRF
+            return super().render(data, accepted_media_type, renderer_context)
+        if any(separator in content for separator in LINE_SEPARATORS):
+            return super().render(data, accepted_media_type, renderer_context)
+        return content
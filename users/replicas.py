@@ -0,0 +1,99 @@
+"""
+Чтение с реплик базы данных.
+
+``ReplicaRouter`` отправляет на реплики (``DATABASE_REPLICAS``) только чтения, явно
+допускающие отставание: пути профиля, списка приглашённых и пакетного поиска
+выполняют их внутри ``reading()``. Остальные чтения и все записи идут в основную
+базу, поэтому верификация и активация инвайт-кода не видят отставания реплик.
+
+Read-your-writes: после изменения профиля номер телефона закрепляется за основной
+базой на ``REPLICA_PIN_SECONDS`` (ключ в кэше ``REPLICA_PIN_CACHE_ALIAS``, общем для
+воркеров при заданном REDIS_URL). Пока номер закреплён, его профиль и список
+приглашённых читаются из основной базы: пользователь сразу видит свой новый
+инвайт-код, а пригласивший — нового приглашённого.
+
+Без настроенных реплик ``reading()`` ничего не делает и не обращается к кэшу.
+"""
+import contextvars
+import random
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+
+# Реплика для чтений текущего блока reading(); None — основная база
+current_replica = contextvars.ContextVar('current_replica', default=None)
+
+
+def get_cache():
+    return caches[settings.REPLICA_PIN_CACHE_ALIAS]
+
+
+def pin_key(phone_number):
+    return f'replica:pin:{phone_number}'
+
+
+def pin(phone_number):
+    """Закрепляет чтения профиля номера за основной базой на REPLICA_PIN_SECONDS"""
+    if settings.DATABASE_REPLICAS:
+        get_cache().set(pin_key(phone_number), True, settings.REPLICA_PIN_SECONDS)
+
+
+def choose(pinned):
+    """Реплика для блока чтений или None, если есть закреплённые номера"""
+    if pinned or not settings.DATABASE_REPLICAS:
+        return None
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+@contextmanager
+def use(alias):
+    token = current_replica.set(alias)
+    try:
+        yield alias
+    finally:
+        current_replica.reset(token)
+
+
+def reading(*phone_numbers):
+    """
+    Чтения внутри блока идут на одну случайную реплику, если профили ``phone_numbers``
+    не изменялись в последние REPLICA_PIN_SECONDS. Возвращает контекстный менеджер,
+    значение которого — выбранная реплика или None (основная база)::
+
+        with replicas.reading(phone_number):
+            user = User.objects.by_phone(phone_number).first()
+    """
+    replicas = settings.DATABASE_REPLICAS
+    pinned = replicas and phone_numbers and get_cache().get_many(
+        [pin_key(phone_number) for phone_number in phone_numbers])
+    return use(choose(pinned))
+
+
+@asynccontextmanager
+async def areading(*phone_numbers):
+    """Асинхронная версия reading()"""
+    replicas = settings.DATABASE_REPLICAS
+    pinned = replicas and phone_numbers and \
+        await get_cache().aget_many([pin_key(phone_number) for phone_number in phone_numbers])
+    with use(choose(pinned)) as alias:
+        yield alias
+
+
+class ReplicaRouter:
+    """Маршрутизатор: чтения блоков reading() — на реплику, всё остальное — в основную базу"""
+
+    def db_for_read(self, model, **hints):
+        return current_replica.get()
+
+    def db_for_write(self, model, **hints):
+        # Явно: иначе Django записал бы объект, прочитанный с реплики, в реплику
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики содержат те же данные, что и основная база
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
@@ -1,21 +1,42 @@
+from django.conf import settings
 from rest_framework import serializers
 
-from .models import User
+from . import phones, replicas
+from .models import Referral, User
 
 
-class PhoneNumberVerificationSerializer(serializers.Serializer):
-    phone_number = serializers.CharField(max_length=15)
+# Запись номера в запросе может содержать пробелы, скобки и дефисы
+PHONE_NUMBER_INPUT_MAX_LENGTH = 32
+
+
+def validate_phone_number(value):
+    """
+    Правила проверки номера телефона без создания сериализатора
+    (используются и при массовом импорте). Возвращает каноническую запись номера.
+    """
+    try:
+        return phones.normalize(value)
+    except phones.InvalidPhoneNumber as error:
+        raise serializers.ValidationError(str(error))
+
+
+class PhoneNumberField(serializers.CharField):
+    """Номер телефона в любой записи; значение поля — каноническая запись (users/phones.py)"""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('max_length', PHONE_NUMBER_INPUT_MAX_LENGTH)
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        return validate_phone_number(super().to_internal_value(data))
 
-    def validate_phone_number(self, value):
-        """Валидация номера телефона"""
-        # Здесь можно добавить дополнительные проверки на формат телефона
-        if len(value) < 10:
-            raise serializers.ValidationError("Номер телефона слишком короткий.")
-        return value
+
+class PhoneNumberVerificationSerializer(serializers.Serializer):
+    phone_number = PhoneNumberField()
 
 
 class VerificationCodeSerializer(serializers.Serializer):
-    phone_number = serializers.CharField(max_length=15)
+    phone_number = PhoneNumberField()
     verification_code = serializers.CharField(max_length=4)
 
 
@@ -30,11 +51,93 @@ class UserProfileSerializer(serializers.ModelSerializer):
 
     def get_invited_users(self, obj):
         # Возвращает список пользователей, которые активировали инвайт-код этого пользователя
-        invited_users = User.objects.filter(activated_invite_code=obj.invite_code)
-        return [user.phone_number for user in invited_users]
+        # Выборка по индексу referral_inviter_idx, без загрузки моделей пользователей
+        return list(Referral.objects.filter(inviter=obj)
+                    .order_by('activated_at', 'id')
+                    .values_list('invitee__phone_number', flat=True))
+
+
+class ProfileCacheStatsSerializer(serializers.Serializer):
+    # Счётчики кэша профилей текущего процесса: ответ ProfileCacheStatsView
+    hits = serializers.IntegerField()
+    misses = serializers.IntegerField()
+    invalidations = serializers.IntegerField()
+    hit_ratio = serializers.FloatField()
+
+
+class DownlineLevelSerializer(serializers.Serializer):
+    level = serializers.IntegerField()
+    count = serializers.IntegerField()
+
+
+class DownlineSerializer(serializers.Serializer):
+    # Статистика нижней линии рефералов: ответ DownlineView
+    depth = serializers.IntegerField()
+    total = serializers.IntegerField()
+    levels = DownlineLevelSerializer(many=True)
+
+
+class LeaderboardEntrySerializer(serializers.Serializer):
+    rank = serializers.IntegerField()
+    user = serializers.CharField(help_text="Номер телефона, видны первые 4 и последние 2 цифры")
+    invited_count = serializers.IntegerField()
+
+
+class LeaderboardSerializer(serializers.Serializer):
+    # Рейтинг пригласивших: ответ LeaderboardView
+    period = serializers.CharField()
+    period_start = serializers.DateField(allow_null=True)
+    results = LeaderboardEntrySerializer(many=True)
+
+
+class InvitedUsersPageSerializer(serializers.Serializer):
+    # Страница списка приглашённых: ответ InvitedUsersView
+    count = serializers.IntegerField()
+    next = serializers.URLField(allow_null=True)
+    previous = serializers.URLField(allow_null=True)
+    results = serializers.ListField(child=serializers.CharField())
+
+
+class ProfileLookupSerializer(serializers.Serializer):
+    usernames = serializers.ListField(child=serializers.CharField(max_length=150),
+                                      allow_empty=False)
+
+    def validate_usernames(self, value):
+        if len(value) > settings.PROFILE_LOOKUP_MAX_BATCH:
+            raise serializers.ValidationError(
+                f"Не больше {settings.PROFILE_LOOKUP_MAX_BATCH} пользователей в одном запросе.")
+        return value
+
+
+class TokenRefreshSerializer(serializers.Serializer):
+    refresh = serializers.CharField()
 
 
 class InviteCodeSerializer(serializers.Serializer):
-    phone_number = serializers.CharField(max_length=15)
+    phone_number = PhoneNumberField()
     activated_invite_code = serializers.CharField(max_length=6)
 
+
+# Колонки профиля в порядке полей UserProfileSerializer
+PROFILE_FIELDS = ['phone_number', 'invite_code', 'activated_invite_code']
+
+
+def load_profile(username):
+    """
+    Загружает данные профиля для кэша профилей, None если пользователь не найден.
+
+    Результат совпадает с ``UserProfileSerializer(user).data``, но модель User не
+    создаётся: читаются только нужные колонки, без хэша пароля и прочих полей
+    AbstractUser, и без разбора полей сериализатора на каждый запрос.
+    """
+    # С реплики, если профиль не изменялся только что (см. users/replicas.py)
+    with replicas.reading(username):
+        row = User.objects.by_phone(username).values_list('pk', *PROFILE_FIELDS).first()
+        if row is None:
+            return None
+        pk, *values = row
+        data = dict(zip(PROFILE_FIELDS, values))
+        data['invited_users'] = list(Referral.objects.filter(inviter_id=pk)
+                                     .order_by('activated_at', 'id')
+                                     .values_list('invitee__phone_number', flat=True))
+    return data
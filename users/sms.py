@@ -0,0 +1,166 @@
+"""
+Доставка SMS: очередь исходящих сообщений и подключаемые бэкенды отправки.
+
+Обработчики запросов только ставят сообщение в очередь (одна вставка в таблицу
+``OutboundSms``), а отправку выполняют воркеры ``manage.py sms_worker``,
+которые забирают сообщения пачками. Бэкенд отправки задаётся настройкой
+``SMS_BACKEND`` по аналогии с ``EMAIL_BACKEND`` в Django.
+"""
+import json
+import logging
+import random
+import sys
+import threading
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import OutboundSms
+
+logger = logging.getLogger(__name__)
+
+# Результат обработки одной пачки
+DrainResult = namedtuple('DrainResult', ['claimed', 'sent', 'failed'])
+
+# Сообщения, "отправленные" через LocmemSmsBackend (используется в тестах)
+outbox = []
+_outbox_lock = threading.Lock()
+
+
+# region Бэкенды
+class BaseSmsBackend:
+    """Базовый класс бэкенда отправки SMS"""
+
+    def send_messages(self, messages):
+        """
+        Отправляет пачку сообщений ``OutboundSms``.
+        Возвращает количество отправленных сообщений, при ошибке бросает исключение.
+        """
+        raise NotImplementedError('Бэкенд должен реализовать send_messages()')
+
+
+class LocmemSmsBackend(BaseSmsBackend):
+    """Сохраняет сообщения в памяти процесса (``users.sms.outbox``)"""
+
+    def send_messages(self, messages):
+        with _outbox_lock:
+            outbox.extend({'phone_number': message.phone_number, 'text': message.text}
+                          for message in messages)
+        return len(messages)
+
+
+class FileSmsBackend(BaseSmsBackend):
+    """Дописывает сообщения в файл ``SMS_FILE_PATH`` в формате JSON Lines"""
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path or settings.SMS_FILE_PATH
+
+    def send_messages(self, messages):
+        with open(self.file_path, 'a', encoding='utf-8') as stream:
+            for message in messages:
+                stream.write(json.dumps({'phone_number': message.phone_number,
+                                         'text': message.text},
+                                        ensure_ascii=False) + '\n')
+        return len(messages)
+
+
+class ConsoleSmsBackend(BaseSmsBackend):
+    """Выводит сообщения в stdout, удобно при локальной разработке"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def send_messages(self, messages):
+        for message in messages:
+            self.stream.write(f"SMS -> {message.phone_number}: {message.text}\n")
+        self.stream.flush()
+        return len(messages)
+
+
+def get_backend(backend=None, **kwargs):
+    """Создаёт экземпляр бэкенда по пути к классу (по умолчанию ``SMS_BACKEND``)"""
+    return import_string(backend or settings.SMS_BACKEND)(**kwargs)
+
+# endregion Бэкенды
+
+
+# region Очередь
+def enqueue_sms(phone_number, text):
+    """Ставит SMS в очередь на отправку и сразу возвращает управление"""
+    return OutboundSms.objects.create(phone_number=phone_number, text=text)
+
+
+async def aenqueue_sms(phone_number, text):
+    """Асинхронная версия enqueue_sms"""
+    return await OutboundSms.objects.acreate(phone_number=phone_number, text=text)
+
+
+def retry_delay(attempts):
+    """Пауза перед следующей попыткой: удваивается с каждой попыткой, со случайным разбросом"""
+    delay = min(settings.SMS_RETRY_MAX_DELAY, settings.SMS_RETRY_DELAY * 2 ** (attempts - 1))
+    return random.uniform(delay / 2, delay)
+
+
+def claim_batch(batch_size):
+    """
+    Забирает пачку сообщений, время попытки которых наступило, и откладывает их
+    следующую попытку на ``SMS_LEASE_TIMEOUT``: пока воркер их отправляет, другие
+    воркеры их не возьмут, а если воркер упадёт, сообщения вернутся в очередь.
+
+    Строки блокируются через ``SELECT ... FOR UPDATE SKIP LOCKED`` только на время
+    этой короткой транзакции, отправка идёт уже после коммита (на SQLite
+    блокировки не поддерживаются, там запускайте один воркер).
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(OutboundSms.objects
+                     .select_for_update(skip_locked=True)
+                     .filter(status=OutboundSms.STATUS_PENDING, next_attempt_at__lte=now)
+                     .order_by('next_attempt_at', 'id')[:batch_size])
+        if batch:
+            OutboundSms.objects.filter(pk__in=[message.pk for message in batch]).update(
+                next_attempt_at=now + timedelta(seconds=settings.SMS_LEASE_TIMEOUT))
+    return batch
+
+
+def drain_batch(batch_size=None, backend=None):
+    """
+    Забирает из очереди одну пачку готовых сообщений и отправляет её.
+
+    Если бэкенд не смог отправить пачку, следующая попытка откладывается с
+    экспоненциальной паузой (``SMS_RETRY_DELAY``, не больше ``SMS_RETRY_MAX_DELAY``),
+    после ``SMS_MAX_ATTEMPTS`` попыток сообщения помечаются как неотправленные.
+    """
+    backend = backend or get_backend()
+    batch = claim_batch(batch_size or settings.SMS_BATCH_SIZE)
+    if not batch:
+        return DrainResult(0, 0, 0)
+
+    try:
+        backend.send_messages(batch)
+    except Exception:
+        logger.exception('Не удалось отправить пачку из %s SMS', len(batch))
+        failed = True
+    else:
+        failed = False
+
+    now = timezone.now()
+    for message in batch:
+        message.attempts += 1
+        if not failed:
+            message.status, message.sent_at = OutboundSms.STATUS_SENT, now
+        elif message.attempts >= settings.SMS_MAX_ATTEMPTS:
+            message.status = OutboundSms.STATUS_FAILED
+        else:
+            # Разброс не даёт сообщениям, упавшим вместе, повторяться одновременно
+            message.next_attempt_at = now + timedelta(seconds=retry_delay(message.attempts))
+    OutboundSms.objects.bulk_update(batch, ['status', 'attempts', 'next_attempt_at', 'sent_at'])
+    if failed:
+        return DrainResult(len(batch), 0, len(batch))
+    return DrainResult(len(batch), len(batch), 0)
+
+# endregion Очередь
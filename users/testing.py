@@ -0,0 +1,63 @@
+"""
+Локальный HTTP-приёмник событий для бенчмарков и тестов доставки исходящих событий
+(users/events.py): принимает POST на любой путь и запоминает тела и заголовки
+запросов в ``received``. Первые ``fail_first`` запросов получают ответ 503,
+``delay`` — пауза перед ответом, имитирующая сеть::
+
+    with LocalWebhookServer() as server:
+        backend = WebhookEventBackend(url=server.url)
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LocalWebhookServer:
+
+    def __init__(self, fail_first=0, delay=0.0):
+        self.fail_first = fail_first
+        self.delay = delay
+        self.received = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/events/'
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def _handler_class(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if receiver.delay:
+                    time.sleep(receiver.delay)
+                with receiver._lock:
+                    failing = receiver.fail_first > 0
+                    if failing:
+                        receiver.fail_first -= 1
+                    else:
+                        receiver.received.append({'headers': dict(self.headers),
+                                                  'body': json.loads(data)})
+                self.send_response(503 if failing else 204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
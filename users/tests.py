@@ -1,32 +1,1740 @@
-from rest_framework.test import APITestCase
+import asyncio
+import csv
+import gzip
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from importlib import import_module
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.utils import make_template_fragment_key
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, APITestCase
 from rest_framework import status
 
+from referral_system import docs, schema
+
+from users import checks, events, invite_codes, leaderboard, metrics, phones, referral_tree, \
+    replicas, sms, throttling, tokens, verification
+from users.authentication import SignedTokenAuthentication
+from users.cache import profile_cache, set_invited_users_page
+from users.models import LeaderboardCounter, OutboundSms, OutboxEvent, Referral, ReferralClosure, \
+    User, VerificationCode
+from users.pagination import InvitedUsersPagination
+from users.renderers import FastJSONRenderer
+from users.serializers import UserProfileSerializer, load_profile
+from users.testing import LocalWebhookServer
+
 class PhoneAuthTestCase(APITestCase):
 
+    def setUp(self):
+        # Сбрасывает вёдра ограничения частоты запросов между тестами
+        cache.clear()
+
     def test_send_verification_code(self):
         """Проверяем, что система отправляет код на номер телефона"""
-        response = self.client.post('/auth/phone/', {'phone_number': '1234567890'})
+        response = self.client.post('/phone/', {'phone_number': '1234567890'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIn('verification_code', response.data)
+        self.assertEqual(response.data['message'],
+                         "Пользователь создан, код верификации отправлен на номер телефона")
+
+        response = self.client.post('/phone/', {'phone_number': '1234567890'})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertIn('code', response.data)
-        self.assertEqual(response.data['message'], "Verification code sent")
+        self.assertEqual(response.data['message'],
+                         "Новый код верификации отправлен на номер телефона")
 
     def test_verify_code_success(self):
         """Проверяем успешную верификацию кода"""
         phone_number = '1234567890'
-        code = '1234'  # Предположим, что мы уже знаем код, который был отправлен
-        self.client.post('/auth/phone/', {'phone_number': phone_number})  # Отправляем код
+        response = self.client.post('/phone/', {'phone_number': phone_number})  # Отправляем код
+        code = response.data['verification_code']
 
-        response = self.client.post('/auth/verify/', {'phone_number': phone_number, 'code': code})
+        response = self.client.post('/verify/', {'phone_number': phone_number,
+                                                 'verification_code': code})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data['message'], "Phone number verified successfully")
+        user = User.objects.by_phone(phone_number).get()
+        self.assertTrue(user.is_active)
+        self.assertEqual(response.data['message'],
+                         f"Верификация прошла успешно! Ваш invite-код: {user.invite_code}")
 
     def test_verify_code_failure(self):
         """Проверяем неверный код"""
         phone_number = '1234567890'
-        wrong_code = '9999'
 
-        self.client.post('/auth/phone/', {'phone_number': phone_number})  # Отправляем код
+        response = self.client.post('/phone/', {'phone_number': phone_number})  # Отправляем код
+        wrong_code = '9999' if response.data['verification_code'] != '9999' else '1111'
+
+        response = self.client.post('/verify/', {'phone_number': phone_number,
+                                                 'verification_code': wrong_code})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['message'], "Неверный код верификации")
+
+
+class FailingSmsBackend(sms.BaseSmsBackend):
+    def send_messages(self, messages):
+        raise ConnectionError('SMS-шлюз недоступен')
+
+
+@override_settings(SMS_BACKEND='users.sms.LocmemSmsBackend', SMS_MAX_ATTEMPTS=2)
+class SmsQueueTestCase(APITestCase):
+
+    def setUp(self):
+        sms.outbox.clear()
+
+    def test_phone_endpoint_enqueues_sms(self):
+        """Эндпоинт только ставит SMS в очередь, не отправляя его"""
+        response = self.client.post('/phone/', {'phone_number': '79990001122'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        message = OutboundSms.objects.get()
+        self.assertEqual(message.phone_number, '79990001122')
+        self.assertIn(response.data['verification_code'], message.text)
+        self.assertEqual(message.status, OutboundSms.STATUS_PENDING)
+        self.assertEqual(sms.outbox, [])
+
+    def test_worker_drains_queue_in_batches(self):
+        """Воркер отправляет все сообщения пачками и помечает их отправленными"""
+        for number in range(5):
+            sms.enqueue_sms(f'7999000000{number}', 'code')
+
+        call_command('sms_worker', once=True, batch_size=2, stdout=StringIO())
+
+        self.assertEqual(len(sms.outbox), 5)
+        self.assertFalse(OutboundSms.objects.exclude(status=OutboundSms.STATUS_SENT).exists())
+
+    def test_failed_batch_is_retried_then_marked_failed(self):
+        """Ошибка бэкенда не теряет сообщение, после SMS_MAX_ATTEMPTS оно помечается ошибочным"""
+        message = sms.enqueue_sms('79990001122', 'code')
+        backend = FailingSmsBackend()
+
+        with self.assertLogs('users.sms', 'ERROR'):
+            self.assertEqual(sms.drain_batch(backend=backend), (1, 0, 1))
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), (OutboundSms.STATUS_PENDING, 1))
+        # Повторная попытка отложена: следующая пачка сообщение не забирает
+        self.assertGreater(message.next_attempt_at, timezone.now())
+        self.assertEqual(sms.drain_batch(backend=backend).claimed, 0)
+
+        OutboundSms.objects.update(next_attempt_at=timezone.now())
+        with self.assertLogs('users.sms', 'ERROR'):
+            sms.drain_batch(backend=backend)
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), (OutboundSms.STATUS_FAILED, 2))
+        self.assertEqual(sms.drain_batch(backend=backend).claimed, 0)
+
+    @override_settings(SMS_RETRY_DELAY=10, SMS_RETRY_MAX_DELAY=15)
+    def test_retry_delay_grows_with_attempts(self):
+        self.assertTrue(5 <= sms.retry_delay(1) <= 10)
+        self.assertTrue(7.5 <= sms.retry_delay(5) <= 15)
 
-        response = self.client.post('/auth/verify/', {'phone_number': phone_number, 'code': wrong_code})
+    def test_messages_are_claimed_before_sending(self):
+        """Пока пачка отправляется, сообщения забраны воркером и другим не достаются"""
+        sms.enqueue_sms('79990001122', 'code')
+        claimed = []
+
+        class ClaimCheckingBackend(sms.LocmemSmsBackend):
+            def send_messages(self, messages):
+                claimed.append(sms.claim_batch(10))
+                return super().send_messages(messages)
+
+        self.assertEqual(sms.drain_batch(backend=ClaimCheckingBackend()), (1, 1, 0))
+        self.assertEqual(claimed, [[]])
+
+    @override_settings(SMS_BACKEND='users.tests.FailingSmsBackend')
+    def test_worker_stops_after_failed_batch(self):
+        """Неудачная пачка не считается полной: воркер не забирает сразу следующую"""
+        for number in range(2):
+            sms.enqueue_sms(f'7999000000{number}', 'code')
+        stdout = StringIO()
+
+        with self.assertLogs('users.sms', 'ERROR') as logs:
+            call_command('sms_worker', once=True, batch_size=1, stdout=stdout)
+
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('неудачных попыток: 1', stdout.getvalue())
+
+
+@override_settings(SMS_BACKEND='users.sms.LocmemSmsBackend')
+class AsyncApiTestCase(TransactionTestCase):
+
+    async def test_login_flow(self):
+        """Асинхронные эндпоинты проходят полный сценарий входа и активации инвайт-кода"""
+        response = await self.async_client.post('/async/phone/', {'phone_number': '79990001122'},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        code = response.json()['verification_code']
+        self.assertTrue(await OutboundSms.objects.filter(phone_number='79990001122').aexists())
+
+        response = await self.async_client.post('/async/verify/', {
+            'phone_number': '79990001122', 'verification_code': code,
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        access = response.json()['access']
+
+        inviter = await User.objects.acreate(username='79990003344', phone_number='79990003344',
+                                             invite_code='ABC123')
+        response = await self.async_client.post(
+            '/async/profile/79990001122/activate-invite-code/',
+            {'phone_number': '79990001122', 'activated_invite_code': inviter.invite_code},
+            content_type='application/json', headers={'Authorization': f'Bearer {access}'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = await self.async_client.get(f'/async/profile/{inviter.username}/')
+        self.assertEqual(response.json()['invited_users'], ['79990001122'])
+
+    async def test_profile_matches_sync_view_and_uses_cache(self):
+        inviter = await User.objects.acreate(username='79990003344', phone_number='79990003344',
+                                             invite_code='ABC123')
+        invitee = await User.objects.acreate(username='79990001122', phone_number='79990001122')
+        await invitee.aactivate_invite_code('ABC123', inviter=inviter)
+        caches['profiles'].clear()
+
+        response = await self.async_client.get('/async/profile/79990003344/')
+        self.assertEqual(response.json(),
+                         (await self.async_client.get('/profile/79990003344/')).json())
+        with mock.patch('users.async_views.load_profile') as loader:
+            await self.async_client.get('/async/profile/79990003344/')
+        loader.assert_not_called()
+
+    async def test_wrong_code_and_missing_profile(self):
+        await User.objects.acreate(username='79990001122', phone_number='79990001122',
+                                   is_active=False)
+        await verification.get_store().aissue('79990001122')
+        response = await self.async_client.post('/async/verify/', {
+            'phone_number': '79990001122', 'verification_code': '0000',
+        }, content_type='application/json')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
-        self.assertEqual(response.data['error'], "Invalid code or phone number")
+
+        response = await self.async_client.get('/async/profile/nobody/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ReferralTestCase(APITestCase):
+
+    def setUp(self):
+        caches['profiles'].clear()
+        self.inviter = User.objects.create(username='79990000001', phone_number='79990000001',
+                                           invite_code='ABC123')
+        self.invitee = User.objects.create(username='79990000002', phone_number='79990000002')
+
+    def test_activation_records_referral(self):
+        """Активация инвайт-кода создаёт связь в таблице рефералов"""
+        response = self.client.post(
+            f'/profile/{self.invitee.username}/activate-invite-code/',
+            {'phone_number': self.invitee.phone_number, 'activated_invite_code': 'ABC123'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        referral = Referral.objects.get()
+        self.assertEqual((referral.inviter, referral.invitee), (self.inviter, self.invitee))
+
+        response = self.client.get(f'/profile/{self.inviter.username}/')
+        self.assertEqual(response.data['invited_users'], [self.invitee.phone_number])
+
+    def test_own_code_is_not_activated(self):
+        self.assertFalse(self.inviter.activate_invite_code('ABC123'))
+        self.assertFalse(Referral.objects.exists())
+
+    def test_backfill_migration(self):
+        """Миграция восстанавливает связи по строковому полю activated_invite_code"""
+        User.objects.filter(pk=self.invitee.pk).update(activated_invite_code='ABC123')
+        User.objects.create(username='79990000003', phone_number='79990000003',
+                            activated_invite_code='NOSUCH')
+
+        migration = import_module('users.migrations.0004_backfill_referrals')
+        migration.backfill_referrals(apps, None)
+        migration.backfill_referrals(apps, None)  # повторный запуск ничего не дублирует
+
+        self.assertEqual(list(Referral.objects.values_list('inviter', 'invitee')),
+                         [(self.inviter.pk, self.invitee.pk)])
+
+
+class InviteCodeTestCase(APITestCase):
+
+    def test_codes_are_unique_and_well_formed(self):
+        """Коды кандидатов разных пользователей не пересекаются"""
+        codes = [code for key in range(1, 20001) for code in invite_codes.candidates(key)]
+        self.assertEqual(len(codes), len(set(codes)))
+        self.assertTrue(all(len(code) == 6 and set(code) <= set(invite_codes.ALPHABET)
+                            for code in codes))
+
+    def test_taken_legacy_code_is_skipped(self):
+        """Если код занят унаследованным случайным кодом, выдаётся следующий кандидат"""
+        user = User.objects.create(username='79990000001', phone_number='79990000001')
+        first, second = invite_codes.candidates(user.pk)[:2]
+        User.objects.create(username='79990000002', phone_number='79990000002',
+                            invite_code=first)
+
+        self.assertEqual(user.generate_invite_code(), second)
+        user.refresh_from_db()
+        self.assertEqual(user.invite_code, second)
+
+    def test_existing_code_is_kept(self):
+        """Код, выданный параллельным запросом, не перезаписывается"""
+        user = User.objects.create(username='79990000001', phone_number='79990000001',
+                                   is_active=False)
+        User.objects.filter(pk=user.pk).update(invite_code='XYZ789')
+
+        self.assertEqual(user.generate_invite_code(is_active=True), 'XYZ789')
+        user.refresh_from_db()
+        self.assertEqual((user.invite_code, user.is_active), ('XYZ789', True))
+
+    def test_verification_assigns_invite_code(self):
+        User.objects.create(username='79990000001', phone_number='79990000001',
+                            is_active=False)
+        code = verification.get_store().issue('79990000001')
+        response = self.client.post('/verify/', {'phone_number': '79990000001',
+                                                 'verification_code': code})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        user = User.objects.get(phone_number='79990000001')
+        self.assertEqual(user.invite_code, invite_codes.candidates(user.pk)[0])
+
+
+class InvitedUsersTestCase(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.inviter = User.objects.create(username='79990000000', phone_number='79990000000',
+                                           invite_code='ABC123')
+        for number in range(1, 6):
+            invitee = User.objects.create(username=f'7999000000{number}',
+                                          phone_number=f'7999000000{number}')
+            invitee.activate_invite_code('ABC123', inviter=self.inviter)
+
+    @mock.patch.object(InvitedUsersPagination, 'page_size', 2)
+    def test_cursor_pagination(self):
+        """Страницы обходятся курсором, новые рефералы идут первыми"""
+        response = self.client.get('/profile/79990000000/invited-users/')
+        self.assertEqual(response.data['count'], 5)
+        results = list(response.data['results'])
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            results += response.data['results']
+
+        self.assertEqual(results, [f'7999000000{number}' for number in range(5, 0, -1)])
+
+    def test_first_page_is_cached_until_new_referral(self):
+        self.client.get('/profile/79990000000/invited-users/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/profile/79990000000/invited-users/')
+        self.assertEqual(response.data['count'], 5)
+
+        invitee = User.objects.create(username='79990000009', phone_number='79990000009')
+        with self.captureOnCommitCallbacks(execute=True):
+            invitee.activate_invite_code('ABC123', inviter=self.inviter)
+
+        response = self.client.get('/profile/79990000000/invited-users/')
+        self.assertEqual(response.data['count'], 6)
+        self.assertEqual(response.data['results'][0], '79990000009')
+
+    def test_stale_first_page_is_not_written_back(self):
+        invitee = User.objects.create(username='79990000009', phone_number='79990000009')
+
+        def activate_then_set(*args):
+            # Активация зафиксирована между чтением списка и записью его в кэш
+            with self.captureOnCommitCallbacks(execute=True):
+                invitee.activate_invite_code('ABC123', inviter=self.inviter)
+            set_invited_users_page(*args)
+
+        with mock.patch('users.views.set_invited_users_page', side_effect=activate_then_set):
+            self.assertEqual(self.client.get('/profile/79990000000/invited-users/')
+                             .data['count'], 5)
+        response = self.client.get('/profile/79990000000/invited-users/')
+        self.assertEqual(response.data['count'], 6)
+
+    @override_settings(ALLOWED_HOSTS=['*'])
+    @mock.patch.object(InvitedUsersPagination, 'page_size', 2)
+    def test_cached_first_page_links_follow_request(self):
+        self.client.get('/profile/79990000000/invited-users/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/profile/79990000000/invited-users/',
+                                       HTTP_HOST='api.example.com')
+        self.assertTrue(response.data['next'].startswith(
+            'http://api.example.com/profile/79990000000/invited-users/?cursor='))
+        self.assertEqual(self.client.get(response.data['next']).data['results'],
+                         ['79990000003', '79990000002'])
+
+    def test_unknown_user(self):
+        response = self.client.get('/profile/nobody/invited-users/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ProfileCacheTestCase(APITestCase):
+
+    def setUp(self):
+        caches['profiles'].clear()
+        profile_cache.reset_stats()
+        self.inviter = User.objects.create(username='79990000000', phone_number='79990000000',
+                                           invite_code='ABC123')
+
+    def test_profile_is_read_through_cache(self):
+        """Повторное чтение профиля не обращается к базе данных"""
+        first = self.client.get('/profile/79990000000/')
+        with self.assertNumQueries(0):
+            second = self.client.get('/profile/79990000000/')
+            self.client.get('/ui/profile/79990000000/')
+
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(profile_cache.stats()['hits'], 2)
+        self.assertEqual(profile_cache.stats()['misses'], 1)
+
+    def test_activation_invalidates_inviter_profile(self):
+        self.client.get('/profile/79990000000/')
+        invitee = User.objects.create(username='79990000001', phone_number='79990000001')
+        with self.captureOnCommitCallbacks(execute=True):
+            invitee.activate_invite_code('ABC123', inviter=self.inviter)
+
+        response = self.client.get('/profile/79990000000/')
+        self.assertEqual(response.data['invited_users'], ['79990000001'])
+        self.assertGreaterEqual(profile_cache.stats()['invalidations'], 1)
+
+    def test_verification_invalidates_profile(self):
+        user = User.objects.create(username='79990000001', phone_number='79990000001',
+                                   is_active=False)
+        code = verification.get_store().issue('79990000001')
+        self.assertIsNone(self.client.get('/profile/79990000001/').data['invite_code'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/verify/', {'phone_number': '79990000001',
+                                          'verification_code': code})
+
+        response = self.client.get('/profile/79990000001/')
+        self.assertEqual(response.data['invite_code'], invite_codes.candidates(user.pk)[0])
+
+    def test_missing_profile_is_not_cached(self):
+        self.assertEqual(self.client.get('/profile/nobody/').status_code,
+                         status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get('/ui/profile/nobody/').status_code,
+                         status.HTTP_404_NOT_FOUND)
+
+    def test_stats_require_admin(self):
+        # Без учётных данных — 401 с приглашением предъявить токен доступа
+        response = self.client.get('/profile-cache/stats/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer realm="api"')
+
+        admin = User.objects.create(username='admin', phone_number='admin', is_staff=True)
+        self.client.force_authenticate(admin)
+        response = self.client.get('/profile-cache/stats/')
+        self.assertEqual(set(response.data), {'hits', 'misses', 'invalidations', 'hit_ratio'})
+
+    def test_versions_are_kept_in_shared_cache(self):
+        self.client.get('/profile/79990000000/')
+        self.assertIsNotNone(cache.get(profile_cache.version_key('79990000000')))
+        # Сброс записей кэша профилей не сбрасывает версии
+        caches['profiles'].clear()
+        version = profile_cache.get_version('79990000000')
+        profile_cache.invalidate('79990000000')
+        self.assertGreater(profile_cache.get_version('79990000000'), version)
+
+    def test_deploy_check_warns_about_local_caches(self):
+        warnings = checks.check_shared_caches(None)
+        self.assertEqual({warning.id for warning in warnings}, {'users.W001'})
+        self.assertIn('PROFILE_VERSION_CACHE_ALIAS', warnings[0].msg)
+
+        redis = {'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                 'LOCATION': 'redis://localhost:6379'}
+        with override_settings(CACHES={'default': redis, 'profiles': redis, 'tokens': redis}):
+            self.assertEqual(checks.check_shared_caches(None), [])
+
+
+class ProfileSerializationTestCase(APITestCase):
+
+    def setUp(self):
+        caches['profiles'].clear()
+        self.inviter = User.objects.create(username='79990000000', phone_number='79990000000',
+                                           invite_code='ABC123')
+        for number in range(1, 3):
+            invitee = User.objects.create(username=f'7999000000{number}',
+                                          phone_number=f'7999000000{number}')
+            invitee.activate_invite_code('ABC123', inviter=self.inviter)
+
+    def test_wire_format_matches_model_serializer(self):
+        """Ответ совпадает байт-в-байт с выводом ModelSerializer и JSONRenderer DRF"""
+        expected = JSONRenderer().render(UserProfileSerializer(self.inviter).data)
+        response = self.client.get('/profile/79990000000/')
+        self.assertEqual(response.content, expected)
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    def test_load_profile_reads_only_profile_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = load_profile('79990000000')
+        self.assertEqual(data, UserProfileSerializer(self.inviter).data)
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('password', queries[0]['sql'])
+        self.assertIsNone(load_profile('nobody'))
+
+    def test_renderer_falls_back_to_drf_encoder(self):
+        renderer = FastJSONRenderer()
+        for data in ({'at': timezone.now(), 'count': 1}, {'text': 'a\u2028b'}, None):
+            self.assertEqual(renderer.render(data), JSONRenderer().render(data))
+        indented = renderer.render({'a': 1}, 'application/json; indent=2')
+        self.assertEqual(indented, JSONRenderer().render({'a': 1}, 'application/json; indent=2'))
+
+
+class ProfilePageTestCase(APITestCase):
+
+    def setUp(self):
+        caches['profiles'].clear()
+        self.inviter = User.objects.create(username='79990000000', phone_number='79990000000',
+                                           invite_code='ABC123')
+
+    def test_repeat_view_is_not_modified(self):
+        """Повторный просмотр без изменений: 304 без запросов к базе и рендеринга шаблона"""
+        first = self.client.get('/ui/profile/79990000000/')
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertIn('no-cache', first['Cache-Control'])
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/ui/profile/79990000000/',
+                                       HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertTemplateNotUsed(response, 'users/profile.html')
+
+        response = self.client.get('/ui/profile/79990000000/',
+                                   HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_activation_changes_etag_and_fragment(self):
+        first = self.client.get('/ui/profile/79990000000/')
+        self.assertContains(first, 'Пока никто не активировал')
+        version = profile_cache.get_version('79990000000')
+        self.assertIsNotNone(caches['profiles'].get(make_template_fragment_key(
+            'profile_invited_users', ['79990000000', version])))
+
+        invitee = User.objects.create(username='79990000001', phone_number='79990000001')
+        with self.captureOnCommitCallbacks(execute=True):
+            invitee.activate_invite_code('ABC123', inviter=self.inviter)
+
+        response = self.client.get('/ui/profile/79990000000/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        self.assertContains(response, '<li>79990000001</li>')
+
+    def test_verification_changes_etag(self):
+        user = User.objects.create(username='79990000001', phone_number='79990000001',
+                                   is_active=False)
+        first = self.client.get('/ui/profile/79990000001/')
+        with self.captureOnCommitCallbacks(execute=True):
+            user.verify()
+
+        response = self.client.get('/ui/profile/79990000001/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, user.invite_code)
+
+    def test_missing_profile_has_no_etag(self):
+        response = self.client.get('/ui/profile/nobody/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(response.has_header('ETag'))
+
+
+class ImportPhonesTestCase(APITestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        User.objects.create(username='79990000001', phone_number='79990000001')
+
+    def write(self, name, lines):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as stream:
+            stream.write('\n'.join(lines) + '\n')
+        return path
+
+    def test_csv_import_validates_and_dedupes(self):
+        path = self.write('phones.csv', ['name,phone_number', 'a,79990000001', 'b,79990000002',
+                                         'c,89990000002', 'd,123', 'e,+7 999 000-00-03',
+                                         'f,8 999 000 00 01'])
+        call_command('import_phones', path, chunk_size=2, assign_invite_codes=True,
+                     stdout=StringIO())
+
+        users = dict(User.objects.values_list('phone_number', 'invite_code'))
+        self.assertEqual(set(users), {'79990000001', '79990000002', '79990000003'})
+        self.assertIsNone(users['79990000001'])
+        self.assertIsNotNone(users['79990000002'])
+        self.assertFalse(User.objects.by_phone('79990000003').get().is_active)
+        self.assertEqual(User.objects.by_phone('79990000002').get().phone_key, 79990000002)
+        self.assertFalse(os.path.exists(f'{path}.checkpoint'))
+
+    def test_jsonl_import_resumes_from_checkpoint(self):
+        path = self.write('phones.jsonl', [json.dumps({'phone_number': f'7999000001{number}'})
+                                           for number in range(4)])
+        # Контрольная точка прерванного импорта: первые две записи уже обработаны
+        with open(f'{path}.checkpoint', 'w', encoding='utf-8') as stream:
+            json.dump({'path': os.path.abspath(path), 'position': 2}, stream)
+
+        call_command('import_phones', path, stdout=StringIO())
+
+        self.assertEqual(set(User.objects.filter(phone_number__startswith='7999000001')
+                             .values_list('phone_number', flat=True)),
+                         {'79990000012', '79990000013'})
+
+    def test_conflicting_rows_are_not_counted_as_created(self):
+        """Номер, зарегистрированный через API во время импорта, считается дублем"""
+        path = self.write('phones.csv', ['79990000002', '79990000003'])
+        bulk_create = User.objects.bulk_create
+
+        def register_then_insert(objs, **kwargs):
+            # Регистрация через API между проверкой существующих номеров и вставкой
+            User.objects.create(username='79990000003', phone_number='79990000003')
+            return bulk_create(objs, **kwargs)
+
+        stdout = StringIO()
+        with mock.patch.object(User.objects, 'bulk_create', register_then_insert):
+            call_command('import_phones', path, stdout=stdout)
+        self.assertIn('создано 1, дублей 1', stdout.getvalue())
+
+
+class QueryBudgetMixin:
+    """Проверка бюджета запросов эндпоинта: отдельно чтения и записи"""
+
+    @contextmanager
+    def assertQueryBudget(self, reads, writes):
+        with CaptureQueriesContext(connection) as context:
+            yield
+        # Управление транзакциями не считается обращением к данным
+        statements = [query['sql'].split(None, 1)[0].upper()
+                      for query in context.captured_queries]
+        statements = [verb for verb in statements
+                      if verb not in ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE')]
+        actual_reads = statements.count('SELECT')
+        self.assertEqual((actual_reads, len(statements) - actual_reads), (reads, writes),
+                         '\n'.join(query['sql'] for query in context.captured_queries))
+
+
+@override_settings(SMS_BACKEND='users.sms.LocmemSmsBackend')
+class QueryBudgetTestCase(QueryBudgetMixin, APITestCase):
+    """Каждый эндпоинт изменяет строку пользователя не более чем одним запросом"""
+
+    def setUp(self):
+        caches['profiles'].clear()
+        self.inviter = User.objects.create(username='79990000000', phone_number='79990000000',
+                                           invite_code='ABC123', is_active=True)
+
+    def test_phone_new_user(self):
+        # SELECT пользователя; INSERT пользователя, UPSERT кода и INSERT SMS в очередь
+        with self.assertQueryBudget(reads=1, writes=3):
+            response = self.client.post('/phone/', {'phone_number': '79990000001'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_phone_existing_user(self):
+        User.objects.create(username='79990000001', phone_number='79990000001', is_active=False)
+        # Строка пользователя не изменяется: UPSERT кода и INSERT SMS
+        with self.assertQueryBudget(reads=1, writes=2):
+            response = self.client.post('/phone/', {'phone_number': '79990000001'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        with self.assertQueryBudget(reads=1, writes=0):
+            self.client.post('/phone/', {'phone_number': self.inviter.phone_number})
+
+    def test_verify(self):
+        User.objects.create(username='79990000001', phone_number='79990000001',
+                            is_active=False)
+        code = verification.get_store().issue('79990000001')
+        # Код погашается одним DELETE, активация и инвайт-код — одним условным UPDATE,
+        # в той же транзакции INSERT события в очередь
+        with self.assertQueryBudget(reads=1, writes=3):
+            response = self.client.post('/verify/', {'phone_number': '79990000001',
+                                                     'verification_code': code})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        user = User.objects.get(phone_number='79990000001')
+        self.assertTrue(user.is_active)
+        self.assertIsNotNone(user.invite_code)
+
+    def test_profile(self):
+        with self.assertQueryBudget(reads=2, writes=0):
+            self.client.get('/profile/79990000000/')
+        with self.assertQueryBudget(reads=0, writes=0):
+            self.client.get('/profile/79990000000/')
+
+    def test_activate_invite_code(self):
+        User.objects.create(username='79990000001', phone_number='79990000001')
+        # UPDATE приглашённого, INSERT связи, UPDATE счётчика пригласившего,
+        # UPSERT счётчиков рейтинга и INSERT события в очередь
+        with self.assertQueryBudget(reads=2, writes=5):
+            response = self.client.post('/profile/79990000001/activate-invite-code/',
+                                        {'phone_number': '79990000001',
+                                         'activated_invite_code': 'ABC123'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ConcurrentActivationTestCase(QueryBudgetMixin, TransactionTestCase):
+    """Параллельные активации одного пользователя применяются ровно один раз"""
+    workers = 8
+
+    def setUp(self):
+        self.invitee = User.objects.create(username='79990000000', phone_number='79990000000')
+        self.inviters = [User.objects.create(username=f'7999000001{number}',
+                                             phone_number=f'7999000001{number}',
+                                             invite_code=f'CODE{number:02d}')
+                         for number in range(self.workers)]
+
+    def activate(self, inviter):
+        # Каждый поток работает со своим соединением и своей копией пользователя,
+        # прочитанной до активации, как параллельные запросы к API
+        try:
+            while True:
+                try:
+                    invitee = User.objects.get(pk=self.invitee.pk)
+                    return invitee.activate_invite_code(inviter.invite_code, inviter=inviter)
+                except OperationalError as error:
+                    # SQLite в памяти сообщает о блокировке сразу, а не ждёт её снятия,
+                    # как PostgreSQL или файловая база: повторяем, пока блокировка не снята
+                    if 'locked' not in str(error):
+                        raise
+                    time.sleep(0.001)
+        finally:
+            connections.close_all()
+
+    def test_parallel_activations_apply_once(self):
+        for _ in range(5):
+            User.objects.filter(pk=self.invitee.pk).update(activated_invite_code=None)
+            User.objects.update(invited_count=0)
+            Referral.objects.all().delete()
+            OutboxEvent.objects.all().delete()
+
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                results = list(pool.map(self.activate, self.inviters))
+
+            self.assertEqual(results.count(True), 1)
+            referral = Referral.objects.get()
+            self.assertEqual(self.inviters[results.index(True)], referral.inviter)
+            self.assertEqual(list(User.objects.filter(invited_count__gt=0)
+                                  .values_list('pk', 'invited_count')),
+                             [(referral.inviter_id, 1)])
+            # Событие записано только для применённой активации
+            self.assertEqual([event.payload['inviter_id'] for event in OutboxEvent.objects.all()],
+                             [referral.inviter_id])
+
+    def test_rejected_activation_is_one_round_trip(self):
+        self.invitee.activate_invite_code('CODE00', inviter=self.inviters[0])
+        # Повторная активация отклоняется самим UPDATE, без чтений и лишних запросов
+        with self.assertQueryBudget(reads=0, writes=1):
+            self.assertFalse(self.invitee.activate_invite_code('CODE01',
+                                                               inviter=self.inviters[1]))
+
+
+class VerificationStoreTestsMixin:
+    store_class = None
+
+    def setUp(self):
+        caches['default'].clear()
+        self.store = verification.get_store(self.store_class, ttl=60, max_attempts=3)
+
+    def test_code_is_single_use(self):
+        code = self.store.issue('79990000001')
+        self.assertEqual(self.store.check('79990000001', code), verification.VALID)
+        self.assertEqual(self.store.check('79990000001', code), verification.INVALID)
+
+    def test_new_code_replaces_previous(self):
+        first = self.store.issue('79990000001')
+        second = self.store.issue('79990000001')
+        if first != second:
+            self.assertEqual(self.store.check('79990000001', first), verification.INVALID)
+        self.assertEqual(self.store.check('79990000001', second), verification.VALID)
+
+    def test_attempts_are_limited(self):
+        code = self.store.issue('79990000001')
+        wrong = '0000' if code != '0000' else '1111'
+        self.assertEqual(self.store.check('79990000001', wrong), verification.INVALID)
+        self.assertEqual(self.store.check('79990000001', wrong), verification.INVALID)
+        self.assertEqual(self.store.check('79990000001', wrong), verification.TOO_MANY_ATTEMPTS)
+        self.assertEqual(self.store.check('79990000001', code), verification.INVALID)
+
+
+class DatabaseVerificationStoreTestCase(VerificationStoreTestsMixin, APITestCase):
+    store_class = 'users.verification.DatabaseVerificationStore'
+
+    def test_expired_code_is_rejected_and_purged(self):
+        code = self.store.issue('79990000001')
+        self.store.issue('79990000002')
+        VerificationCode.objects.filter(pk='79990000001').update(
+            expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(self.store.check('79990000001', code), verification.EXPIRED)
+        VerificationCode.objects.filter(pk='79990000002').update(
+            expires_at=timezone.now() - timedelta(seconds=1))
+        self.store.issue('79990000003')
+
+        call_command('purge_verification_codes', stdout=StringIO())
+        self.assertEqual(list(VerificationCode.objects.values_list('pk', flat=True)),
+                         ['79990000003'])
+
+
+    def test_interleaved_wrong_attempts_are_all_counted(self):
+        code = self.store.issue('79990000001')
+        wrong = '0000' if code != '0000' else '1111'
+        stale = VerificationCode.objects.get(pk='79990000001')
+        # Все проверки прочитали запись до того, как любая из них увеличила счётчик
+        with mock.patch('django.db.models.query.QuerySet.first', return_value=stale):
+            results = [self.store.check('79990000001', wrong) for _ in range(3)]
+
+        self.assertEqual(results, [verification.INVALID, verification.INVALID,
+                                   verification.TOO_MANY_ATTEMPTS])
+        self.assertFalse(VerificationCode.objects.filter(pk='79990000001').exists())
+
+
+class CacheVerificationStoreTestCase(VerificationStoreTestsMixin, APITestCase):
+    store_class = 'users.verification.CacheVerificationStore'
+
+    def test_no_database_queries(self):
+        with self.assertNumQueries(0):
+            code = self.store.issue('79990000001')
+            self.store.check('79990000001', code)
+
+
+def throttle_rates(**rates):
+    return override_settings(REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': rates})
+
+
+class ThrottlingTestCase(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        throttling.local_buckets = throttling.LocalBuckets()
+
+    @throttle_rates(sms_phone='2/min')
+    def test_phone_number_bucket(self):
+        for _ in range(2):
+            response = self.client.post('/phone/', {'phone_number': '79990000001'})
+            self.assertIn(response.status_code, (status.HTTP_200_OK, status.HTTP_201_CREATED))
+
+        with self.assertNumQueries(0):
+            response = self.client.post('/phone/', {'phone_number': '79990000001'})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertEqual(OutboundSms.objects.count(), 2)
+
+        # Ведро другого номера не затронуто
+        response = self.client.post('/phone/', {'phone_number': '79990000002'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    @throttle_rates(verify_ip='2/min')
+    def test_ip_bucket(self):
+        for number in ('79990000001', '79990000002'):
+            response = self.client.post('/verify/', {'phone_number': number,
+                                                     'verification_code': '0000'})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        response = self.client.post('/verify/', {'phone_number': '79990000003',
+                                                 'verification_code': '0000'})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        response = self.client.post('/verify/', {'phone_number': '79990000003',
+                                                 'verification_code': '0000'},
+                                    REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @throttle_rates(sms_global='2/min')
+    def test_bucket_refills(self):
+        now = time.time()
+        with mock.patch.object(throttling.TokenBucketThrottle, 'timer', lambda self: now):
+            self.client.post('/phone/', {'phone_number': '79990000001'})
+            self.client.post('/phone/', {'phone_number': '79990000002'})
+            response = self.client.post('/phone/', {'phone_number': '79990000003'})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+        # Через половину периода в ведре появляется ровно один запрос
+        with mock.patch.object(throttling.TokenBucketThrottle, 'timer', lambda self: now + 30):
+            response = self.client.post('/phone/', {'phone_number': '79990000003'})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            response = self.client.post('/phone/', {'phone_number': '79990000004'})
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    @throttle_rates(sms_phone='1/min')
+    def test_local_fallback_when_cache_is_down(self):
+        broken = mock.Mock(get=mock.Mock(side_effect=ConnectionError),
+                           set=mock.Mock(side_effect=ConnectionError))
+        with mock.patch.object(throttling, 'caches', {'default': broken}), \
+                self.assertLogs('users.throttling', 'WARNING'):
+            self.client.post('/phone/', {'phone_number': '79990000001'})
+            response = self.client.post('/phone/', {'phone_number': '79990000001'})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    @throttle_rates(sms_phone='1/min')
+    def test_async_view_shares_buckets(self):
+        self.client.post('/phone/', {'phone_number': '79990000001'})
+        response = self.client.post('/async/phone/', {'phone_number': '79990000001'},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('detail', response.json())
+        self.assertEqual(response['Retry-After'], '60')
+
+    @throttle_rates(sms_phone='1/min')
+    def test_async_view_reads_cache_off_event_loop(self):
+        loops = []
+
+        def cache_get(key):
+            try:
+                loops.append(asyncio.get_running_loop())
+            except RuntimeError:
+                loops.append(None)
+
+        with mock.patch.object(throttling.TokenBucketThrottle, 'cache_get',
+                               staticmethod(cache_get)):
+            self.client.post('/async/phone/', {'phone_number': '79990000001'}, format='json')
+        self.assertEqual(loops, [None])
+
+
+class RequestMetricsTestCase(APITestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+        caches['profiles'].clear()
+        User.objects.create(username='79990000000', phone_number='79990000000',
+                            invite_code='ABC123', is_active=True)
+
+    def test_route_metrics(self):
+        self.client.post('/phone/', {'phone_number': '79990000001'})
+        self.client.get('/profile/79990000000/')
+        self.client.get('/profile/79990000000/')
+
+        body = self.client.get('/metrics/').content.decode()
+        self.assertIn('http_requests_total{route="phone_number",method="POST",status="201"} 1',
+                      body)
+        self.assertIn('http_requests_total{route="user-profile",method="GET",status="200"} 2',
+                      body)
+        # Бюджет запросов phone/ для нового пользователя: SELECT и три записи
+        self.assertIn('http_request_db_queries_sum{route="phone_number"} 4', body)
+        # Второй запрос профиля обслужен из кэша
+        self.assertIn('http_request_db_queries_bucket{route="user-profile",le="0"} 1', body)
+        self.assertIn('http_request_duration_seconds_count{route="user-profile"} 2', body)
+
+    def test_async_view_queries_are_counted(self):
+        self.client.get('/async/profile/79990000000/')
+        self.assertIn('http_request_db_queries_sum{route="user-profile-async"} 2',
+                      metrics.registry.render())
+
+    def test_structured_log(self):
+        with self.assertLogs('users.metrics', 'INFO') as logs:
+            self.client.get('/profile/79990000000/')
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertEqual((entry['route'], entry['status'], entry['queries']),
+                         ('user-profile', 200, 2))
+
+    def test_streaming_response_is_recorded_when_consumed(self):
+        """Запросы к базе, которые выполняет генератор тела ответа, тоже учитываются"""
+        admin = User.objects.create(username='admin', phone_number='admin', is_staff=True)
+        self.client.force_authenticate(admin)
+        with self.assertLogs('users.metrics', 'INFO') as logs:
+            response = self.client.post('/profiles/lookup/',
+                                        {'usernames': ['79990000000', 'nobody']}, format='json')
+            content = b''.join(response.streaming_content)
+        [record] = logs.records
+        entry = json.loads(record.getMessage())
+        self.assertEqual((entry['route'], entry['queries'], entry['bytes']),
+                         ('profile-lookup', 1, len(content)))
+
+    @override_settings(METRICS_SAMPLE_RATE=0)
+    def test_sampling(self):
+        self.client.get('/profile/79990000000/')
+        body = metrics.registry.render()
+        self.assertIn('http_requests_total{route="user-profile",method="GET",status="200"} 1',
+                      body)
+        self.assertNotIn('http_request_duration_seconds_count', body)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token(self):
+        self.assertEqual(self.client.get('/metrics/').status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+        response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ReferralTreeTestCase(APITestCase):
+    """Дерево: R -> A, R -> B, A -> C, C -> D"""
+
+    def setUp(self):
+        self.users = {name: User.objects.create(username=f'7999000000{index}',
+                                                phone_number=f'7999000000{index}',
+                                                invite_code=f'CODE0{index}')
+                      for index, name in enumerate('RABCD')}
+
+    def activate(self, inviter, invitee):
+        self.assertTrue(self.users[invitee].activate_invite_code(
+            self.users[inviter].invite_code))
+
+    def build_tree(self):
+        # C приглашает D раньше, чем сам активирует код A: нижняя линия C переносится
+        for inviter, invitee in (('R', 'A'), ('C', 'D'), ('A', 'C'), ('R', 'B')):
+            self.activate(inviter, invitee)
+
+    expected = {'depth': 3, 'total': 4, 'levels': [{'level': 1, 'count': 2},
+                                                   {'level': 2, 'count': 1},
+                                                   {'level': 3, 'count': 1}]}
+
+    def test_recursive_query(self):
+        self.build_tree()
+        with self.assertNumQueries(1):
+            stats = referral_tree.downline_stats(self.users['R'].pk)
+        self.assertEqual(stats, self.expected)
+        self.assertEqual(referral_tree.downline_stats(self.users['R'].pk, max_depth=2)['total'],
+                         3)
+        self.assertEqual(referral_tree.downline_stats(self.users['B'].pk)['total'], 0)
+
+    @override_settings(REFERRAL_CLOSURE_ENABLED=True)
+    def test_closure_is_maintained_on_activation(self):
+        self.build_tree()
+        self.assertEqual(referral_tree.downline_stats(self.users['R'].pk), self.expected)
+        self.assertEqual(referral_tree.downline_stats(self.users['A'].pk)['levels'],
+                         [{'level': 1, 'count': 1}, {'level': 2, 'count': 1}])
+
+        maintained = set(ReferralClosure.objects.values_list('ancestor', 'descendant', 'depth'))
+        call_command('rebuild_referral_closure', stdout=StringIO())
+        self.assertEqual(
+            set(ReferralClosure.objects.values_list('ancestor', 'descendant', 'depth')),
+            maintained)
+
+    @override_settings(REFERRAL_CLOSURE_ENABLED=True)
+    def test_link_locks_inviter_path_first(self):
+        self.activate('R', 'A')
+        self.activate('A', 'C')
+        with CaptureQueriesContext(connection) as queries:
+            referral_tree.link(self.users['C'].pk, self.users['D'].pk)
+        # Сначала блокируется путь пригласившего до корня, затем вставляются пути
+        self.assertIn('"users_user"', queries[0]['sql'])
+        self.assertTrue(queries[-1]['sql'].lstrip().startswith('INSERT'))
+        self.assertEqual(referral_tree.lock_path(self.users['C'].pk),
+                         sorted(self.users[name].pk for name in 'RAC'))
+
+    @override_settings(REFERRAL_CLOSURE_ENABLED=True)
+    def test_cycle(self):
+        # R и A пригласили друг друга: обход не зацикливается
+        self.activate('R', 'A')
+        self.activate('A', 'R')
+        for use_closure in (False, True):
+            self.assertEqual(
+                referral_tree.downline_stats(self.users['R'].pk, use_closure=use_closure),
+                {'depth': 1, 'total': 1, 'levels': [{'level': 1, 'count': 1}]})
+
+    def test_endpoint(self):
+        self.build_tree()
+        response = self.client.get(f"/profile/{self.users['R'].username}/downline/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), self.expected)
+        response = self.client.get('/profile/nobody/downline/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class LeaderboardTestCase(APITestCase):
+
+    def setUp(self):
+        self.inviters = [User.objects.create(username=f'7999000000{index}',
+                                             phone_number=f'7999000000{index}',
+                                             invite_code=f'CODE0{index}')
+                         for index in range(3)]
+        self.invitees = iter(User.objects.create(username=f'7999100000{index}',
+                                                 phone_number=f'7999100000{index}')
+                             for index in range(10))
+
+    def invite(self, inviter, times=1):
+        for _ in range(times):
+            self.assertTrue(next(self.invitees).activate_invite_code(inviter.invite_code))
+
+    def test_counters_are_incremental(self):
+        self.invite(self.inviters[1], 3)
+        self.invite(self.inviters[2], 1)
+        self.invite(self.inviters[0], 2)
+
+        expected = [('7999*****01', 3), ('7999*****00', 2), ('7999*****02', 1)]
+        for period in leaderboard.PERIODS:
+            with self.assertNumQueries(1):
+                start, results = leaderboard.top(period)
+            self.assertEqual([(row['user'], row['invited_count']) for row in results],
+                             expected)
+        self.assertEqual(leaderboard.top('all', limit=1)[1][0]['rank'], 1)
+        self.assertEqual(len(leaderboard.top('all', limit=2)[1]), 2)
+
+    def test_previous_periods_are_not_counted(self):
+        self.invite(self.inviters[0], 2)
+        Referral.objects.filter(invitee__username='79991000000').update(
+            activated_at=timezone.now() - timedelta(days=40))
+        call_command('reconcile_leaderboard', '--days', '45', stdout=StringIO())
+
+        self.assertEqual(leaderboard.top('month')[1][0]['invited_count'], 1)
+        self.assertEqual(leaderboard.top('all')[1][0]['invited_count'], 2)
+        last_month = timezone.localdate() - timedelta(days=40)
+        self.assertEqual(leaderboard.top('month', day=last_month)[1][0]['invited_count'], 1)
+
+    def test_reconciliation_fixes_drift(self):
+        self.invite(self.inviters[0], 2)
+        User.objects.filter(pk=self.inviters[0].pk).update(invited_count=7)
+        LeaderboardCounter.objects.filter(period='day').update(count=7)
+        Referral.objects.filter(inviter=self.inviters[0]).first().delete()
+
+        stdout = StringIO()
+        call_command('reconcile_leaderboard', stdout=stdout)
+        self.assertIn('исправлено общих счётчиков: 1', stdout.getvalue())
+        for period in leaderboard.PERIODS:
+            self.assertEqual(leaderboard.top(period)[1][0]['invited_count'], 1)
+
+    def test_reconciliation_keeps_consistent_counters(self):
+        """Совпадающие счётчики не переписываются, счётчики без рефералов удаляются"""
+        self.invite(self.inviters[0], 2)
+        self.invite(self.inviters[1])
+        Referral.objects.filter(inviter=self.inviters[1]).delete()
+        counter_ids = set(LeaderboardCounter.objects.filter(user=self.inviters[0])
+                          .values_list('pk', flat=True))
+
+        self.assertEqual(leaderboard.reconcile(), 1)
+        self.assertEqual(set(LeaderboardCounter.objects.values_list('pk', flat=True)),
+                         counter_ids)
+        self.assertEqual(leaderboard.reconcile(), 0)
+
+    def test_endpoint(self):
+        self.invite(self.inviters[0])
+        response = self.client.get('/leaderboard/', {'period': 'week', 'limit': 5})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [
+            {'rank': 1, 'user': '7999*****00', 'invited_count': 1}])
+        self.assertNotIn(self.inviters[0].phone_number, response.content.decode())
+        self.assertEqual([phones.mask(value) for value in ('admin', 'superuser')],
+                         ['*****', 'supe***er'])
+        self.assertIsNotNone(response.data['period_start'])
+
+        for params in ({'period': 'year'}, {'limit': 0}, {'limit': 'x'}):
+            response = self.client.get('/leaderboard/', params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ProfileLookupTestCase(APITestCase):
+
+    def setUp(self):
+        self.client.force_authenticate(User.objects.create(
+            username='admin', phone_number='70000000000', is_staff=True))
+        inviter = User.objects.create(username='79990000000', phone_number='79990000000',
+                                      invite_code='ABC123')
+        for number in ('79990000001', '79990000002'):
+            User.objects.create(username=number, phone_number=number).activate_invite_code(
+                'ABC123', inviter=inviter)
+
+    def lookup(self, usernames):
+        response = self.client.post('/profiles/lookup/', {'usernames': usernames},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return b''.join(response.streaming_content).decode().splitlines()
+
+    def test_lookup(self):
+        lines = self.lookup(['79990000001', 'nobody', '79990000000'])
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'username': '79990000001', 'phone_number': '79990000001', 'invite_code': None,
+             'activated_invite_code': 'ABC123', 'invited_count': 0},
+            {'username': 'nobody', 'error': 'not_found'},
+            {'username': '79990000000', 'phone_number': '79990000000', 'invite_code': 'ABC123',
+             'activated_invite_code': None, 'invited_count': 2},
+        ])
+
+    def test_one_query_per_chunk(self):
+        usernames = ['79990000000', '79990000001', '79990000002']
+        with mock.patch('users.views.ProfileLookupView.chunk_size', 2), \
+                self.assertNumQueries(2):
+            self.assertEqual(len(self.lookup(usernames)), 3)
+
+    @override_settings(PROFILE_LOOKUP_MAX_BATCH=2)
+    def test_validation_and_permissions(self):
+        for usernames in ([], ['79990000000', '79990000001', '79990000002']):
+            response = self.client.post('/profiles/lookup/', {'usernames': usernames},
+                                        format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.client.force_authenticate(User.objects.get(username='79990000000'))
+        response = self.client.post('/profiles/lookup/', {'usernames': ['79990000000']},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+
+@override_settings(EXPORT_LAG=0)
+class ExportReferralsTestCase(APITestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        inviter = User.objects.create(username='79990000000', phone_number='79990000000',
+                                      invite_code='ABC123')
+        User.objects.create(username='79990000001', phone_number='79990000001') \
+            .activate_invite_code('ABC123', inviter=inviter)
+
+    def export(self, *args):
+        call_command('export_referrals', self.directory, *args, stdout=StringIO())
+
+    def read(self, prefix):
+        """Читает и удаляет файл выгрузки, возвращает строки"""
+        path, = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                 if name.startswith(prefix)]
+        with gzip.open(path, 'rt', encoding='utf-8') as stream:
+            lines = stream.read().splitlines()
+        os.remove(path)
+        return lines
+
+    def test_csv_export(self):
+        self.export('--chunk-size', '1')
+        users = list(csv.DictReader(self.read('users-')))
+        self.assertEqual([row['phone_number'] for row in users], ['79990000000', '79990000001'])
+        self.assertEqual(users[1]['activated_invite_code'], 'ABC123')
+        referrals = list(csv.DictReader(self.read('referrals-')))
+        self.assertEqual([(row['inviter_phone_number'], row['invitee_phone_number'])
+                          for row in referrals], [('79990000000', '79990000001')])
+
+    def test_incremental_jsonl_export(self):
+        self.export('--format', 'jsonl')
+        self.assertEqual(len(self.read('users-')), 2)
+        self.assertEqual(len(self.read('referrals-')), 1)
+
+        # Следующая выгрузка содержит только записи после отметки прошлой
+        User.objects.create(username='79990000002', phone_number='79990000002') \
+            .activate_invite_code('ABC123')
+        self.export('--format', 'jsonl')
+        self.assertEqual([json.loads(line)['phone_number'] for line in self.read('users-')],
+                         ['79990000002'])
+        self.assertEqual([json.loads(line)['invitee_phone_number']
+                          for line in self.read('referrals-')], ['79990000002'])
+
+        self.export('--format', 'jsonl', '--full')
+        self.assertEqual(len(self.read('users-')), 3)
+
+    @override_settings(EXPORT_LAG=60)
+    def test_late_commit_is_exported(self):
+        started = timezone.now()
+        self.export('--format', 'jsonl')
+        self.read('users-')
+        self.read('referrals-')
+
+        # Запись с моментом до выгрузки, транзакция которой закоммичена после неё
+        User.objects.create(username='79990000002', phone_number='79990000002',
+                            date_joined=started - timedelta(seconds=30))
+        with mock.patch('django.utils.timezone.now',
+                        return_value=started + timedelta(minutes=5)):
+            self.export('--format', 'jsonl')
+        self.assertIn('79990000002', [json.loads(line)['phone_number']
+                                      for line in self.read('users-')])
+
+
+class PhoneNumberTestCase(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        caches['profiles'].clear()
+
+    def test_normalize(self):
+        """Разные записи одного номера приводятся к одной канонической"""
+        for value in ('+7 (999) 000-00-00', '8 999 000 00 00', '0079990000000',
+                      '9990000000', ' 79990000000 '):
+            self.assertEqual(phones.normalize(value), '79990000000')
+        self.assertEqual(phones.to_key('+44 20 7946 0958'), 442079460958)
+        for value in ('', '+7 999 abc', '1' * 16, '+123456', '+0999000000000'):
+            with self.assertRaises(phones.InvalidPhoneNumber):
+                phones.normalize(value)
+        self.assertIsNone(phones.key_or_none('admin'))
+
+    def test_api_resolves_any_notation_to_one_user(self):
+        response = self.client.post('/phone/', {'phone_number': '+7 (999) 000-00-00'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post('/phone/', {'phone_number': '89990000000'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        user = User.objects.get()
+        self.assertEqual((user.username, user.phone_number, user.phone_key),
+                         ('79990000000', '79990000000', 79990000000))
+        response = self.client.post('/verify/', {'phone_number': '9990000000',
+                                                 'verification_code':
+                                                     response.data['verification_code']})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/profile/+79990000000/').data['phone_number'],
+                         '79990000000')
+
+    def test_invalid_number_is_rejected(self):
+        response = self.client.post('/phone/', {'phone_number': '+7 999 abc'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('phone_number', response.data)
+        self.assertEqual(self.client.get('/profile/admin/').status_code,
+                         status.HTTP_404_NOT_FOUND)
+
+    def test_phone_key_is_unique(self):
+        User.objects.create(username='79990000000', phone_number='79990000000')
+        with self.assertRaises(IntegrityError):
+            User.objects.create(username='89990000000', phone_number='89990000000')
+
+
+class PhoneKeyMigrationTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.executor = MigrationExecutor(connection)
+        self.executor.migrate([('users', '0011_leaderboard')])
+        self.addCleanup(call_command, 'migrate', verbosity=0)
+
+    def test_migration_merges_duplicates(self):
+        old_apps = self.executor.loader.project_state([('users', '0011_leaderboard')]).apps
+        OldUser = old_apps.get_model('users', 'User')
+        OldReferral = old_apps.get_model('users', 'Referral')
+        inviter = OldUser.objects.create(username='79990000009', phone_number='79990000009',
+                                         invite_code='ABC123')
+        first = OldUser.objects.create(username='+7 999 000 00 00',
+                                       phone_number='+7 999 000 00 00', invite_code='DEF456',
+                                       is_active=False)
+        second = OldUser.objects.create(username='89990000000', phone_number='89990000000',
+                                        is_active=True, activated_invite_code='ABC123')
+        invitee = OldUser.objects.create(username='79990000001', phone_number='79990000001',
+                                         activated_invite_code='DEF456')
+        OldReferral.objects.create(inviter=inviter, invitee=second)
+        OldReferral.objects.create(inviter=first, invitee=invitee)
+        service = OldUser.objects.create(username='admin', phone_number='')
+
+        executor = MigrationExecutor(connection)
+        executor.migrate([('users', '0012_user_phone_key')])
+
+        self.assertFalse(User.objects.filter(pk=first.pk).exists())
+        merged = User.objects.get(pk=second.pk)
+        self.assertEqual((merged.username, merged.phone_number, merged.phone_key),
+                         ('79990000000', '79990000000', 79990000000))
+        self.assertEqual((merged.invite_code, merged.activated_invite_code, merged.invited_count),
+                         ('DEF456', 'ABC123', 1))
+        self.assertEqual(Referral.objects.get(invitee_id=invitee.pk).inviter_id, merged.pk)
+        self.assertEqual(Referral.objects.get(invitee_id=merged.pk).inviter_id, inviter.pk)
+        self.assertIsNone(User.objects.get(pk=service.pk).phone_key)
+
+
+class TokenAuthTestCase(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        caches[settings.TOKEN_CACHE_ALIAS].clear()
+        self.inviter = User.objects.create(username='79990000000', phone_number='79990000000',
+                                           invite_code='ABC123')
+        self.user = User.objects.create(username='79990000001', phone_number='79990000001',
+                                        is_active=False)
+        code = verification.get_store().issue('79990000001')
+        response = self.client.post('/verify/', {'phone_number': '79990000001',
+                                                 'verification_code': code})
+        self.assertEqual(response.data['token_type'], 'Bearer')
+        self.access, self.refresh = response.data['access'], response.data['refresh']
+
+    def activate(self, access=None, **data):
+        if access:
+            self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+        return self.client.post('/profile/79990000001/activate-invite-code/',
+                                {'activated_invite_code': 'ABC123', **data})
+
+    def test_authentication_reads_neither_database_nor_session(self):
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {self.access}')
+        with self.assertNumQueries(0):
+            user, token = SignedTokenAuthentication().authenticate(request)
+        self.assertEqual((user.pk, user.phone_number), (self.user.pk, '79990000001'))
+        self.assertEqual(token.kind, tokens.ACCESS)
+
+    def test_activation_uses_token_identity(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.activate(self.access)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Пользователь не загружается: его строку меняет только условный UPDATE
+        self.assertFalse([query for query in queries
+                          if query['sql'].startswith('SELECT') and
+                          '"users_user"."phone_key" =' in query['sql']])
+        self.assertEqual(User.objects.get(pk=self.user.pk).activated_invite_code, 'ABC123')
+
+    def test_activation_rejects_foreign_phone_number(self):
+        response = self.activate(self.access, phone_number='79990000009')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(INVITE_ACTIVATION_REQUIRES_TOKEN=True)
+    def test_activation_can_require_token(self):
+        response = self.activate(phone_number='79990000001')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.activate(self.access).status_code, status.HTTP_200_OK)
+
+    def test_invalid_and_expired_tokens_are_rejected(self):
+        for access in (self.access[:-2], self.refresh):
+            self.assertEqual(self.activate(access).status_code, status.HTTP_401_UNAUTHORIZED)
+        with override_settings(ACCESS_TOKEN_TTL=0):
+            response = self.activate(self.access)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response.data['detail'], "Срок действия токена истёк.")
+
+    def test_refresh_rotates_tokens(self):
+        response = self.client.post('/token/refresh/', {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.data['refresh'], self.refresh)
+        self.assertEqual(self.activate(response.data['access']).status_code, status.HTTP_200_OK)
+
+        # Токен обновления одноразовый
+        response = self.client.post('/token/refresh/', {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_refresh_token_redeemed_once(self):
+        """Два запроса, одновременно прошедшие проверку отзыва, не получают две пары"""
+        with mock.patch.object(tokens, 'check', side_effect=tokens.decode):
+            tokens.refresh(self.refresh)
+            with self.assertRaisesMessage(tokens.InvalidToken, "Токен отозван."):
+                tokens.refresh(self.refresh)
+
+    def test_revoke(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access}')
+        response = self.client.post('/token/revoke/', {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        self.assertEqual(self.activate(self.access).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.client.credentials()
+        response = self.client.post('/token/refresh/', {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_revoke_user(self):
+        tokens.revoke_user(self.user.pk)
+        with self.assertRaises(tokens.InvalidToken):
+            tokens.check(self.access, tokens.ACCESS)
+        tokens.check(tokens.issue(self.user, tokens.ACCESS), tokens.ACCESS)
+
+    def test_revocation_survives_default_cache_culling(self):
+        tokens.revoke(tokens.decode(self.access, tokens.ACCESS))
+        cache.set_many({f'filler:{index}': index for index in range(1000)})
+        with self.assertRaisesMessage(tokens.InvalidToken, "Токен отозван."):
+            tokens.check(self.access, tokens.ACCESS)
+
+    def test_async_activation_checks_token_off_event_loop(self):
+        loops = []
+
+        def check(value, kind):
+            try:
+                loops.append(asyncio.get_running_loop())
+            except RuntimeError:
+                loops.append(None)
+            return tokens.decode(value, kind)
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access}')
+        with mock.patch.object(tokens, 'check', side_effect=check):
+            response = self.client.post('/async/profile/79990000001/activate-invite-code/',
+                                        {'phone_number': '79990000001',
+                                         'activated_invite_code': 'ABC123'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(loops, [None])
+
+
+class OpenApiSchemaTestCase(APITestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'openapi.json')
+        settings_override = override_settings(OPENAPI_SCHEMA_PATH=self.path)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_generated_schema_served_compressed_with_etag(self):
+        call_command('generate_openapi_schema', stdout=StringIO())
+        with open(self.path, 'rb') as stream:
+            content = stream.read()
+        self.assertIn('/profile/{username}/', json.loads(content)['paths'])
+
+        response = self.client.get('/openapi.json', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(response.content), content)
+
+        response = self.client.get('/openapi.json', HTTP_ACCEPT_ENCODING='gzip',
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Без gzip отдаётся исходный файл, у другого представления другой ETag
+        plain = self.client.get('/openapi.json')
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertEqual(plain.content, content)
+        self.assertNotEqual(plain['ETag'], response['ETag'])
+
+    def test_schema_generated_without_warnings(self):
+        # У всех представлений есть сериализаторы ответов: drf_yasg не падает на них
+        with self.assertNoLogs('drf_yasg', 'WARNING'):
+            paths = json.loads(docs.generate_schema())['paths']
+        results = paths['/leaderboard/']['get']['responses']['200']['schema']
+        self.assertEqual(results['$ref'], '#/definitions/Leaderboard')
+
+    def test_regenerated_schema_reloaded(self):
+        schema.write(self.path, b'{"paths": {}}')
+        etag = self.client.get('/openapi.json')['ETag']
+
+        schema.write(self.path, b'{"paths": {"/new/": {}}}')
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        response = self.client.get('/openapi.json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), {'paths': {'/new/': {}}})
+
+    def test_missing_schema_generated_on_request(self):
+        with self.assertLogs('referral_system.schema', 'WARNING'):
+            response = self.client.get('/openapi.json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('/verify/', json.loads(response.content)['paths'])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_docs_loaded_lazily(self):
+        # Загрузка URLconf в чистом процессе не импортирует генератор схемы drf_yasg
+        code = ('import sys, django; django.setup()\n'
+                'from django.urls import get_resolver; get_resolver().url_patterns\n'
+                'print(sorted(name for name in sys.modules if name.startswith("drf_yasg.")))')
+        environ = dict(os.environ, DJANGO_SETTINGS_MODULE='referral_system.settings')
+        output = subprocess.run([sys.executable, '-c', code], env=environ, check=True,
+                                capture_output=True, text=True).stdout
+        self.assertNotIn('drf_yasg.views', output)
+        self.assertNotIn('drf_yasg.generators', output)
+
+        # Страницы документации загружают заранее сгенерированную схему
+        for url in ('/swagger/', '/redoc/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertIn('/openapi.json', response.content.decode())
+
+
+@override_settings(SMS_BACKEND='users.sms.LocmemSmsBackend', EVENTS_RETRY_DELAY=0,
+                   EVENTS_MAX_ATTEMPTS=3)
+class OutboxEventTestCase(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        events.delivered.clear()
+        self.inviter = User.objects.create(username='79990000000', phone_number='79990000000',
+                                           invite_code='ABC123', is_active=True)
+        self.user = User.objects.create(username='79990000001', phone_number='79990000001')
+
+    def record(self, count):
+        return [events.record(OutboxEvent.USER_VERIFIED, user_id=number) for number in range(count)]
+
+    def test_events_recorded_with_changes(self):
+        code = verification.get_store().issue('79990000001')
+        self.client.post('/verify/', {'phone_number': '79990000001', 'verification_code': code})
+        self.client.post('/profile/79990000001/activate-invite-code/',
+                         {'phone_number': '79990000001', 'activated_invite_code': 'ABC123'})
+
+        verified, activated = OutboxEvent.objects.order_by('pk')
+        self.user.refresh_from_db()
+        self.assertEqual((verified.event_type, verified.payload),
+                         (OutboxEvent.USER_VERIFIED,
+                          {'user_id': self.user.pk, 'phone_number': '79990000001',
+                           'invite_code': self.user.invite_code}))
+        self.assertEqual(activated.event_type, OutboxEvent.INVITE_CODE_ACTIVATED)
+        self.assertEqual(activated.payload['inviter_id'], self.inviter.pk)
+        self.assertEqual(activated.payload['invitee_phone_number'], '79990000001')
+
+    def test_event_rolled_back_with_change(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            self.user.activate_invite_code('ABC123', inviter=self.inviter)
+            raise RuntimeError
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertFalse(Referral.objects.exists())
+
+    def test_concurrent_delivery_over_http(self):
+        recorded = self.record(6)
+        with LocalWebhookServer(delay=0.05) as server, \
+                ThreadPoolExecutor(max_workers=6) as executor:
+            backend = events.WebhookEventBackend(url=server.url, secret='secret')
+            started = time.perf_counter()
+            result = events.dispatch_batch(batch_size=10, backend=backend, executor=executor)
+            elapsed = time.perf_counter() - started
+        self.assertEqual(result, events.DispatchResult(claimed=6, delivered=6, failed=0))
+        # Отправки идут параллельно: меньше суммы задержек приёмника
+        self.assertLess(elapsed, 6 * 0.05)
+
+        self.assertEqual(sorted(request['body']['id'] for request in server.received),
+                         [event.pk for event in recorded])
+        request = server.received[0]
+        self.assertEqual(request['headers']['Idempotency-Key'], str(request['body']['id']))
+        self.assertTrue(request['headers']['X-Signature'].startswith('sha256='))
+        self.assertEqual(request['body']['type'], OutboxEvent.USER_VERIFIED)
+        self.assertFalse(OutboxEvent.objects.exclude(status=OutboxEvent.STATUS_SENT).exists())
+
+    def test_failed_delivery_retried(self):
+        event, = self.record(1)
+        with LocalWebhookServer(fail_first=2) as server:
+            backend = events.WebhookEventBackend(url=server.url)
+            with self.assertLogs('users.events', 'WARNING'):
+                results = [events.dispatch_batch(backend=backend) for _ in range(4)]
+        self.assertEqual([result.delivered for result in results], [0, 0, 1, 0])
+        event.refresh_from_db()
+        self.assertEqual((event.status, event.attempts), (OutboxEvent.STATUS_SENT, 3))
+        self.assertIn('503', event.last_error)
+        self.assertEqual(len(server.received), 1)
+
+    def test_delivery_gives_up_after_max_attempts(self):
+        event, = self.record(1)
+        with LocalWebhookServer(fail_first=10) as server:
+            backend = events.WebhookEventBackend(url=server.url)
+            with self.assertLogs('users.events', 'WARNING'):
+                results = [events.dispatch_batch(backend=backend) for _ in range(4)]
+        self.assertEqual([result.failed for result in results], [1, 1, 1, 0])
+        event.refresh_from_db()
+        self.assertEqual((event.status, event.attempts), (OutboxEvent.STATUS_FAILED, 3))
+
+    @override_settings(EVENTS_RETRY_DELAY=1, EVENTS_RETRY_MAX_DELAY=8)
+    def test_retry_delay_grows_exponentially(self):
+        for attempts, (low, high) in {1: (0.5, 1), 2: (1, 2), 3: (2, 4), 10: (4, 8)}.items():
+            self.assertTrue(low <= events.retry_delay(attempts) <= high)
+
+    def test_claimed_events_redelivered_after_lease(self):
+        self.record(2)
+        self.assertEqual(len(events.claim_batch(10)), 2)
+        # Пока срок не истёк, события не достаются другим воркерам
+        self.assertEqual(events.claim_batch(10), [])
+
+        # Воркер упал, не отметив результат: после срока события отправляются снова
+        OutboxEvent.objects.update(available_at=timezone.now())
+        result = events.dispatch_batch(backend=events.LocmemEventBackend())
+        self.assertEqual(result.delivered, 2)
+        self.assertEqual(len(events.delivered), 2)
+
+    @override_settings(EVENTS_BACKEND='users.events.LocmemEventBackend')
+    def test_worker_and_metrics(self):
+        self.record(3)
+        OutboxEvent.objects.filter(pk=OutboxEvent.objects.earliest('pk').pk).update(
+            status=OutboxEvent.STATUS_FAILED)
+        response = self.client.get('/metrics/')
+        self.assertIn('outbox_events{status="pending"} 2', response.content.decode())
+        self.assertIn('outbox_events{status="failed"} 1', response.content.decode())
+
+        stdout = StringIO()
+        call_command('events_worker', '--once', '--concurrency', '2', stdout=stdout)
+        self.assertIn('Доставлено событий: 2', stdout.getvalue())
+
+        content = self.client.get('/metrics/').content.decode()
+        self.assertIn('outbox_events{status="pending"} 0', content)
+        self.assertIn('outbox_lag_seconds 0.0', content)
+        self.assertIn('outbox_delivery_lag_seconds_count 2', content)
+
+
+REPLICA = 'replica_lagging'
+
+
+@override_settings(SMS_BACKEND='users.sms.LocmemSmsBackend', DATABASE_REPLICAS=[REPLICA],
+                   REPLICA_PIN_SECONDS=60)
+class ReplicaRoutingTestCase(TransactionTestCase):
+    """
+    Реплика — отдельная тестовая база того же движка, что и default (SQLite или
+    PostgreSQL). Данные в неё копируются только вызовом replicate(), между вызовами
+    она отстаёт от основной базы. Псевдоним регистрируется в setUpClass: проверки
+    тестового раннера выполняются до него и о реплике не знают.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        primary = connections['default'].settings_dict
+        replica = dict(primary, TEST={})
+        if connections['default'].vendor == 'sqlite':
+            replica['NAME'] = ':memory:'
+        else:
+            replica['TEST'] = {'NAME': f"{primary['NAME']}_replica"}
+        replica = connections.configure_settings({'default': primary, REPLICA: replica})[REPLICA]
+        settings.DATABASES[REPLICA] = connections.settings[REPLICA] = replica
+        connections[REPLICA].creation.create_test_db(verbosity=0, autoclobber=True,
+                                                     serialize=False)
+        cls.databases = {'default', REPLICA}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections[REPLICA].creation.destroy_test_db(
+            connections[REPLICA].settings_dict['NAME'], verbosity=0)
+        del connections[REPLICA]
+        # connections.settings — это и есть settings.DATABASES
+        connections.settings.pop(REPLICA, None)
+        settings.DATABASES.pop(REPLICA, None)
+
+    def setUp(self):
+        self.inviter = User.objects.create(username='79990000000', phone_number='79990000000',
+                                           invite_code='ABC123', is_active=True)
+        self.user = User.objects.create(username='79990000001', phone_number='79990000001')
+        self.replicate()
+        # Окно закрепления после создания пользователей прошло
+        cache.clear()
+        caches['profiles'].clear()
+
+    def replicate(self):
+        """Реплика догоняет основную базу"""
+        Referral.objects.using(REPLICA).all().delete()
+        User.objects.using(REPLICA).all().delete()
+        for model in (User, Referral):
+            model.objects.using(REPLICA).bulk_create(model.objects.using('default').all())
+
+    def profile(self, phone_number):
+        caches['profiles'].clear()
+        return self.client.get(f'/profile/{phone_number}/').json()
+
+    def test_routing(self):
+        self.assertEqual(User.objects.all().db, 'default')
+        with replicas.reading('79990000001') as alias:
+            self.assertEqual(alias, REPLICA)
+            self.assertEqual(User.objects.all().db, REPLICA)
+            user = User.objects.get(phone_number='79990000001')
+        self.assertEqual(user._state.db, REPLICA)
+
+        # Объект, прочитанный с реплики, записывается в основную базу
+        user.first_name = 'Иван'
+        user.save()
+        self.assertEqual(User.objects.get(pk=user.pk).first_name, 'Иван')
+        self.assertEqual(User.objects.using(REPLICA).get(pk=user.pk).first_name, '')
+
+        # Изменённый профиль закреплён за основной базой
+        with replicas.reading('79990000001') as alias:
+            self.assertIsNone(alias)
+            self.assertEqual(User.objects.all().db, 'default')
+
+    def test_verified_user_sees_new_invite_code(self):
+        code = verification.get_store().issue('79990000001')
+        response = self.client.post('/verify/', {'phone_number': '79990000001',
+                                                 'verification_code': code})
+        invite_code = User.objects.get(pk=self.user.pk).invite_code
+        self.assertIn(invite_code, response.json()['message'])
+        # Реплика ещё не получила инвайт-код, профиль читается из основной базы
+        self.assertIsNone(User.objects.using(REPLICA).get(pk=self.user.pk).invite_code)
+        self.assertEqual(self.profile('79990000001')['invite_code'], invite_code)
+
+        # После окна закрепления профиль снова читается с реплики
+        cache.delete(replicas.pin_key('79990000001'))
+        self.assertIsNone(self.profile('79990000001')['invite_code'])
+        self.replicate()
+        self.assertEqual(self.profile('79990000001')['invite_code'], invite_code)
+
+    def test_inviter_sees_new_invitee(self):
+        self.client.post('/profile/79990000001/activate-invite-code/',
+                         {'phone_number': '79990000001', 'activated_invite_code': 'ABC123'})
+        self.assertFalse(Referral.objects.using(REPLICA).exists())
+
+        self.assertEqual(self.profile('79990000000')['invited_users'], ['79990000001'])
+        self.assertEqual(self.client.get('/profile/79990000000/invited-users/').json()['results'],
+                         ['79990000001'])
+        self.assertEqual(self.profile('79990000001')['activated_invite_code'], 'ABC123')
+
+    async def test_async_profile_reads_replica(self):
+        # Изменение в обход модели: профиль не закреплён, реплика отстаёт
+        await User.objects.filter(pk=self.user.pk).aupdate(invite_code='NEW123')
+        response = await self.async_client.get('/async/profile/79990000001/')
+        self.assertIsNone(response.json()['invite_code'])
+
+        await sync_to_async(replicas.pin)('79990000001')
+        caches['profiles'].clear()
+        response = await self.async_client.get('/async/profile/79990000001/')
+        self.assertEqual(response.json()['invite_code'], 'NEW123')
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_without_replicas(self):
+        with mock.patch.object(replicas, 'get_cache') as get_cache:
+            with replicas.reading('79990000001') as alias:
+                self.assertIsNone(alias)
+                self.assertEqual(User.objects.all().db, 'default')
+            replicas.pin('79990000001')
+        get_cache.assert_not_called()
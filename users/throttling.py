@@ -0,0 +1,160 @@
+"""
+Ограничение частоты запросов к эндпоинтам входа по алгоритму token bucket.
+
+Ведро реализовано как GCRA (generic cell rate algorithm): для каждого ключа
+хранится одно число — теоретическое время прихода следующего запроса, — поэтому
+проверка стоит одного чтения и одной записи в кэш, независимо от лимита
+(в отличие от SimpleRateThrottle из DRF, который хранит историю запросов).
+
+Лимиты задаются в ``REST_FRAMEWORK['DEFAULT_THROTTLE_RATES']`` в формате DRF
+(``'5/min'``: ёмкость ведра 5 запросов, пополнение 5 запросов в минуту) под
+ключом ``<throttle_scope представления>_<вид ограничения>``, например
+``sms_phone``. Если лимит не задан, ограничение не применяется.
+
+Состояние хранится в общем кэше ``THROTTLE_CACHE_ALIAS``; если кэш недоступен,
+используется ведро в памяти процесса, чтобы отказ кэша не открыл эндпоинты.
+Чтение и запись состояния не атомарны: при гонке параллельных запросов с одним
+ключом лимит может быть превышен на единицы запросов, что для защиты от
+перебора и расхода SMS допустимо.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from . import phones
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """'5/min' -> (5, 60.0): ёмкость ведра и период пополнения в секундах"""
+    if rate is None:
+        return None
+    num, period = rate.split('/')
+    return int(num), float(PERIODS[period[0]])
+
+
+class LocalBuckets:
+    """Запасное хранилище состояния вёдер в памяти процесса"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def get(self, key):
+        with self._lock:
+            value, expires_at = self._data.get(key, (None, 0))
+        return value if expires_at > time.monotonic() else None
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            if len(self._data) > 100000:
+                now = time.monotonic()
+                self._data = {k: v for k, v in self._data.items() if v[1] > now}
+            self._data[key] = (value, time.monotonic() + timeout)
+
+
+local_buckets = LocalBuckets()
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Базовое ограничение: ведро на ключ, возвращаемый get_ident_key()"""
+    kind = None
+    timer = time.time
+
+    def get_rate(self, view):
+        scope = getattr(view, 'throttle_scope', None)
+        if scope is None:
+            return None
+        return parse_rate(api_settings.DEFAULT_THROTTLE_RATES.get(f'{scope}_{self.kind}'))
+
+    def get_ident_key(self, request, view):
+        """Ключ ведра внутри области; None — запрос не ограничивается"""
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        rate = self.get_rate(view)
+        if rate is None:
+            return True
+        ident = self.get_ident_key(request, view)
+        if ident is None:
+            return True
+
+        capacity, period = rate
+        interval = period / capacity
+        # Допустимое опережение графика: ведро вмещает capacity запросов подряд
+        tolerance = interval * (capacity - 1)
+        key = f'throttle:{view.throttle_scope}_{self.kind}:{ident}'
+
+        now = self.timer()
+        tat = max(self.cache_get(key) or now, now)
+        if tat - now > tolerance:
+            self.wait_seconds = tat - tolerance - now
+            return False
+
+        tat += interval
+        self.cache_set(key, tat, int(tat - now) + 1)
+        return True
+
+    def wait(self):
+        return getattr(self, 'wait_seconds', None)
+
+    @staticmethod
+    def cache_get(key):
+        try:
+            return caches[settings.THROTTLE_CACHE_ALIAS].get(key)
+        except Exception:
+            logger.warning('Кэш ограничений недоступен, используется локальное ведро',
+                           exc_info=True)
+            return local_buckets.get(key)
+
+    @staticmethod
+    def cache_set(key, value, timeout):
+        try:
+            caches[settings.THROTTLE_CACHE_ALIAS].set(key, value, timeout)
+        except Exception:
+            local_buckets.set(key, value, timeout)
+
+
+class PhoneNumberThrottle(TokenBucketThrottle):
+    """Ограничение на номер телефона из тела запроса"""
+    kind = 'phone'
+
+    def get_ident_key(self, request, view):
+        data = getattr(request, 'data', None)
+        if data is None:
+            # Асинхронные представления без DRF разбирают тело сами
+            data = view.get_data(request)
+        phone_number = data.get('phone_number') if hasattr(data, 'get') else None
+        if phone_number is None:
+            return None
+        # Разные записи одного номера делят одно ведро. Невалидный номер отклонит
+        # сериализатор; ведро для него всё равно заводится, чтобы перебор мусорных
+        # значений тоже упирался в лимит
+        return phones.canonical_or_none(phone_number) or ''.join(str(phone_number).split()) or None
+
+
+class IPThrottle(TokenBucketThrottle):
+    """Ограничение на IP-адрес клиента (с учётом NUM_PROXIES)"""
+    kind = 'ip'
+
+    def get_ident_key(self, request, view):
+        return self.get_ident(request)
+
+
+class GlobalThrottle(TokenBucketThrottle):
+    """Общее ограничение на эндпоинт для всех клиентов"""
+    kind = 'global'
+
+    def get_ident_key(self, request, view):
+        return 'all'
+
+
+LOGIN_THROTTLES = [PhoneNumberThrottle, IPThrottle, GlobalThrottle]
@@ -0,0 +1,147 @@
+"""
+Подписанные токены доступа и обновления.
+
+Токен — JSON с идентификатором пользователя, номером телефона, временем выпуска
+и случайным идентификатором токена, подписанный HMAC-SHA256 на ``SECRET_KEY``
+(``django.core.signing``; старые ключи из ``SECRET_KEY_FALLBACKS`` тоже
+принимаются). Проверка токена не обращается ни к базе данных, ни к таблице
+сессий: достаточно подписи, времени выпуска и списка отзыва в кэше.
+
+Токен доступа живёт ``ACCESS_TOKEN_TTL`` секунд, токен обновления —
+``REFRESH_TOKEN_TTL``. Виды токенов подписываются разной солью, поэтому токен
+обновления нельзя предъявить вместо токена доступа и наоборот. Токен обновления
+одноразовый: при обмене на новую пару он атомарно отзывается (``cache.add``), и из
+параллельных запросов с одним токеном новую пару получает только один.
+
+Отозванные токены хранятся в кэше ``TOKEN_CACHE_ALIAS`` до истечения их срока
+жизни; ``revoke_user`` отзывает все выпущенные ранее токены пользователя. Кэш
+отдельный от ``default``: вытеснение записи об отзыве при переполнении общего кэша
+снова сделало бы отозванный токен действительным.
+"""
+import math
+import secrets
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+
+ACCESS = 'access'
+REFRESH = 'refresh'
+
+
+class InvalidToken(Exception):
+    """Токен не принят; текст исключения — сообщение для клиента"""
+
+
+class Token:
+    """Проверенный токен"""
+    __slots__ = ('kind', 'user_id', 'phone_number', 'issued_at', 'id')
+
+    def __init__(self, kind, payload):
+        self.kind = kind
+        self.user_id = payload['u']
+        self.phone_number = payload['p']
+        self.issued_at = payload['t']
+        self.id = payload['j']
+
+    @property
+    def expires_at(self):
+        return self.issued_at + lifetime(self.kind)
+
+
+def lifetime(kind):
+    return settings.ACCESS_TOKEN_TTL if kind == ACCESS else settings.REFRESH_TOKEN_TTL
+
+
+def get_cache():
+    return caches[settings.TOKEN_CACHE_ALIAS]
+
+
+def signer(kind):
+    return signing.Signer(salt=f'users.tokens.{kind}')
+
+
+def revoked_key(token_id):
+    return f'token:revoked:{token_id}'
+
+
+def not_before_key(user_id):
+    return f'token:not-before:{user_id}'
+
+
+def issue(user, kind):
+    """Новый токен вида ``kind`` для пользователя"""
+    payload = {'u': user.pk, 'p': user.phone_number, 't': round(time.time(), 6),
+               'j': secrets.token_hex(8)}
+    return signer(kind).sign_object(payload)
+
+
+def issue_pair(user):
+    """Токены доступа и обновления в формате ответа API"""
+    return {
+        'access': issue(user, ACCESS),
+        'refresh': issue(user, REFRESH),
+        'token_type': 'Bearer',
+        'expires_in': settings.ACCESS_TOKEN_TTL,
+    }
+
+
+def decode(value, kind):
+    """Проверяет подпись и срок действия, без обращения к кэшу"""
+    try:
+        token = Token(kind, signer(kind).unsign_object(value))
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        raise InvalidToken("Неверный токен.")
+    if time.time() >= token.expires_at:
+        raise InvalidToken("Срок действия токена истёк.")
+    return token
+
+
+def check(value, kind):
+    """Проверенный и не отозванный токен: подпись, срок действия и одно чтение кэша"""
+    token = decode(value, kind)
+    found = get_cache().get_many([revoked_key(token.id), not_before_key(token.user_id)])
+    if revoked_key(token.id) in found or \
+            token.issued_at <= found.get(not_before_key(token.user_id), 0):
+        raise InvalidToken("Токен отозван.")
+    return token
+
+
+def revoke(token):
+    """Отзывает токен до истечения его срока действия"""
+    remaining = math.ceil(token.expires_at - time.time())
+    if remaining > 0:
+        get_cache().set(revoked_key(token.id), True, remaining)
+
+
+def claim(token):
+    """
+    Атомарно отзывает токен; False, если его уже отозвал другой запрос. ``add`` в
+    общем кэше (Redis) не даёт двум запросам одновременно использовать один токен.
+    """
+    remaining = math.ceil(token.expires_at - time.time())
+    return get_cache().add(revoked_key(token.id), True, max(remaining, 1))
+
+
+def revoke_user(user_id):
+    """Отзывает все токены пользователя, выпущенные до этого момента"""
+    get_cache().set(not_before_key(user_id), round(time.time(), 6), settings.REFRESH_TOKEN_TTL)
+
+
+def refresh(value):
+    """
+    Обменивает токен обновления на новую пару, прежний токен обновления отзывается.
+    Единственное место, где токен сверяется с базой: пользователь должен
+    существовать и быть активным.
+    """
+    from .models import User
+
+    token = check(value, REFRESH)
+    user = User.objects.filter(pk=token.user_id, is_active=True).only('pk', 'phone_number').first()
+    if user is None:
+        raise InvalidToken("Пользователь не найден или не активен.")
+    # Проверка отзыва выше не атомарна: параллельный запрос мог пройти её с тем же токеном
+    if not claim(token):
+        raise InvalidToken("Токен отозван.")
+    return issue_pair(user)
@@ -0,0 +1,180 @@
+"""
+Хранилище кодов верификации.
+
+Коды хранятся отдельно от пользователя, по ключу "номер телефона", со сроком
+действия и счётчиком неудачных попыток. Проверка кода — один поиск по ключу,
+а выдача нового кода не переписывает строку пользователя. Реализация задаётся
+настройкой ``VERIFICATION_STORE``:
+
+* ``DatabaseVerificationStore`` — таблица ``VerificationCode``, истёкшие коды
+  удаляются пачкой командой ``manage.py purge_verification_codes``;
+* ``CacheVerificationStore`` — кэш Django (в памяти процесса или Redis),
+  истёкшие записи удаляет сам кэш.
+"""
+import secrets
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.module_loading import import_string
+
+from .models import VerificationCode
+
+# Результаты проверки кода
+VALID = 'valid'
+INVALID = 'invalid'
+EXPIRED = 'expired'
+TOO_MANY_ATTEMPTS = 'too_many_attempts'
+
+ERROR_MESSAGES = {
+    INVALID: "Неверный код верификации",
+    EXPIRED: "Срок действия кода верификации истёк, запросите новый код",
+    TOO_MANY_ATTEMPTS: "Превышено количество попыток, запросите новый код",
+}
+
+
+def generate_code():
+    """Случайный 4-значный код верификации"""
+    return str(1000 + secrets.randbelow(9000))
+
+
+class BaseVerificationStore:
+    """Базовый класс хранилища кодов верификации"""
+
+    def __init__(self, ttl=None, max_attempts=None):
+        self.ttl = ttl or settings.VERIFICATION_CODE_TTL
+        self.max_attempts = max_attempts or settings.VERIFICATION_MAX_ATTEMPTS
+
+    def issue(self, phone_number):
+        """Выдаёт новый код для номера (прежний код перестаёт действовать) и возвращает его"""
+        raise NotImplementedError
+
+    def check(self, phone_number, code):
+        """
+        Проверяет код. Верный код погашается и больше не принимается,
+        после ``max_attempts`` неверных попыток код аннулируется.
+        Возвращает одну из констант VALID, INVALID, EXPIRED, TOO_MANY_ATTEMPTS.
+        """
+        raise NotImplementedError
+
+    def discard(self, phone_number):
+        """Аннулирует код номера"""
+        raise NotImplementedError
+
+    def purge_expired(self):
+        """Удаляет истёкшие коды, возвращает количество удалённых"""
+        return 0
+
+    async def aissue(self, phone_number):
+        return await sync_to_async(self.issue)(phone_number)
+
+    async def acheck(self, phone_number, code):
+        return await sync_to_async(self.check)(phone_number, code)
+
+
+class DatabaseVerificationStore(BaseVerificationStore):
+    """Коды в таблице VerificationCode с первичным ключом по номеру телефона"""
+
+    def issue(self, phone_number):
+        code = generate_code()
+        # INSERT ... ON CONFLICT DO UPDATE: один запрос и для нового, и для повторного кода
+        VerificationCode.objects.bulk_create(
+            [VerificationCode(phone_number=phone_number, code=code, attempts=0,
+                              expires_at=timezone.now() + timedelta(seconds=self.ttl))],
+            update_conflicts=True,
+            unique_fields=['phone_number'],
+            update_fields=['code', 'expires_at', 'attempts'],
+        )
+        return code
+
+    def check(self, phone_number, code):
+        now = timezone.now()
+        # Верный код погашается одним условным DELETE: из параллельных проверок
+        # одного кода успешной окажется только одна
+        consumed, _ = VerificationCode.objects.filter(
+            phone_number=phone_number, code=code, expires_at__gt=now).delete()
+        if consumed:
+            return VALID
+
+        entry = VerificationCode.objects.filter(phone_number=phone_number).first()
+        if entry is None:
+            return INVALID
+        if entry.expires_at <= now:
+            entry.delete()
+            return EXPIRED
+        # Счётчик увеличивается условным UPDATE, а не по прочитанному значению:
+        # параллельные неверные попытки не могут прочитать одно и то же число
+        if VerificationCode.objects.filter(
+                pk=phone_number, expires_at__gt=now,
+                attempts__lt=self.max_attempts - 1).update(attempts=F('attempts') + 1):
+            return INVALID
+        self.discard(phone_number)
+        return TOO_MANY_ATTEMPTS
+
+    def discard(self, phone_number):
+        VerificationCode.objects.filter(pk=phone_number).delete()
+
+    def purge_expired(self):
+        # Один DELETE по индексу expires_at
+        deleted, _ = VerificationCode.objects.filter(expires_at__lte=timezone.now()).delete()
+        return deleted
+
+
+class CacheVerificationStore(BaseVerificationStore):
+    """Коды в кэше Django: срок действия задаётся таймаутом записи"""
+
+    def __init__(self, alias=None, **kwargs):
+        super().__init__(**kwargs)
+        self.alias = alias or settings.VERIFICATION_CACHE_ALIAS
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def code_key(phone_number):
+        return f'verification:code:{phone_number}'
+
+    @staticmethod
+    def attempts_key(phone_number):
+        return f'verification:attempts:{phone_number}'
+
+    def issue(self, phone_number):
+        code = generate_code()
+        self.cache.set_many({self.code_key(phone_number): code,
+                             self.attempts_key(phone_number): 0}, self.ttl)
+        return code
+
+    def check(self, phone_number, code):
+        stored = self.cache.get(self.code_key(phone_number))
+        if stored is None:
+            # Истёкшая запись удалена кэшем и неотличима от отсутствующей
+            return INVALID
+        if constant_time_compare(stored, code):
+            # delete() сообщает, удалил ли ключ именно этот вызов: так код
+            # погашается однократно даже при параллельных проверках
+            if self.cache.delete(self.code_key(phone_number)):
+                self.cache.delete(self.attempts_key(phone_number))
+                return VALID
+            return INVALID
+        try:
+            # incr атомарен, поэтому параллельные попытки подбора не теряются
+            attempts = self.cache.incr(self.attempts_key(phone_number))
+        except ValueError:
+            attempts = self.max_attempts
+        if attempts >= self.max_attempts:
+            self.discard(phone_number)
+            return TOO_MANY_ATTEMPTS
+        return INVALID
+
+    def discard(self, phone_number):
+        self.cache.delete_many([self.code_key(phone_number), self.attempts_key(phone_number)])
+
+
+def get_store(store=None, **kwargs):
+    """Создаёт хранилище по пути к классу (по умолчанию ``VERIFICATION_STORE``)"""
+    return import_string(store or settings.VERIFICATION_STORE)(**kwargs)
@@ -1,20 +1,38 @@
-import random
-import time
+import json
+from types import SimpleNamespace
 
+from django.conf import settings
 from django.contrib import messages
+from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import status
+from rest_framework.exceptions import NotAuthenticated, PermissionDenied
 from rest_framework.generics import GenericAPIView
+from rest_framework.permissions import IsAdminUser
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
 
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.views.generic import FormView, DetailView
 
+from users import events, leaderboard, metrics, phones, referral_tree, replicas, tokens, \
+    verification
 from users.forms import PhoneNumberForm, VerificationCodeForm, ActiveInviteCodeView
-from .models import User
+from .authentication import TokenUser
+from .cache import get_invited_users_page, profile_cache, set_invited_users_page
+from .models import Referral, User
+from .pagination import InvitedUsersPagination
+from .renderers import FastJSONRenderer
 from .serializers import PhoneNumberVerificationSerializer, VerificationCodeSerializer, \
-    UserProfileSerializer, InviteCodeSerializer
+    DownlineSerializer, UserProfileSerializer, InviteCodeSerializer, InvitedUsersPageSerializer, \
+    LeaderboardSerializer, ProfileCacheStatsSerializer, ProfileLookupSerializer, \
+    TokenRefreshSerializer, load_profile
+from .throttling import LOGIN_THROTTLES
 
 
 # region API
@@ -24,6 +42,8 @@ class PhoneNumberView(GenericAPIView):
     После успешной валидации номера телефона генерируется 4-значный код для верификации.
     """
     serializer_class = PhoneNumberVerificationSerializer
+    throttle_classes = LOGIN_THROTTLES
+    throttle_scope = 'sms'
 
     @swagger_auto_schema(operation_summary="Авторизация по номеру телефона")
     def post(self, request, *args, **kwargs):
@@ -35,8 +55,8 @@ class PhoneNumberView(GenericAPIView):
 
           "phone_number" числовое поле json: "номер телефона, 11-15 цифр",
 
-        Возвращает сообщение о результате операции и отправляет код верификации с
-        имитацией задержки в 1-2 секунды на введённый номер.
+        Возвращает сообщение о результате операции и ставит SMS с кодом верификации
+        в очередь отправки, не дожидаясь доставки.
         """
         serializer = PhoneNumberVerificationSerializer(data=request.data)
 
@@ -45,8 +65,8 @@ class PhoneNumberView(GenericAPIView):
                 'phone_number']  # Извлекаем номер телефона из данных.
 
             # Проверка на существование пользователя с данным номером телефона.
-            user = User.objects.filter(
-                phone_number=phone_number).first()  # Используем номер телефона как username
+            user = User.objects.by_phone(
+                phone_number).first()  # Используем номер телефона как username
             if user:
                 if user.is_active:
                     # Если пользователь уже верифицирован (is_active=1),
@@ -60,9 +80,6 @@ class PhoneNumberView(GenericAPIView):
                     # отправляем новый код верификации.
                     verification_code = user.generate_and_send_verification_code()
 
-                    # Имитируем задержку на сервере для отправки кода верификации.
-                    time.sleep(random.randint(1, 2))  # Задержка от 1 до 2 секунд.
-
                     return Response({
                         "message": "Новый код верификации отправлен на номер телефона",
                         "verification_code": verification_code
@@ -74,9 +91,6 @@ class PhoneNumberView(GenericAPIView):
                                            phone_number=phone_number, is_active=False)
                 verification_code = user.generate_and_send_verification_code()
 
-                # Имитируем задержку на сервере для отправки кода верификации.
-                time.sleep(random.randint(1, 2))  # Задержка от 1 до 2 секунд.
-
                 return Response({
                     "message": "Пользователь создан, код верификации отправлен на номер телефона",
                     "verification_code": verification_code
@@ -92,6 +106,8 @@ class VerificationCodeView(GenericAPIView):
     Если код правильный, то создается или обновляется пользователь.
     """
     serializer_class = VerificationCodeSerializer
+    throttle_classes = LOGIN_THROTTLES
+    throttle_scope = 'verify'
 
     @swagger_auto_schema(operation_summary="Верификация номера телефона")
     def post(self, request, *args, **kwargs):
@@ -105,7 +121,9 @@ class VerificationCodeView(GenericAPIView):
           "phone_number" числовое поле json: "номер телефона, 11-15 цифр",
           "verification_code" числовое поле json: "4 цифры"
 
-        Возвращает сообщение о результате операции.
+        Возвращает сообщение о результате операции, при успешной верификации —
+        токены доступа и обновления (access, refresh): токен доступа передаётся
+        в заголовке "Authorization: Bearer <токен>".
         """
         # Создаем экземпляр сериализатора с данными из запроса.
         serializer = VerificationCodeSerializer(data=request.data)
@@ -116,25 +134,22 @@ class VerificationCodeView(GenericAPIView):
                 'verification_code']  # Извлекаем верификационный код
 
             # Проверка на существование пользователя с данным номером телефона.
-            user = User.objects.filter(phone_number=phone_number).first()
+            user = User.objects.by_phone(phone_number).first()
 
             if user:
-                # Проверяем, совпадает ли введённый верификационный код с сохранённым у пользователя
-                if user.verification_code == verification_code:
-                    if not user.invite_code:
-                        user.generate_invite_code()
-                    user.is_active = True
-                    user.save()
-
-                    # Имитируем задержку на сервере для отправки кода верификации.
-                    time.sleep(random.randint(1, 2))  # Задержка от 1 до 2 секунд.
+                # Проверяем код в хранилище кодов верификации (поиск по номеру телефона)
+                result = user.check_verification_code(verification_code)
+                if result == verification.VALID:
+                    # Активация и выдача инвайт-кода одним UPDATE
+                    user.verify()
 
                     return Response({
-                        "message": f"Верификация прошла успешно! Ваш invite-код: {user.invite_code}"
+                        "message": f"Верификация прошла успешно! Ваш invite-код: {user.invite_code}",
+                        **tokens.issue_pair(user),
                     }, status=status.HTTP_200_OK)
                 else:
                     return Response({
-                        "message": "Неверный код верификации"
+                        "message": verification.ERROR_MESSAGES[result]
                     }, status=status.HTTP_400_BAD_REQUEST)
             else:
                 return Response({
@@ -145,9 +160,10 @@ class VerificationCodeView(GenericAPIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class UserProfileView(GenericAPIView):
+class UserProfileAPIView(GenericAPIView):
     # permission_classes = [IsAuthenticated]
     serializer_class = UserProfileSerializer
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
 
     @swagger_auto_schema(operation_summary="Просмотр профиля пользователя.")
     def get(self, request, *args, **kwargs):
@@ -170,18 +186,247 @@ class UserProfileView(GenericAPIView):
           "invited_users": ["8989989989"]
         }
         """
-        username = kwargs.get('username')  # Извлекаем username из URL-параметра
+        # username из URL-параметра в любой записи номера телефона
+        phone_number = phones.canonical_or_none(kwargs.get('username'))
 
-        try:
-            user = User.objects.get(
-                username=username)  # Находим пользователя по username
-        except User.DoesNotExist:
+        # Данные профиля берём из кэша, при промахе сериализуем пользователя из базы
+        data = phone_number and profile_cache.get_or_load(phone_number, load_profile)
+        if data is None:
+            return Response({"message": "Пользователь не найден"},
+                            status=status.HTTP_404_NOT_FOUND)
+        return Response(data, status=status.HTTP_200_OK)
+
+
+class ProfileCacheStatsView(GenericAPIView):
+    permission_classes = [IsAdminUser]
+    serializer_class = ProfileCacheStatsSerializer
+
+    @swagger_auto_schema(operation_summary="Статистика кэша профилей.",
+                         responses={200: ProfileCacheStatsSerializer})
+    def get(self, request, *args, **kwargs):
+        """
+        Счётчики кэша профилей текущего процесса: попадания, промахи, инвалидации
+        (новые версии профилей) и доля попаданий. Доступно только администраторам.
+        """
+        return Response(profile_cache.stats(), status=status.HTTP_200_OK)
+
+
+class ProfileLookupView(GenericAPIView):
+    permission_classes = [IsAdminUser]
+    serializer_class = ProfileLookupSerializer
+    # Пользователей на один запрос к базе; ответ формируется и отдаётся по частям
+    chunk_size = 1000
+    fields = ['username', 'phone_number', 'invite_code', 'activated_invite_code',
+              'invited_count']
+
+    @swagger_auto_schema(operation_summary="Пакетное получение профилей.")
+    def post(self, request, *args, **kwargs):
+        """
+        Данные профилей для списка пользователей (например, для синхронизации с CRM).
+        Доступно только администраторам.
+
+        Параметры:
+          "usernames" список строк: имена пользователей (номера телефонов),
+          не больше PROFILE_LOOKUP_MAX_BATCH (по умолчанию 5000)
+
+        Возвращает NDJSON (application/x-ndjson): по одной JSON-строке на каждое имя
+        в порядке запроса. Каждые 1000 имён загружаются одним запросом к базе.
+
+        Пример ответа на запрос:
+
+          {"username": "79990000000", "phone_number": "79990000000", "invite_code": "0aVNRO",
+           "activated_invite_code": null, "invited_count": 2}
+          {"username": "79990000001", "error": "not_found"}
+        """
+        serializer = ProfileLookupSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        usernames = serializer.validated_data['usernames']
+        return StreamingHttpResponse(self.stream(usernames),
+                                     content_type='application/x-ndjson')
+
+    def stream(self, usernames):
+        for start in range(0, len(usernames), self.chunk_size):
+            chunk = usernames[start:start + self.chunk_size]
+            keys = [phones.key_or_none(username) for username in chunk]
+            # Пакетная выгрузка допускает отставание реплики: номера не закрепляются
+            with replicas.reading():
+                users = User.objects.only('phone_key', *self.fields).in_bulk(
+                    [key for key in keys if key is not None], field_name='phone_key')
+            lines = []
+            for username, key in zip(chunk, keys):
+                user = users.get(key)
+                data = ({field: getattr(user, field) for field in self.fields} if user
+                        else {'username': username, 'error': 'not_found'})
+                lines.append(json.dumps(data, ensure_ascii=False))
+            yield '\n'.join(lines) + '\n'
+
+
+class DownlineView(GenericAPIView):
+    serializer_class = DownlineSerializer
+
+    @swagger_auto_schema(operation_summary="Статистика нижней линии рефералов.",
+                         manual_parameters=[openapi.Parameter(
+                             'max_depth', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                             description='Ограничение глубины обхода')],
+                         responses={200: DownlineSerializer})
+    def get(self, request, *args, **kwargs):
+        """
+        Статистика всего дерева рефералов пользователя: приглашённые, приглашённые
+        ими и т. д. Считается одним SQL-запросом.
+
+        Параметры:
+          Поле "username" строковое: 11-15 цифр
+          Параметр запроса "max_depth": ограничение глубины обхода (необязательный)
+
+        Возвращает глубину дерева, общее количество рефералов и количество на каждом уровне.
+
+        Пример ответа на запрос:
+
+        {
+          "depth": 2,
+          "total": 3,
+          "levels": [{"level": 1, "count": 2}, {"level": 2, "count": 1}]
+        }
+        """
+        user_id = User.objects.by_phone(kwargs.get('username')) \
+            .values_list('pk', flat=True).first()
+        if user_id is None:
             return Response({"message": "Пользователь не найден"},
                             status=status.HTTP_404_NOT_FOUND)
+        try:
+            max_depth = int(request.query_params.get('max_depth', 0)) or None
+        except ValueError:
+            return Response({"max_depth": ["Ожидается целое число"]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(referral_tree.downline_stats(user_id, max_depth),
+                        status=status.HTTP_200_OK)
+
+
+class LeaderboardView(GenericAPIView):
+    serializer_class = LeaderboardSerializer
+    max_limit = 100
+
+    @swagger_auto_schema(operation_summary="Рейтинг пригласивших пользователей.",
+                         manual_parameters=[
+                             openapi.Parameter('period', openapi.IN_QUERY,
+                                               type=openapi.TYPE_STRING,
+                                               enum=leaderboard.PERIODS),
+                             openapi.Parameter('limit', openapi.IN_QUERY,
+                                               type=openapi.TYPE_INTEGER,
+                                               minimum=1, maximum=max_limit)],
+                         responses={200: LeaderboardSerializer})
+    def get(self, request, *args, **kwargs):
+        """
+        Пользователи с наибольшим количеством приглашённых. Рейтинг публичный:
+        номера телефонов в нём маскируются (видны первые 4 и последние 2 цифры).
+
+        Параметры запроса:
+          "period": all (за всё время, по умолчанию), day, week или month (текущий
+          календарный день, неделя или месяц)
+          "limit": количество мест, от 1 до 100 (по умолчанию 10)
+
+        Пример ответа на запрос:
+
+        {
+          "period": "week",
+          "period_start": "2024-11-18",
+          "results": [{"rank": 1, "user": "7999*****00", "invited_count": 12}]
+        }
+        """
+        period = request.query_params.get('period', leaderboard.ALL_TIME)
+        if period not in leaderboard.PERIODS:
+            return Response({"period": [f"Допустимые значения: {', '.join(leaderboard.PERIODS)}"]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = int(request.query_params.get('limit', 10))
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= self.max_limit:
+            return Response({"limit": [f"Ожидается целое число от 1 до {self.max_limit}"]},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        start, results = leaderboard.top(period, limit)
+        return Response({'period': period, 'period_start': start, 'results': results},
+                        status=status.HTTP_200_OK)
+
+
+def metrics_view(request):
+    """Метрики запросов процесса и очереди событий в текстовом формате Prometheus"""
+    token = settings.METRICS_TOKEN
+    if token and not constant_time_compare(request.headers.get('Authorization', ''),
+                                           f'Bearer {token}'):
+        return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+    return HttpResponse(metrics.registry.render() + events.render_metrics(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class InvitedUsersView(GenericAPIView):
+    serializer_class = InvitedUsersPageSerializer
+    pagination_class = InvitedUsersPagination
+
+    @swagger_auto_schema(operation_summary="Список приглашённых пользователей.",
+                         responses={200: InvitedUsersPageSerializer})
+    def get(self, request, *args, **kwargs):
+        """
+        Постраничный список пользователей, активировавших инвайт-код профиля.
+
+        Параметры:
+          Поле "username" строковое: 11-15 цифр
+          Параметр запроса "cursor": курсор следующей/предыдущей страницы
 
-        # Сериализуем данные пользователя
-        serializer = self.get_serializer(user)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        Возвращает количество приглашённых, ссылки на соседние страницы и номера
+        телефонов приглашённых пользователей (сначала новые). Первая страница
+        кэшируется и сбрасывается при активации инвайт-кода.
+
+        Пример ответа на запрос:
+
+        {
+          "count": 1,
+          "next": null,
+          "previous": null,
+          "results": ["8989989989"]
+        }
+        """
+        phone_number = phones.canonical_or_none(kwargs.get('username'))
+        first_page = bool(phone_number) and \
+            not request.query_params.get(self.paginator.cursor_query_param)
+        if first_page:
+            # Версия читается до загрузки списка (см. users/cache.py)
+            version = profile_cache.get_version(phone_number)
+            cached = get_invited_users_page(phone_number, version)
+            if cached is not None:
+                return Response({
+                    'count': cached['count'],
+                    'next': self.paginator.cursor_link(request, cached['next_cursor']),
+                    'previous': None,
+                    'results': cached['results'],
+                }, status=status.HTTP_200_OK)
+
+        # С реплики, если список не изменялся только что (см. users/replicas.py)
+        with replicas.reading(phone_number):
+            user = User.objects.by_phone(phone_number).values('pk', 'invited_count').first()
+            if user is None:
+                return Response({"message": "Пользователь не найден"},
+                                status=status.HTTP_404_NOT_FOUND)
+
+            # Только нужные колонки, без создания экземпляров моделей
+            queryset = (Referral.objects.filter(inviter_id=user['pk'])
+                        .values('id', 'activated_at', 'invitee__phone_number'))
+            page = self.paginate_queryset(queryset)
+        data = {
+            'count': user['invited_count'],
+            'next': self.paginator.get_next_link(),
+            'previous': self.paginator.get_previous_link(),
+            'results': [row['invitee__phone_number'] for row in page],
+        }
+        if first_page:
+            set_invited_users_page(phone_number, version, {
+                'count': data['count'],
+                'next_cursor': self.paginator.get_next_cursor(),
+                'results': data['results'],
+            })
+        return Response(data, status=status.HTTP_200_OK)
 
 
 class ActivateInviteCodeView(GenericAPIView):
@@ -193,11 +438,14 @@ class ActivateInviteCodeView(GenericAPIView):
         """
         Активация инвайт-кода.
         Предусмотренны случаи ранее активированного инвайт-кода, несуществующего кода,
-        успешной активации. Реализовано ьез необходимости предварительной авторизации.
+        успешной активации. Пользователь определяется по токену доступа из заголовка
+        "Authorization: Bearer <токен>", без запроса к базе; без токена (если
+        INVITE_ACTIVATION_REQUIRES_TOKEN выключен) — по номеру телефона в теле запроса.
 
         Параметры:
 
-          "phone_number" числовое поле json: "номер телефона, 11-15 цифр",
+          "phone_number" числовое поле json: "номер телефона, 11-15 цифр"
+          (с токеном необязательно, но должно совпадать с номером из токена),
           "activated_invite_code" строка json: "любые шесть символов"
 
           Поле "username" и поле "phone_number" должны содержать один номер телефона.
@@ -208,8 +456,8 @@ class ActivateInviteCodeView(GenericAPIView):
         if request.data.get('activated_invite_code'):
             # Получаем инвайт-код из запроса
             activated_invite_code = request.data.get('activated_invite_code')
-            # Получаем пользователя (не авторизированного) добавляющего инвайт
-            user = User.objects.get(phone_number=request.data.get('phone_number'))
+            # Получаем пользователя, добавляющего инвайт
+            user = self.get_invitee(request)
 
             try:
                 # Проверяем, существует ли пользователь с этим инвайт-кодом
@@ -219,10 +467,14 @@ class ActivateInviteCodeView(GenericAPIView):
                                             "с таким инвайт-кодом."},
                                 status=status.HTTP_400_BAD_REQUEST)
 
-            # Если инвайн не активировался ранее
-            if user.activated_invite_code is None:
-                # Проверка на добавление своего же инвайт-кода
-                user.activate_invite_code(request.data.get('activated_invite_code'))
+            # Проверка на добавление своего же инвайт-кода
+            if inviter.pk == user.pk:
+                return Response({"message": "Нельзя активировать свой инвайт-код"},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            # Активация применяется, только если инвайт не активировался ранее:
+            # условие проверяет база данных, поэтому параллельные запросы не проходят дважды
+            if user.activate_invite_code(activated_invite_code, inviter=inviter):
                 return Response(
                     {
                         "message": f"Инвайт-код {request.data.get('activated_invite_code')} "
@@ -232,6 +484,66 @@ class ActivateInviteCodeView(GenericAPIView):
                 return Response({"message": f"Инвайт-код ранее активирован"},
                                 status=status.HTTP_400_BAD_REQUEST)
 
+    @staticmethod
+    def get_invitee(request):
+        if isinstance(request.user, TokenUser):
+            phone_number = request.data.get('phone_number')
+            if phone_number and phones.canonical_or_none(phone_number) != request.user.phone_number:
+                raise PermissionDenied("Номер телефона не совпадает с номером из токена.")
+            return request.user.get_user()
+        if settings.INVITE_ACTIVATION_REQUIRES_TOKEN:
+            raise NotAuthenticated()
+        return User.objects.by_phone(request.data.get('phone_number')).get()
+
+
+class TokenRefreshView(GenericAPIView):
+    serializer_class = TokenRefreshSerializer
+
+    @swagger_auto_schema(operation_summary="Обновление токена доступа.")
+    def post(self, request, *args, **kwargs):
+        """
+        Обмен токена обновления на новую пару токенов; прежний токен обновления
+        после обмена не принимается.
+
+        Параметры:
+          "refresh" строка json: токен обновления, выданный при верификации
+
+        Возвращает access, refresh, token_type и expires_in (секунды).
+        """
+        serializer = TokenRefreshSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            data = tokens.refresh(serializer.validated_data['refresh'])
+        except tokens.InvalidToken as error:
+            return Response({"message": str(error)}, status=status.HTTP_401_UNAUTHORIZED)
+        return Response(data, status=status.HTTP_200_OK)
+
+
+class TokenRevokeView(GenericAPIView):
+    serializer_class = TokenRefreshSerializer
+
+    @swagger_auto_schema(operation_summary="Отзыв токенов (выход).")
+    def post(self, request, *args, **kwargs):
+        """
+        Отзывает токен обновления из тела запроса и токен доступа из заголовка
+        Authorization, если он передан.
+
+        Параметры:
+          "refresh" строка json: токен обновления
+        """
+        serializer = TokenRefreshSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            refresh = tokens.decode(serializer.validated_data['refresh'], tokens.REFRESH)
+        except tokens.InvalidToken as error:
+            return Response({"message": str(error)}, status=status.HTTP_401_UNAUTHORIZED)
+        tokens.revoke(refresh)
+        if isinstance(request.auth, tokens.Token):
+            tokens.revoke(request.auth)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 
 # endregion API
 
@@ -245,7 +557,7 @@ class HomePageView(FormView):
     def form_valid(self, form):
         phone_number = form.cleaned_data['phone_number']
         try:
-            user = User.objects.get(phone_number=phone_number)
+            user = User.objects.by_phone(phone_number).get()
             # Проверка верификации
             if user.is_active:
                 # Перенаправляем на профиль пользователя
@@ -264,37 +576,78 @@ class VerifyPhoneNumberView(FormView):
     def form_valid(self, form):
         verification_code = form.cleaned_data['verification_code']
         try:
-            user = User.objects.get(verification_code=verification_code)
-            if user.verification_code == verification_code:
+            user = User.objects.by_phone(self.kwargs['phone_number']).get()
+            result = user.check_verification_code(verification_code)
+            if result == verification.VALID:
                 # Код верен, генерируем инвайт-код, меняем статус активации пользователя.
-                user.generate_invite_code()
-                user.is_active = True
-                user.save()
+                user.verify()
                 return redirect('profile', username=user.username)
             else:
-                return HttpResponse("Неверный код верификации", status=400)
+                return HttpResponse(verification.ERROR_MESSAGES[result], status=400)
         except User.DoesNotExist:
             return HttpResponse("Пользователь не найден", status=404)
 
 
+def profile_version(request, username):
+    """Версия профиля, один раз на запрос: из неё строятся ETag и Last-Modified"""
+    if not hasattr(request, 'profile_version'):
+        request.profile_version = profile_cache.get_version(
+            phones.canonical_or_none(username) or username)
+    return request.profile_version
+
+
+def profile_etag(request, username):
+    return str(profile_version(request, username))
+
+
+def profile_last_modified(request, username):
+    return profile_cache.last_modified(profile_version(request, username))
+
+
 class UserProfileView(DetailView, FormView):
+    """
+    Страница профиля. Повторный просмотр без изменений профиля отвечает
+    ``304 Not Modified`` по ETag/Last-Modified из версии профиля в кэше, без
+    обращения к базе и без рендеринга шаблона; блок приглашённых кэшируется
+    фрагментом под той же версией. Активация инвайт-кода и верификация
+    выставляют новую версию (см. ``ProfileCache.invalidate``).
+    """
     model = User
     template_name = 'users/profile.html'
     context_object_name = 'user'
     form_class = ActiveInviteCodeView
 
+    # Браузер перепроверяет страницу при каждом просмотре, а не хранит её по эвристике
+    @method_decorator(cache_control(private=True, no_cache=True))
+    @method_decorator(condition(etag_func=profile_etag,
+                                last_modified_func=profile_last_modified))
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update(profile_version=profile_version(self.request, self.kwargs['username']),
+                       fragment_cache_alias=settings.PROFILE_CACHE_ALIAS,
+                       fragment_cache_timeout=settings.PROFILE_CACHE_TIMEOUT)
+        return context
+
     def form_valid(self, form):
         activated_invite_code = form.cleaned_data['activated_invite_code']
-        is_exists = User.objects.filter(invite_code=activated_invite_code).exists()
+        inviter = User.objects.filter(invite_code=activated_invite_code).first()
 
-        if is_exists:
-            user = User.objects.get(username=self.kwargs['username'])
-            user.activate_invite_code(activated_invite_code)
+        if inviter:
+            user = User.objects.by_phone(self.kwargs['username']).get()
+            user.activate_invite_code(activated_invite_code, inviter=inviter)
             return redirect('profile', username=self.kwargs['username'])
         else:
             return redirect('profile', username=self.kwargs['username'])
 
     def get_object(self, queryset=None):
-        return User.objects.get(username=self.kwargs['username'])
+        # Профиль читается через общий кэш профилей, как и в API
+        phone_number = phones.canonical_or_none(self.kwargs['username'])
+        data = phone_number and profile_cache.get_or_load(phone_number, load_profile)
+        if data is None:
+            raise Http404("Пользователь не найден")
+        return SimpleNamespace(username=phone_number, **data)
 
 # endregion Templates